@@ -17,7 +17,9 @@ and license to the output file.
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--input_dir', default='output/scenes')
-parser.add_argument('--output_file', default='output/CLEVR_misc_scenes.json')
+parser.add_argument('--output_file', default='output/CLEVR_misc_scenes.json',
+           help='Output file; if it ends in .jsonl then a JSON-lines file ' +
+                'with one scene per line is written instead')
 parser.add_argument('--version', default='1.data')
 parser.add_argument('--date', default='7/8/2017')
 parser.add_argument('--license',
@@ -53,7 +55,14 @@ def main(args):
     'scenes': scenes
   }
   with open(args.output_file, 'w') as f:
-    json.dump(output, f)
+    if args.output_file.endswith('.jsonl'):
+      # JSON-lines: the info followed by one scene per line, so that readers
+      # can stream scenes without loading the whole file
+      f.write(json.dumps({'info': output['info']}) + '\n')
+      for scene in scenes:
+        f.write(json.dumps(scene) + '\n')
+    else:
+      json.dump(output, f)
 
 
 if __name__ == '__main__':
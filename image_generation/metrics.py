@@ -0,0 +1,97 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import json, time
+
+"""
+Per-scene timers and counters for render_images.py, written as one JSON line per
+scene so that we can see where rendering time goes. See summarize_metrics.py
+for a report over such a file.
+
+Recording is off until open_file is called; until then timer and count do
+nothing, so the instrumented code behaves the same with and without metrics.
+Between begin_scene and end_scene:
+
+- with timer("name"): ... adds the wall time of the block to the stage "name".
+  Timers nest, and a stage is recorded under the path of the stages it was
+  started in, e.g. "add_random_objects/add_text".
+- count("name", n) adds n to a counter.
+
+end_scene writes a record like:
+
+{"scene": 12, "seconds": 41.2, "stages": {"render": {"seconds": 35.1, "calls": 1},
+ ...}, "counters": {"visibility_failures": 2, ...}}
+"""
+
+_file = None
+_scene = None
+_stack = []
+
+
+def open_file(path):
+    """ Start recording metrics, appending them to the JSON-lines file at path """
+    global _file
+    _file = open(path, "a")
+
+
+def enabled():
+    return _file is not None and _scene is not None
+
+
+def begin_scene(**fields):
+    """ Start the record of a scene; fields are stored in the record as they are """
+    global _scene
+    if _file is None:
+        return
+    _scene = dict(fields)
+    _scene["stages"] = {}
+    _scene["counters"] = {}
+    _scene["start"] = time.time()
+    del _stack[:]
+
+
+def end_scene(**fields):
+    """ Finish the record of the current scene and write it out """
+    global _scene
+    if not enabled():
+        return
+    record = _scene
+    _scene = None
+    record.update(fields)
+    record["seconds"] = time.time() - record.pop("start")
+    # A single write per scene, so that several processes can append to the
+    # same file
+    _file.write(json.dumps(record) + "\n")
+    _file.flush()
+
+
+class timer(object):
+    """ Context manager timing a stage of the current scene """
+
+    def __init__(self, name):
+        self.name = name
+        self.path = None
+
+    def __enter__(self):
+        if enabled():
+            _stack.append(self.name)
+            self.path = "/".join(_stack)
+            self.tic = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.path is not None and enabled():
+            _stack.pop()
+            stage = _scene["stages"].setdefault(self.path, {"seconds": 0.0, "calls": 0})
+            stage["seconds"] += time.time() - self.tic
+            stage["calls"] += 1
+
+
+def count(name, n=1):
+    """ Add n to the counter name of the current scene """
+    if enabled():
+        _scene["counters"][name] = _scene["counters"].get(name, 0) + n
@@ -0,0 +1,248 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import argparse, math, random, sys
+import numpy as np
+
+"""
+Sampling of object layouts on the ground plane. This module does not depend on
+Blender, so layouts can be generated and checked with plain Python; render_images.py
+only builds the geometry for a layout once it has been sampled.
+
+Objects are placed one at a time. A position is valid for a new object if it is
+at least min_dist away from every placed object (after subtracting both radii),
+and if along each of the cardinal directions (left, right, front, behind) it is
+not within margin of a placed object; this makes resolving spatial relationships
+slightly less ambiguous.
+
+Candidate positions for each object are drawn uniformly at random over the
+ground plane, as render_images.py has always done, but in batches that are
+tested against all placed objects at once.
+
+All sampling takes an explicit numpy RandomState; make_rng seeds one from
+Python's random module, so a layout is reproducible whenever random is seeded.
+
+Running this module as a script (python placement.py) samples layouts, checks
+them with validate_layout and prints the number of restarts they needed; it
+exits with an error if any layout is invalid, so it can be run in CI.
+"""
+
+CARDINAL_DIRECTIONS = ["left", "right", "front", "behind"]
+
+
+def make_rng():
+    """ A numpy RandomState seeded from Python's random module """
+    return np.random.RandomState(random.getrandbits(32))
+
+
+def direction_matrix(directions):
+    """
+  Stack the (x, y) parts of the cardinal directions from a view_struct
+  "directions" dictionary into a (4, 2) array. These directions must lie in the
+  ground plane.
+  """
+    for name in CARDINAL_DIRECTIONS:
+        assert directions[name][2] == 0
+    return np.array([directions[name][:2] for name in CARDINAL_DIRECTIONS], dtype=np.float64)
+
+
+def placement_ok(candidates, radius, positions, radii, direction_mat, min_dist, margin):
+    """
+  Check candidate positions for a new object of the given radius against the
+  placed objects at positions (an (M, 2) array) with the given radii.
+
+  Returns a boolean array with one entry per candidate.
+  """
+    candidates = np.asarray(candidates, dtype=np.float64).reshape(-1, 2)
+    if len(positions) == 0:
+        return np.ones(len(candidates), dtype=bool)
+    # diff[k, m] = (dx, dy) from placed object m to candidate k
+    diff = candidates[:, None, :] - positions[None, :, :]
+    dist = np.sqrt((diff ** 2).sum(axis=2))
+    dists_good = (dist - radius - radii[None, :] >= min_dist).all(axis=1)
+    margins = diff.dot(direction_mat.T)
+    margins_good = ~((margins > 0) & (margins < margin)).any(axis=(1, 2))
+    return dists_good & margins_good
+
+
+def draw_position(rng, num, bounds, radius, positions, radii, min_dist, margin, direction_mat):
+    """
+  Draw num candidate positions for an object of the given radius and return the
+  first valid one, or None if none of them are valid.
+  """
+    candidates = rng.uniform(bounds[0], bounds[1], size=(num, 2))
+    ok = placement_ok(candidates, radius, positions, radii, direction_mat, min_dist, margin)
+    if not ok.any():
+        return None
+    return candidates[np.argmax(ok)]
+
+
+def sample_layout(
+    radii,
+    directions,
+    rng,
+    min_dist=0.25,
+    margin=0.4,
+    max_retries=50,
+    bounds=(-3.0, 3.0),
+    max_restarts=100,
+):
+    """
+  Sample ground plane positions for objects with the given radii, in order.
+  directions is the "directions" dictionary of the canonical view, and rng is a
+  numpy RandomState (see make_rng).
+
+  Each object gets max_retries candidate positions, which are drawn and tested
+  all at once; the first valid one is used. If none are valid then the whole
+  layout is started again, at most max_restarts times, so that the caller can
+  try other sizes or give up if the objects do not fit.
+
+  Returns a tuple (positions, num_restarts) where positions is a list of (x, y)
+  tuples, or None if we ran out of restarts.
+  """
+    direction_mat = direction_matrix(directions)
+    all_radii = np.asarray(radii, dtype=np.float64)
+
+    num_restarts = 0
+    while True:
+        positions = np.zeros((0, 2))
+        for i, radius in enumerate(all_radii):
+            position = draw_position(
+                rng, max_retries, bounds, radius, positions, all_radii[:i], min_dist, margin, direction_mat
+            )
+            if position is None:
+                break
+            positions = np.vstack([positions, position])
+        if len(positions) == len(all_radii):
+            return [tuple(p) for p in positions.tolist()], num_restarts
+        num_restarts += 1
+        if num_restarts > max_restarts:
+            return None, num_restarts
+
+
+def sample_position(
+    index,
+    positions,
+    radii,
+    directions,
+    rng,
+    min_dist=0.25,
+    margin=0.4,
+    max_retries=50,
+    bounds=(-3.0, 3.0),
+):
+    """
+  Sample a new position for object index of an existing layout, keeping all
+  other objects where they are. Returns an (x, y) tuple, or None if none of the
+  max_retries candidates were valid.
+  """
+    others = [j for j in range(len(positions)) if j != index]
+    other_positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)[others]
+    other_radii = np.asarray(radii, dtype=np.float64)[others]
+    position = draw_position(
+        rng,
+        max_retries,
+        bounds,
+        radii[index],
+        other_positions,
+        other_radii,
+        min_dist,
+        margin,
+        direction_matrix(directions),
+    )
+    if position is None:
+        return None
+    return tuple(position.tolist())
+
+
+def validate_layout(positions, radii, directions, min_dist=0.25, margin=0.4):
+    """
+  Check that a layout satisfies the same constraints as sample_layout, placing
+  objects in order. Returns the index of the first object in a bad position, or
+  None if the layout is valid.
+  """
+    direction_mat = direction_matrix(directions)
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    radii = np.asarray(radii, dtype=np.float64)
+    for i in range(len(positions)):
+        if not placement_ok(positions[i], radii[i], positions[:i], radii[:i], direction_mat, min_dist, margin)[0]:
+            return i
+    return None
+
+
+def random_directions(rng):
+    """ Cardinal directions of a camera looking along the ground plane at a random angle """
+    theta = rng.uniform(0, 2 * math.pi)
+    behind = [math.cos(theta), math.sin(theta), 0.0]
+    left = [-math.sin(theta), math.cos(theta), 0.0]
+    return {
+        "behind": behind,
+        "front": [-x for x in behind],
+        "left": left,
+        "right": [-x for x in left],
+    }
+
+
+def check_layouts(
+    num_layouts=200, min_objects=3, max_objects=10, sizes=(0.35, 0.7), seed=0, bounds=(-3.0, 3.0), **kwargs
+):
+    """
+  Sample num_layouts layouts, each with a random number of objects of random
+  sizes and random camera directions, and check that they can be sampled,
+  that they pass validate_layout, that every object is within bounds, and
+  that moving one object with sample_position keeps the layout valid. Other
+  keyword arguments (min_dist, margin, max_retries, max_restarts) are passed
+  on to sample_layout.
+
+  Returns a tuple (number of bad layouts, total number of restarts).
+  """
+    validate_kwargs = {k: v for k, v in kwargs.items() if k in ("min_dist", "margin")}
+    position_kwargs = {k: v for k, v in kwargs.items() if k != "max_restarts"}
+    rng = np.random.RandomState(seed)
+    num_bad = 0
+    total_restarts = 0
+    for _ in range(num_layouts):
+        radii = [sizes[i] for i in rng.randint(len(sizes), size=rng.randint(min_objects, max_objects + 1))]
+        directions = random_directions(rng)
+        positions, num_restarts = sample_layout(radii, directions, rng, bounds=bounds, **kwargs)
+        total_restarts += num_restarts
+        if positions is None:
+            num_bad += 1
+            continue
+        in_bounds = all(bounds[0] <= x <= bounds[1] for p in positions for x in p)
+        if not in_bounds or validate_layout(positions, radii, directions, **validate_kwargs) is not None:
+            num_bad += 1
+            continue
+        index = rng.randint(len(positions))
+        position = sample_position(index, positions, radii, directions, rng, bounds=bounds, **position_kwargs)
+        if position is None:
+            continue
+        # The moved object must keep its distance from all other objects,
+        # which holds if the layout is valid with it placed last
+        order = [j for j in range(len(positions)) if j != index] + [index]
+        moved = [positions[j] if j != index else position for j in order]
+        if validate_layout(moved, [radii[j] for j in order], directions, **validate_kwargs) is not None:
+            num_bad += 1
+    return num_bad, total_restarts
+
+
+if __name__ == "__main__":
+    # Check sampled layouts with plain Python, e.g. in CI:
+    # python placement.py --num_layouts 200
+    parser = argparse.ArgumentParser(description="Check that sampled layouts are valid")
+    parser.add_argument("--num_layouts", default=200, type=int, help="The number of layouts to sample")
+    parser.add_argument("--min_dist", default=0.25, type=float)
+    parser.add_argument("--margin", default=0.4, type=float)
+    parser.add_argument("--max_retries", default=50, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+    num_bad, total_restarts = check_layouts(
+        args.num_layouts, seed=args.seed, min_dist=args.min_dist, margin=args.margin, max_retries=args.max_retries
+    )
+    print("%d layouts, %d invalid, %d restarts" % (args.num_layouts, num_bad, total_restarts))
+    if num_bad > 0:
+        sys.exit(1)
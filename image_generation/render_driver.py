@@ -0,0 +1,424 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json, os, socket, sqlite3, subprocess, sys, tempfile, threading, time
+
+import scene_files
+import scene_specs
+
+"""
+Renders a range of scenes with many Blender workers at once. Run this with plain
+Python (not from Blender) from the image_generation directory like this:
+
+python render_driver.py --num_images 100000 --workers 16 -- [arguments to render_images.py]
+
+Scene indices are kept in a work queue in a SQLite file (--queue). Each worker
+repeatedly claims a batch of consecutive pending scenes from the queue and
+renders them by running
+
+blender --background --python render_images.py -- --start_idx S --num_images N [arguments]
+
+A scene only counts as done once its JSON file and all of the images it lists
+exist and are complete (see scene_files.py), so scenes that are already
+rendered are skipped and scenes whose worker failed or crashed are retried, up
+to --max_attempts times. Scenes whose spec was rejected by render_images.py
+(see scene_files.py) are finished as well and are not retried. With
+--scene_specs the spec file is indexed once, and each batch is given a spec file
+holding only its own specs. Several drivers may share the same queue file, for
+example one per machine with the output directories and the queue on a shared
+filesystem; note that SQLite locking may not be reliable on some network
+filesystems.
+
+When all scenes are done or rejected the JSON files of all scenes that are done
+are combined into --output_scene_file, in the same format as render_images.py
+writes.
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--blender",
+    default=os.environ.get("BLENDER", "blender"),
+    help="Blender executable used to run render_images.py; defaults to $BLENDER " + "or blender on the PATH",
+)
+parser.add_argument("--workers", default=1, type=int, help="The number of Blender processes to run at once")
+parser.add_argument(
+    "--batch_size",
+    default=10,
+    type=int,
+    help="The maximum number of consecutive scenes rendered by one Blender "
+    + "process. Larger batches spend less time starting Blender; consider "
+    + "also passing --reuse_base_scene to render_images.py.",
+)
+parser.add_argument(
+    "--queue", default="../output/render_queue.sqlite", help="SQLite file holding the state of every scene"
+)
+parser.add_argument(
+    "--max_attempts", default=3, type=int, help="The number of times to try rendering a scene before giving up on it"
+)
+parser.add_argument(
+    "--lease_timeout",
+    default=3600,
+    type=float,
+    help="Scenes claimed by a worker more than this many seconds ago that "
+    + "are still not done can be claimed again, for example after a driver "
+    + "was killed.",
+)
+parser.add_argument("--report_every", default=60, type=float, help="Print throughput every this many seconds")
+parser.add_argument("--log_dir", default="../output/render_logs", help="Directory for the output of each worker")
+parser.add_argument("--noaudio", action="store_true", help="Pass -noaudio to Blender")
+
+# These are passed on to render_images.py; the driver needs them to find the
+# outputs of each scene.
+parser.add_argument("--start_idx", default=0, type=int, help="The index of the first scene to render")
+parser.add_argument("--num_images", default=5, type=int, help="The number of scenes to render")
+parser.add_argument("--filename_prefix", default="CLEVR")
+parser.add_argument("--split", default="new")
+parser.add_argument("--output_image_dir", default="../output/images/")
+parser.add_argument("--output_scene_dir", default="../output/scenes/")
+parser.add_argument(
+    "--output_scene_file",
+    default="../output/CLEVR_scenes.json",
+    help="Path to write a single JSON file containing all scene information " + "once all scenes are done",
+)
+parser.add_argument("--version", default="1.data")
+parser.add_argument("--license", default="Creative Commons Attribution (CC-BY 4.data)")
+parser.add_argument("--date", default=time.strftime("%m/%d/%Y"))
+parser.add_argument(
+    "--scene_specs",
+    default=None,
+    help="Optional spec file from scene_specs.py. Each batch is passed a file "
+    + "with just its own specs, so pass this here rather than after --.",
+)
+
+PENDING, RUNNING, DONE, REJECTED, FAILED = "pending", "running", "done", "rejected", "failed"
+
+
+def scene_name(args, idx):
+    return "%s_%s_s%s" % (args.filename_prefix, args.split, str(idx).zfill(6))
+
+
+def scene_path(args, idx):
+    return os.path.join(args.output_scene_dir, scene_name(args, idx) + ".json")
+
+
+def scene_status(args, idx):
+    """ DONE or REJECTED if the scene is finished, otherwise None """
+    path = scene_path(args, idx)
+    if scene_files.scene_complete(path, args.output_image_dir):
+        return DONE
+    if scene_files.scene_rejected(path):
+        return REJECTED
+    return None
+
+
+class WorkQueue(object):
+    """
+  The state of every scene in a SQLite table. Every thread needs its own
+  WorkQueue since SQLite connections cannot be shared between threads.
+  """
+
+    def __init__(self, path, lease_timeout=3600):
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.lease_timeout = lease_timeout
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS scenes ("
+            "idx INTEGER PRIMARY KEY, status TEXT, attempts INTEGER, "
+            "worker TEXT, claimed REAL, finished REAL)"
+        )
+
+    def add(self, indices):
+        with self.transaction():
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO scenes VALUES (?, ?, 0, NULL, NULL, NULL)", [(idx, PENDING) for idx in indices]
+            )
+
+    def transaction(self):
+        return Transaction(self.conn)
+
+    def claim(self, worker, start_idx, end_idx, batch_size):
+        """
+    Claim up to batch_size consecutive scenes in [start_idx, end_idx) that are
+    pending or whose lease expired. Returns the list of claimed indices.
+    """
+        now = time.time()
+        claimable = "(status = ? OR (status = ? AND claimed < ?))"
+        params = (PENDING, RUNNING, now - self.lease_timeout)
+        with self.transaction():
+            row = self.conn.execute(
+                "SELECT MIN(idx) FROM scenes WHERE idx >= ? AND idx < ? AND " + claimable,
+                (start_idx, end_idx) + params,
+            ).fetchone()
+            if row[0] is None:
+                return []
+            indices = [row[0]]
+            rows = self.conn.execute(
+                "SELECT idx FROM scenes WHERE idx > ? AND idx < ? AND " + claimable + " ORDER BY idx",
+                (indices[0], min(indices[0] + batch_size, end_idx)) + params,
+            ).fetchall()
+            for (idx,) in rows:
+                if idx != indices[-1] + 1:
+                    break
+                indices.append(idx)
+            self.conn.executemany(
+                "UPDATE scenes SET status = ?, worker = ?, claimed = ? WHERE idx = ?",
+                [(RUNNING, worker, now, idx) for idx in indices],
+            )
+        return indices
+
+    def finish(self, idx, status, max_attempts):
+        """
+    Record the outcome of an attempt at rendering a scene, where status is
+    DONE or REJECTED if the scene is finished and None if the attempt failed.
+    """
+        with self.transaction():
+            if status is not None:
+                self.conn.execute(
+                    "UPDATE scenes SET status = ?, finished = ? WHERE idx = ?", (status, time.time(), idx)
+                )
+            else:
+                self.conn.execute(
+                    "UPDATE scenes SET attempts = attempts + 1, "
+                    "status = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END WHERE idx = ?",
+                    (max_attempts, FAILED, PENDING, idx),
+                )
+
+    def mark_finished(self, statuses):
+        """ Set the status of scenes from a dict of index to DONE or REJECTED """
+        with self.transaction():
+            self.conn.executemany(
+                "UPDATE scenes SET status = ?, finished = ? WHERE idx = ?",
+                [(status, time.time(), idx) for idx, status in statuses.items()],
+            )
+
+    def counts(self, start_idx, end_idx):
+        rows = self.conn.execute(
+            "SELECT status, COUNT(*) FROM scenes WHERE idx >= ? AND idx < ? GROUP BY status", (start_idx, end_idx)
+        ).fetchall()
+        counts = {PENDING: 0, RUNNING: 0, DONE: 0, REJECTED: 0, FAILED: 0}
+        counts.update(dict(rows))
+        return counts
+
+    def indices_with_status(self, status, start_idx, end_idx):
+        rows = self.conn.execute(
+            "SELECT idx FROM scenes WHERE status = ? AND idx >= ? AND idx < ? ORDER BY idx",
+            (status, start_idx, end_idx),
+        ).fetchall()
+        return [idx for (idx,) in rows]
+
+
+class Transaction(object):
+    """ BEGIN IMMEDIATE ... COMMIT, so that claims from several drivers never overlap """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+
+def render_command(args, render_args, start_idx, num_images, output_scene_file, spec_file=None):
+    cmd = [args.blender, "--background"]
+    if args.noaudio:
+        cmd.append("-noaudio")
+    cmd += ["--python", "render_images.py", "--"]
+    cmd += ["--start_idx", str(start_idx), "--num_images", str(num_images)]
+    cmd += ["--filename_prefix", args.filename_prefix, "--split", args.split]
+    cmd += ["--output_image_dir", args.output_image_dir, "--output_scene_dir", args.output_scene_dir]
+    cmd += ["--output_scene_file", output_scene_file, "--resume"]
+    cmd += ["--version", args.version, "--license", args.license, "--date", args.date]
+    if spec_file is not None:
+        cmd += ["--scene_specs", spec_file]
+    return cmd + render_args
+
+
+def run_worker(args, render_args, worker_id, end_idx, stats, lock, spec_offsets=None):
+    worker = "%s:%d:%d" % (socket.gethostname(), os.getpid(), worker_id)
+    queue = WorkQueue(args.queue, lease_timeout=args.lease_timeout)
+    log_path = os.path.join(args.log_dir, "worker_%s_%d.log" % (socket.gethostname(), worker_id))
+    while True:
+        indices = queue.claim(worker, args.start_idx, end_idx, args.batch_size)
+        if not indices:
+            break
+        # Each batch writes its own combined scene file, which we do not need
+        f, tmp_scene_file = tempfile.mkstemp(suffix=".json")
+        os.close(f)
+        tmp_spec_file = None
+        if spec_offsets is not None:
+            f, tmp_spec_file = tempfile.mkstemp(suffix=".jsonl")
+            os.close(f)
+            scene_specs.write_spec_slice(args.scene_specs, tmp_spec_file, indices, spec_offsets)
+        cmd = render_command(args, render_args, indices[0], len(indices), tmp_scene_file, tmp_spec_file)
+        tic = time.time()
+        with open(log_path, "a") as log:
+            log.write("\n$ %s\n" % " ".join(cmd))
+            log.flush()
+            returncode = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+        os.remove(tmp_scene_file)
+        if tmp_spec_file is not None:
+            os.remove(tmp_spec_file)
+
+        num_done = num_rejected = 0
+        for idx in indices:
+            status = scene_status(args, idx)
+            queue.finish(idx, status, args.max_attempts)
+            num_done += int(status == DONE)
+            num_rejected += int(status == REJECTED)
+        with lock:
+            stats["done"] += num_done
+            stats["rejected"] += num_rejected
+            stats["failed_attempts"] += len(indices) - num_done - num_rejected
+            stats["render_time"] += time.time() - tic
+        if num_rejected > 0:
+            print(
+                "worker %d: %d of scenes %d-%d rejected; see %s"
+                % (worker_id, num_rejected, indices[0], indices[-1], log_path)
+            )
+        if num_done + num_rejected < len(indices):
+            print(
+                "worker %d: %d of scenes %d-%d not done (exit code %d); see %s"
+                % (worker_id, len(indices) - num_done - num_rejected, indices[0], indices[-1], returncode, log_path)
+            )
+
+
+def print_report(queue, args, end_idx, stats, tic):
+    counts = queue.counts(args.start_idx, end_idx)
+    elapsed = time.time() - tic
+    rate = stats["done"] / elapsed if elapsed > 0 else 0.0
+    remaining = counts[PENDING] + counts[RUNNING]
+    eta = "%.1f h" % (remaining / rate / 3600.0) if rate > 0 else "unknown"
+    print(
+        "[%.0f s] done %d / %d (%d this run, %.2f scenes/min), %d running, %d rejected, %d failed, ETA %s"
+        % (
+            elapsed,
+            counts[DONE],
+            end_idx - args.start_idx,
+            stats["done"],
+            60 * rate,
+            counts[RUNNING],
+            counts[REJECTED],
+            counts[FAILED],
+            eta,
+        )
+    )
+
+
+def combine_scenes(args, end_idx):
+    """
+  Write all scenes to --output_scene_file without loading them all at once,
+  leaving out rejected scenes. Returns the number of scenes written.
+  """
+    info = {"date": args.date, "version": args.version, "split": args.split, "license": args.license}
+    tmp_path = args.output_scene_file + ".tmp"
+    num_scenes = 0
+    with open(tmp_path, "w") as out:
+        out.write('{"info": %s, "scenes": [' % json.dumps(info))
+        for idx in range(args.start_idx, end_idx):
+            path = scene_path(args, idx)
+            if not os.path.isfile(path) and scene_files.scene_rejected(path):
+                continue
+            with open(path, "r") as f:
+                scene = json.load(f)
+            if num_scenes > 0:
+                out.write(", ")
+            out.write(json.dumps(scene))
+            num_scenes += 1
+        out.write("]}")
+    os.replace(tmp_path, args.output_scene_file)
+    return num_scenes
+
+
+def main(args, render_args):
+    for d in [args.output_image_dir, args.output_scene_dir, args.log_dir, os.path.dirname(args.queue)]:
+        if d and not os.path.isdir(d):
+            os.makedirs(d)
+
+    end_idx = args.start_idx + args.num_images
+    queue = WorkQueue(args.queue, lease_timeout=args.lease_timeout)
+    queue.add(range(args.start_idx, end_idx))
+
+    # Scenes rendered or rejected by earlier runs (or by hand) do not need to
+    # be rendered again
+    finished = set(queue.indices_with_status(DONE, args.start_idx, end_idx))
+    finished.update(queue.indices_with_status(REJECTED, args.start_idx, end_idx))
+    statuses = {}
+    for idx in range(args.start_idx, end_idx):
+        if idx not in finished:
+            status = scene_status(args, idx)
+            if status is not None:
+                statuses[idx] = status
+    queue.mark_finished(statuses)
+    counts = queue.counts(args.start_idx, end_idx)
+    print("%d scenes to render, %d already done, %d rejected" % (args.num_images, counts[DONE], counts[REJECTED]))
+
+    spec_offsets = None
+    if args.scene_specs is not None:
+        spec_offsets = scene_specs.index_specs(args.scene_specs)
+
+    stats = {"done": 0, "rejected": 0, "failed_attempts": 0, "render_time": 0.0}
+    lock = threading.Lock()
+    tic = time.time()
+    threads = []
+    for worker_id in range(args.workers):
+        t = threading.Thread(
+            target=run_worker, args=(args, render_args, worker_id, end_idx, stats, lock, spec_offsets)
+        )
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    last_report = time.time()
+    while any(t.is_alive() for t in threads):
+        time.sleep(1)
+        if time.time() - last_report >= args.report_every:
+            print_report(queue, args, end_idx, stats, tic)
+            last_report = time.time()
+
+    print_report(queue, args, end_idx, stats, tic)
+    elapsed = time.time() - tic
+    print(
+        "Rendered %d scenes in %.0f s with %d workers (%.2f scenes/min, %.1f worker-seconds per scene), "
+        "%d rejected, %d failed attempts"
+        % (
+            stats["done"],
+            elapsed,
+            args.workers,
+            60.0 * stats["done"] / max(elapsed, 1e-6),
+            stats["render_time"] / max(stats["done"], 1),
+            stats["rejected"],
+            stats["failed_attempts"],
+        )
+    )
+
+    counts = queue.counts(args.start_idx, end_idx)
+    num_finished = counts[DONE] + counts[REJECTED]
+    if num_finished == args.num_images:
+        print("All scenes done; writing %s" % args.output_scene_file)
+        num_scenes = combine_scenes(args, end_idx)
+        if counts[REJECTED] > 0:
+            print("Left out %d scenes whose spec was rejected; wrote %d scenes" % (counts[REJECTED], num_scenes))
+    else:
+        failed = queue.indices_with_status(FAILED, args.start_idx, end_idx)
+        print(
+            "%d scenes are not done; %d failed %d times: %s"
+            % (args.num_images - num_finished, len(failed), args.max_attempts, failed[:20])
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    render_args = []
+    if "--" in argv:
+        idx = argv.index("--")
+        argv, render_args = argv[:idx], argv[idx + 1 :]
+    if any(arg.split("=")[0] == "--scene_specs" for arg in render_args):
+        parser.error("pass --scene_specs to render_driver.py before --, not to render_images.py")
+    main(parser.parse_args(argv), render_args)
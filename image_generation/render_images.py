@@ -6,10 +6,9 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 from __future__ import print_function
-import math, sys, argparse, json, os, tempfile, string
+import math, sys, argparse, json, os, tempfile, time
 from datetime import datetime as dt
-from collections import Counter
-from random import uniform, randint, choice, random
+from random import randint, choice
 import builtins as __builtin__
 import numpy as np
 
@@ -36,6 +35,10 @@ except ImportError as e:
 if INSIDE_BLENDER:
     try:
         import utils
+        import placement
+        import scene_files
+        import scene_specs
+        import metrics
     except ImportError as e:
         print("\nERROR")
         print("Running render_images.py from Blender and cannot import utils.py.")
@@ -77,6 +80,15 @@ parser.add_argument(
     + "allowed color names for that shape. This allows rendering images "
     + "for CLEVR-CoGenT.",
 )
+parser.add_argument(
+    "--scene_specs",
+    default=None,
+    help="Optional path to a file of scene specs written by scene_specs.py. "
+    + "If given, the cameras, lights and objects of each scene are taken "
+    + "from its spec instead of being chosen at random, and scenes whose "
+    + "spec turns out not to be valid in Blender (e.g. because an object "
+    + "is not visible enough) are rejected rather than re-rolled.",
+)
 
 # Settings for objects
 parser.add_argument("--min_objects", default=3, type=int, help="The minimum number of objects to place in each scene")
@@ -189,6 +201,21 @@ parser.add_argument(
     default="../output/CLEVR_scenes.json",
     help="Path to write a single JSON file containing all scene information",
 )
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Skip scenes that were already rendered completely, i.e. whose JSON "
+    + "file and all of whose images exist in the output directories. Use "
+    + "this to restart a job that was interrupted without rendering the "
+    + "finished scenes again.",
+)
+parser.add_argument(
+    "--metrics_file",
+    default=None,
+    help="If given, append a JSON line with the time taken by each stage of "
+    + "rendering and counters such as retries for every scene to this file. "
+    + "Use summarize_metrics.py for a report over this file.",
+)
 parser.add_argument(
     "--output_blend_dir",
     default="output/blendfiles",
@@ -259,6 +286,13 @@ parser.add_argument(
     help="The number of samples to use when rendering. Larger values will "
     + "result in nicer images but will cause rendering to take longer.",
 )
+parser.add_argument(
+    "--denoise",
+    action="store_true",
+    help="Denoise the rendered images, so that far fewer samples give a "
+    + "clean image. This needs Blender 2.79 or later and is ignored with a "
+    + "warning otherwise.",
+)
 parser.add_argument(
     "--render_min_bounces", default=8, type=int, help="The minimum number of bounces to use for rendering."
 )
@@ -274,10 +308,40 @@ parser.add_argument(
     + "rendering may achieve better performance using smaller tile sizes "
     + "while larger tile sizes may be optimal for GPU-based rendering.",
 )
+parser.add_argument(
+    "--max_render_attempts",
+    default=5,
+    type=int,
+    help="The number of times to try rendering each view of a scene before "
+    + "giving up on the scene. Views are retried on their own, so views that "
+    + "were already rendered are not rendered again. The other scenes are "
+    + "still rendered, and the scenes that were given up on are reported at "
+    + "the end and rendered again with --resume. Must be at least 1.",
+)
+parser.add_argument(
+    "--persistent_data",
+    action="store_true",
+    help="Keep the Cycles render data (including the BVH) between the "
+    + "renders of the different views of a scene. Only the camera changes "
+    + "between these renders, so the geometry does not need to be synced "
+    + "and the BVH does not need to be built again for each view.",
+)
+parser.add_argument(
+    "--reuse_base_scene",
+    action="store_true",
+    help="Load --base_scene_blendfile and the materials only once and reuse "
+    + "them for all images, removing the objects added for each image "
+    + "before the next one, instead of reopening the blendfile for "
+    + "every image. This saves a lot of time when rendering small images "
+    + "with few samples.",
+)
 
 
 def main(args):
 
+    if args.max_render_attempts < 1:
+        raise ValueError("--max_render_attempts must be at least 1, got %d" % args.max_render_attempts)
+
     if not os.path.isdir(args.output_image_dir):
         os.makedirs(args.output_image_dir)
     if not os.path.isdir(args.output_scene_dir):
@@ -285,7 +349,24 @@ def main(args):
     if args.save_blendfiles == 1 and not os.path.isdir(args.output_blend_dir):
         os.makedirs(args.output_blend_dir)
 
+    if args.metrics_file is not None:
+        metrics.open_file(args.metrics_file)
+
+    base_scene = None
+    if args.reuse_base_scene:
+        base_scene = BaseScene(args)
+
+    specs = None
+    if args.scene_specs is not None:
+        mismatches = scene_specs.spec_info_mismatches(scene_specs.read_spec_info(args.scene_specs), args)
+        if mismatches:
+            raise ValueError("%s was made with other arguments: %s" % (args.scene_specs, "; ".join(mismatches)))
+        specs = scene_specs.read_specs(args.scene_specs, args.start_idx, args.num_images)
+
     all_scene_paths = []
+    rejected_scene_paths = set()
+    failed_scene_paths = []
+    num_skipped = 0
     for i in range(args.num_images):
         prefix = "%s_%s_" % (args.filename_prefix, args.split)
 
@@ -298,19 +379,67 @@ def main(args):
         blend_path = os.path.join(args.output_blend_dir, blend_path)
 
         all_scene_paths.append(scene_path)
-        num_objects = randint(args.min_objects, args.max_objects)
-        render_scene(
-            args,
-            num_objects=num_objects,
-            output_index=(i + args.start_idx),
-            output_split=args.split,
-            output_image=img_path,
-            output_scene=scene_path,
-            output_blendfile=blend_path,
-        )
+        if args.resume and scene_files.scene_complete(scene_path, args.output_image_dir):
+            num_skipped += 1
+            continue
+        if args.resume and scene_files.scene_rejected(scene_path):
+            num_skipped += 1
+            rejected_scene_paths.add(scene_path)
+            continue
+        spec = None
+        if specs is None:
+            num_objects = randint(args.min_objects, args.max_objects)
+        elif i + args.start_idx not in specs:
+            raise ValueError("%s has no spec for scene %d" % (args.scene_specs, i + args.start_idx))
+        else:
+            spec = specs[i + args.start_idx]
+            num_objects = len(spec["objects"])
+        metrics.begin_scene(scene=i + args.start_idx, num_objects=num_objects)
+        try:
+            render_scene(
+                args,
+                num_objects=num_objects,
+                output_index=(i + args.start_idx),
+                output_split=args.split,
+                output_image=img_path,
+                output_scene=scene_path,
+                output_blendfile=blend_path,
+                base_scene=base_scene,
+                spec=spec,
+            )
+        except SceneRejected as e:
+            print("Rejected the spec of scene %d: %s" % (i + args.start_idx, e))
+            # The marker makes --resume and render_driver.py treat the scene
+            # as finished rather than trying it again
+            scene_files.write_rejected(scene_path, str(e))
+            rejected_scene_paths.add(scene_path)
+            metrics.end_scene(rejected=True)
+            continue
+        except RenderFailed as e:
+            # Give up on this scene but go on with the others; it has no JSON
+            # file, so it is reported below and rendered again by --resume
+            print("Giving up on scene %d: %s" % (i + args.start_idx, e))
+            failed_scene_paths.append(scene_path)
+            metrics.end_scene(failed=True)
+            continue
+        scene_files.clear_rejected(scene_path)
+        metrics.end_scene()
+    if args.resume:
+        print("Skipped %d scenes that were already rendered" % num_skipped)
+    if failed_scene_paths:
+        print("Gave up on %d scenes that could not be rendered" % len(failed_scene_paths))
+    if rejected_scene_paths:
+        # Rendering the same spec again would give the same result, so these
+        # are left out of the combined file
+        print("%d scene specs were rejected; these scenes are not rendered" % len(rejected_scene_paths))
+        all_scene_paths = [path for path in all_scene_paths if path not in rejected_scene_paths]
 
     # After rendering all images, combine the JSON files for each scene into a
-    # single JSON file.
+    # single JSON file. Make sure that we do not pick up a scene that another
+    # job is still writing.
+    incomplete = [path for path in all_scene_paths if not scene_files.scene_complete(path, args.output_image_dir)]
+    if incomplete:
+        raise RuntimeError("%d scenes were not rendered completely, e.g. %s" % (len(incomplete), incomplete[0]))
     all_scenes = []
     for scene_path in all_scene_paths:
         with open(scene_path, "r") as f:
@@ -319,8 +448,164 @@ def main(args):
         "info": {"date": args.date, "version": args.version, "split": args.split, "license": args.license,},
         "scenes": all_scenes,
     }
-    with open(args.output_scene_file, "w") as f:
-        json.dump(output, f)
+    scene_files.write_json_atomic(output, args.output_scene_file)
+
+
+def add_camera(name, location, target):
+    """ Add a camera at location that points at the object target """
+    cam_obj = bpy.data.objects.new(name, bpy.data.cameras.new(name))
+    cam_obj.location = location
+    m = cam_obj.constraints.new("TRACK_TO")
+    m.target = target
+    m.track_axis = "TRACK_NEGATIVE_Z"
+    m.up_axis = "UP_Y"
+    bpy.context.scene.objects.link(cam_obj)
+    return cam_obj
+
+
+def spec_cameras(spec):
+    """
+  Set up the cameras of a scene spec: cameras of the base scene are moved to
+  their location in the spec, and the others are added, pointing at the same
+  target as the first camera of the base scene. Returns the cameras in the
+  order of the spec.
+  """
+    cams = []
+    for cam_spec in spec["cameras"]:
+        if cam_spec["name"] in bpy.data.objects:
+            cam = bpy.data.objects[cam_spec["name"]]
+            cam.location = cam_spec["location"]
+        else:
+            base_cam = [obj for obj in bpy.data.objects if obj.type == "CAMERA"][0]
+            cam = add_camera(cam_spec["name"], cam_spec["location"], base_cam.constraints[0].target)
+        cams.append(cam)
+    return cams
+
+
+class RenderFailed(Exception):
+    """
+  Raised when a scene could not be rendered: a view failed --max_render_attempts
+  times, or its objects could not be placed
+  """
+
+    pass
+
+
+def render_views(views, max_attempts):
+    """
+  Render a list of (camera, path) views, where camera is None to keep the
+  current scene camera. Each view is retried on its own up to max_attempts
+  times, so a failed render does not cause the views that are already done to
+  be rendered again.
+
+  Returns a dictionary for each view with the number of attempts it took and
+  the time in seconds taken by the successful attempt. Raises RenderFailed if
+  a view could not be rendered in max_attempts attempts, which must be at
+  least 1.
+  """
+    if max_attempts < 1:
+        raise ValueError("max_attempts must be at least 1, got %d" % max_attempts)
+    view_stats = []
+    for cam, path in views:
+        if cam is not None:
+            bpy.context.scene.camera = cam
+        for attempt in range(1, max_attempts + 1):
+            tic = time.time()
+            try:
+                render_still(path)
+                break
+            except Exception as e:
+                print("Rendering %s failed (attempt %d of %d): %s" % (path, attempt, max_attempts, e))
+                metrics.count("render_failures")
+                if attempt == max_attempts:
+                    raise RenderFailed("could not render %s in %d attempts: %s" % (path, max_attempts, e))
+        view_stats.append({"attempts": attempt, "time": time.time() - tic})
+    return view_stats
+
+
+def set_render_quality(args):
+    """
+  Set the number of samples and denoising for Cycles. Denoising is only
+  available from Blender 2.79; if it is requested but not available we print a
+  warning and render without it. Cycles in the 2.7x versions of Blender that
+  this script supports has no adaptive sampling, so every pixel takes the full
+  number of samples.
+
+  Returns a dictionary of the settings actually used, which is stored with
+  each view.
+  """
+    cycles = bpy.context.scene.cycles
+    cycles.samples = args.render_num_samples
+    quality = {"samples": args.render_num_samples, "denoise": False}
+
+    layer = bpy.context.scene.render.layers.active
+    if hasattr(layer.cycles, "use_denoising"):
+        layer.cycles.use_denoising = args.denoise
+        quality["denoise"] = args.denoise
+    elif args.denoise:
+        print("WARNING: denoising needs Blender 2.79 or later; rendering without it")
+    return quality
+
+
+def render_still(path):
+    """
+  Render the current camera to the image at path. Blender writes the image
+  under a temporary name first, which is renamed once it is complete.
+  """
+    render_args = bpy.context.scene.render
+    old_filepath = render_args.filepath
+    root, ext = os.path.splitext(path)
+    tmp_path = root + ".tmp" + ext
+    render_args.filepath = tmp_path
+    try:
+        bpy.ops.render.render(write_still=True)
+    finally:
+        render_args.filepath = old_filepath
+    os.replace(tmp_path, path)
+
+
+class BaseScene(object):
+    """
+  The base blendfile and materials, loaded once and shared by all images when
+  rendering with --reuse_base_scene. Shapes are also kept in memory once loaded
+  (see utils.add_object), since they survive until another main file is opened.
+
+  reset() brings the scene back to the state it was in just after loading,
+  by removing every object added for the previous image (objects, text,
+  extra cameras), undoing the camera and light jitter, and removing the
+  datablocks that were left without users.
+  """
+
+    DATABLOCK_TYPES = ["meshes", "curves", "materials", "cameras", "fonts", "images"]
+
+    def __init__(self, args):
+        bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
+        utils.load_materials(args.material_dir)
+        scene = bpy.context.scene
+        self.object_locations = {obj.name: tuple(obj.location) for obj in scene.objects}
+        self.camera_name = scene.camera.name if scene.camera is not None else None
+        self.datablock_names = {}
+        for attr in self.DATABLOCK_TYPES:
+            self.datablock_names[attr] = set(block.name for block in getattr(bpy.data, attr))
+
+    def reset(self):
+        scene = bpy.context.scene
+        for obj in list(scene.objects):
+            if obj.name not in self.object_locations:
+                bpy.data.objects.remove(obj, do_unlink=True)
+        for name, location in self.object_locations.items():
+            bpy.data.objects[name].location = location
+        if self.camera_name is not None:
+            scene.camera = bpy.data.objects[self.camera_name]
+
+        # Meshes and curves go first since they hold on to materials and fonts
+        for attr in self.DATABLOCK_TYPES:
+            collection = getattr(bpy.data, attr)
+            for block in list(collection):
+                if block.users == 0 and block.name not in self.datablock_names[attr]:
+                    collection.remove(block)
+                    metrics.count("datablocks_removed")
+        scene.update()
 
 
 def render_scene(
@@ -331,13 +616,23 @@ def render_scene(
     output_image="render.png",
     output_scene="render_json",
     output_blendfile=None,
+    base_scene=None,
+    spec=None,
 ):
 
-    # Load the main blendfile
-    bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
+    if base_scene is None:
+        # Load the main blendfile
+        with metrics.timer("open_mainfile"):
+            bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
 
-    # Load materials
-    utils.load_materials(args.material_dir)
+        # Load materials
+        with metrics.timer("load_materials"):
+            utils.load_materials(args.material_dir)
+    else:
+        # The base scene and materials are already loaded; just clear out the
+        # previous image
+        with metrics.timer("reset_base_scene"):
+            base_scene.reset()
 
     # Set render arguments so we can get pixel coordinates later.
     # We use functionality specific to the CYCLES renderer so BLENDER_RENDER
@@ -350,6 +645,10 @@ def render_scene(
     render_args.resolution_percentage = 100
     render_args.tile_x = args.render_tile_size
     render_args.tile_y = args.render_tile_size
+    # Images are always written as PNG; scene_files.png_complete checks this
+    # for --resume and the final scene file
+    render_args.image_settings.file_format = "PNG"
+    render_args.image_settings.color_mode = "RGBA"
 
     bpy.context.scene.render.engine = "CYCLES"
 
@@ -365,7 +664,7 @@ def render_scene(
     # Some CYCLES-specific stuff
     bpy.data.worlds["World"].cycles.sample_as_light = True
     bpy.context.scene.cycles.blur_glossy = 2.0
-    bpy.context.scene.cycles.samples = args.render_num_samples
+    render_quality = set_render_quality(args)
     bpy.context.scene.cycles.transparent_min_bounces = args.render_min_bounces
     bpy.context.scene.cycles.transparent_max_bounces = args.render_max_bounces
     if args.use_gpu == 1:
@@ -373,55 +672,20 @@ def render_scene(
 
     # This will give ground-truth information about the scene and its objects
     view_struct = {}
-    if args.multi_view:
+    if spec is not None:
+        cam_names = [cam_spec["name"] for cam_spec in spec["cameras"]]
+        if not args.multi_view and cam_names != ["cc"]:
+            raise ValueError(
+                "the spec of scene %d has cameras %s, which need --multi_view" % (output_index, ", ".join(cam_names))
+            )
+        cams = spec_cameras(spec)
+    elif args.multi_view:
         cams = [obj for obj in bpy.data.objects if obj.type == "CAMERA"]
-        poses = [cam.location for cam in cams]
 
         if args.random_views:
-
-            base_angle = math.atan2(cams[0].location[1], cams[0].location[0])
-
-            num_samples = 20
-            # generate the points on a circle of radius r around the scene
-            azimuths = [
-                uniform(base_angle + args.random_view_azimuth_min, base_angle + args.random_view_azimuth_max)
-                for _ in range(num_samples)
-            ]
-            x = [args.random_view_radius * math.cos(a) for a in azimuths]
-            y = [args.random_view_radius * math.sin(a) for a in azimuths]
-            elevations = [
-                uniform(args.random_view_elevation_min, args.random_view_elevation_max) for _ in range(num_samples)
-            ]
-            z = [math.tan(e) * args.random_view_radius for e in elevations]
-
-            for z_i in z:
-                if z_i < 2:
-                    print(
-                        "\n\n=== WARNING: ELEVATION VERY LOW ({}). "
-                        "PROLLY HARD TO FIND WORKING CONFIGURATION WHERE NOTHING IS OBSCURED.\n"
-                        "Increase args.random_view_elevation_min\n\n".format(z_i)
-                    )
-
-            scn = bpy.context.scene
             origin_empty = cams[0].constraints[0].target
-            cams = [cams[0]]
-            for i in range(num_samples):
-
-                # create the first camera
-                cam = bpy.data.cameras.new("cam" + str(i))
-
-                # create the first camera object
-                cam_obj = bpy.data.objects.new("cam" + str(i), cam)
-                cam_obj.location = (x[i], y[i], z[i])
-
-                print("cam_obj loc", cam_obj.location)
-
-                m = cam_obj.constraints.new("TRACK_TO")
-                m.target = origin_empty
-                m.track_axis = "TRACK_NEGATIVE_Z"
-                m.up_axis = "UP_Y"
-                scn.objects.link(cam_obj)
-                cams.append(cam_obj)
+            locations = scene_specs.sample_random_views(cams[0].location, args)
+            cams = [cams[0]] + [add_camera("cam%d" % i, loc, origin_empty) for i, loc in enumerate(locations)]
     else:
         cams = [obj for obj in bpy.data.objects if obj.name == "cc"]
     if args.multi_view:
@@ -457,53 +721,52 @@ def render_scene(
     bpy.ops.mesh.primitive_plane_add(radius=5)
     plane = bpy.context.object
 
-    def rand(L):
-        return 2.0 * L * (random() - 0.5)
-
-    # Add random jitter to camera position
-    if args.camera_jitter > 0:
+    # Add random jitter to camera position; camera locations in a spec already
+    # include it
+    if spec is None and args.camera_jitter > 0:
         for cam in cams:
             for i in range(3):
-                cam.location[i] += rand(args.camera_jitter)
+                cam.location[i] += scene_specs.jitter(args.camera_jitter)
             # cam.location[2] = 2
 
-    # Figure out the left, up, and behind directions along the plane and record
-    # them in the scene structure
-    camera = bpy.data.objects["cc"]
-    # Quaternion((0.781359076499939, 0.46651220321655273, 0.2125076949596405, 0.3559281527996063))
-    plane_normal = plane.data.vertices[0].normal
-    cam_behind = camera.matrix_world.to_quaternion() * Vector((0, 0, -1))
-    cam_left = camera.matrix_world.to_quaternion() * Vector((-1, 0, 0))
-    cam_up = camera.matrix_world.to_quaternion() * Vector((0, 1, 0))
-    plane_behind = (cam_behind - cam_behind.project(plane_normal)).normalized()
-    plane_left = (cam_left - cam_left.project(plane_normal)).normalized()
-    plane_up = cam_up.project(plane_normal).normalized()
+    # Figure out the left, up, and behind directions along the plane for every
+    # camera and record them in the scene structure. The cameras may have just
+    # been jittered, so bring their world matrices up to date first.
+    with metrics.timer("directions"):
+        bpy.context.scene.update()
+        plane_normal = tuple(plane.data.vertices[0].normal)
+        quaternions = [tuple(cam.matrix_world.to_quaternion()) for cam in cams]
+        for cam, directions in zip(cams, compute_view_directions(quaternions, plane_normal)):
+            view_struct[cam.name]["directions"] = directions
 
     # Delete the plane; we only used it for normals anyway. The base scene file
     # contains the actual ground plane.
     utils.delete_object(plane)
 
-    # Save all six axis-aligned directions in the scene struct
-    view_struct["cc"]["directions"]["behind"] = tuple(plane_behind)
-    view_struct["cc"]["directions"]["front"] = tuple(-plane_behind)
-    view_struct["cc"]["directions"]["left"] = tuple(plane_left)
-    view_struct["cc"]["directions"]["right"] = tuple(-plane_left)
-    view_struct["cc"]["directions"]["above"] = tuple(plane_up)
-    view_struct["cc"]["directions"]["below"] = tuple(-plane_up)
-
-    # Add random jitter to lamp positions
-    if args.key_light_jitter > 0:
-        for i in range(3):
-            bpy.data.objects["Lamp_Key"].location[i] += rand(args.key_light_jitter)
-    if args.back_light_jitter > 0:
-        for i in range(3):
-            bpy.data.objects["Lamp_Back"].location[i] += rand(args.back_light_jitter)
-    if args.fill_light_jitter > 0:
+    # Add random jitter to lamp positions, or the offsets from the spec
+    if spec is not None:
+        light_offsets = spec["lights"]
+    else:
+        light_offsets = {}
+        for name, arg in scene_specs.LIGHT_JITTER_ARGS:
+            if getattr(args, arg) > 0:
+                light_offsets[name] = [scene_specs.jitter(getattr(args, arg)) for _ in range(3)]
+    for name, offset in light_offsets.items():
         for i in range(3):
-            bpy.data.objects["Lamp_Fill"].location[i] += rand(args.fill_light_jitter)
+            bpy.data.objects[name].location[i] += offset[i]
 
-    # Now make some random objects
-    texts, blender_texts, objects, blender_objects = add_random_objects(view_struct, num_objects, args, cams)
+    # Now make some random objects, or the objects of the spec
+    if spec is not None:
+        with metrics.timer("add_spec_objects"):
+            texts, blender_texts, objects, blender_objects, retries = add_spec_objects(view_struct, spec, args, cams)
+    else:
+        with metrics.timer("add_random_objects"):
+            texts, blender_texts, objects, blender_objects, retries = add_random_objects(
+                view_struct, num_objects, args, cams
+            )
+    print("placement retries for scene %d: %s" % (output_index, retries))
+    for kind, num_retries in retries.items():
+        metrics.count("retries_" + kind, num_retries)
 
     if args.shadow_less:
         for obj in blender_objects:
@@ -514,236 +777,517 @@ def render_scene(
     for cam in cams:
         view_struct[cam.name]["objects"] = objects[cam.name]
         view_struct[cam.name]["texts"] = texts
-        view_struct[cam.name]["relationships"] = compute_all_relationships(view_struct)
+        view_struct[cam.name]["retries"] = retries
+    # Each view gets relationships relative to its own camera; these are
+    # computed for all cameras at once.
+    with metrics.timer("relationships"):
+        all_relationships = compute_all_view_relationships(view_struct, [cam.name for cam in cams])
+    for cam in cams:
+        view_struct[cam.name]["relationships"] = all_relationships[cam.name]
+    if args.multi_view:
+        path_root = ".".join(output_image.split(".")[:-1])
+        views = [(cam, path_root + "_" + cam.name + ".png") for cam in cams]
+    else:
+        # Render from the scene camera, as set in the base scene
+        views = [(None, output_image)]
+    render_args.use_persistent_data = args.persistent_data
+    try:
+        with metrics.timer("render"):
+            view_stats = render_views(views, args.max_render_attempts)
+    finally:
+        # Free the render data before the next scene is built
+        render_args.use_persistent_data = False
+    for cam, stats in zip(cams, view_stats):
+        stats.update(render_quality)
+        view_struct[cam.name]["render"] = stats
+
+    if args.save_blendfiles:
+        with metrics.timer("save_blendfile"):
+            bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
+
+    # The scene file is written last, since its presence marks the scene as
+    # done for --resume
+    with metrics.timer("write_scene"):
+        scene_files.write_json_atomic(view_struct, output_scene, indent=2)
+
+
+def add_random_objects(view_struct, num_objects, args, cams):
+    """
+  Add random objects to the current blender scene
+
+  Failures are retried in a loop rather than by starting over recursively; see
+  place_random_objects for which failures are retried without starting over.
+  If the objects still cannot be placed after starting over --max_retries
+  times, RenderFailed is raised so that the scene is given up on.
+
+  Returns a tuple (texts, blender_texts, objects, blender_objects, retries)
+  where retries counts the retries of each kind that were needed.
+  """
+    properties = scene_specs.load_properties(args)
+    retries = {"layout": 0, "object": 0, "visibility": 0, "restart": 0}
     while True:
-        try:
-            path_dir = bpy.context.scene.render.filepath  # save for restore
-            if args.multi_view:
-                for cam in cams:
-                    bpy.context.scene.camera = cam
-                    bpy.context.scene.render.filepath = ".".join(path_dir.split(".")[:-1]) + "_" + cam.name + ".png"
-                    bpy.ops.render.render(write_still=True)
-                    bpy.context.scene.render.filepath = path_dir
-            else:
-                bpy.ops.render.render(write_still=True)
+        placed = place_random_objects(view_struct, num_objects, args, cams, properties, retries)
+        if placed is not None:
             break
+        if retries["restart"] == args.max_retries:
+            raise RenderFailed(
+                "could not place %d objects after starting over %d times" % (num_objects, args.max_retries)
+            )
+        __builtin__.print("Could not place all objects; replacing objects")
+        retries["restart"] += 1
 
-        except Exception as e:
-            print(e)
+    records, visible_chars = placed
+    texts, blender_texts, objects, blender_objects = collect_records(records, args, cams, visible_chars)
+    return texts, blender_texts, objects, blender_objects, retries
 
-    with open(output_scene, "w") as f:
-        json.dump(view_struct, f, indent=2)
 
-    if args.save_blendfiles:
-        bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
+class SceneRejected(Exception):
+    """ Raised when the spec of a scene cannot be rendered as it is """
 
+    pass
 
-def add_random_objects(view_struct, num_objects, args, cams):
+
+def add_spec_objects(view_struct, spec, args, cams):
     """
-  Add random objects to the current blender scene
+  Add the objects of a scene spec (see scene_specs.py) to the current blender
+  scene. Nothing is re-rolled: if the layout is not valid for the actual
+  directions of the canonical camera, text cannot be added to an object, or
+  some objects are not visible enough, SceneRejected is raised. The objects
+  added so far are left in the scene, which is reset before the next one.
+
+  Returns a tuple (texts, blender_texts, objects, blender_objects, retries) as
+  add_random_objects does, with all retries zero.
   """
+    properties = scene_specs.load_properties(args)
+    retries = {"layout": 0, "object": 0, "visibility": 0, "restart": 0}
+    size_radii = dict(properties["size_mapping"])
+    radii = [size_radii[obj_spec["size"]] for obj_spec in spec["objects"]]
+    positions = [obj_spec["position"] for obj_spec in spec["objects"]]
+    with metrics.timer("validate_layout"):
+        bad = placement.validate_layout(
+            positions, radii, view_struct["cc"]["directions"], min_dist=args.min_dist, margin=args.margin
+        )
+    if bad is not None:
+        raise SceneRejected("object %d is too close to another object along the actual directions" % bad)
+
+    records = []
+    for i, obj_spec in enumerate(spec["objects"]):
+        record = add_spec_object(i, obj_spec, properties, args, cams)
+        if record is None:
+            metrics.count("text_failures")
+            raise SceneRejected("could not add text to object %d" % i)
+        records.append(record)
+
+    min_pixels = args.min_pixels_per_object if args.enforce_obj_visibility else None
+    min_char_pixels = args.min_char_pixels if args.text and args.all_chars_visible else None
+    visible_chars = {}
+    if min_pixels is not None or min_char_pixels is not None:
+        canonical_cams = [cam for cam in cams if cam.name == "cc"]
+        blender_objects = [record["blender_object"] for record in records]
+        all_chars = [c for record in records for c in record["chars"]]
+        with metrics.timer("visibility"):
+            all_visible, visible_objects, visible_chars = check_visibility(
+                blender_objects + all_chars, min_pixels, canonical_cams, min_char_pixels=min_char_pixels
+            )
+        if not all_visible:
+            metrics.count("visibility_failures")
+            hidden = [
+                i
+                for i, record in enumerate(records)
+                if not record_visible(record, visible_objects["cc"], visible_chars["cc"], min_pixels, min_char_pixels)
+            ]
+            raise SceneRejected("objects %s are not visible enough" % hidden)
+
+    texts, blender_texts, objects, blender_objects = collect_records(records, args, cams, visible_chars)
+    return texts, blender_texts, objects, blender_objects, retries
 
-    # Load the property file
-    with open(args.properties_json, "r") as f:
-        properties = json.load(f)
-        color_name_to_rgba = {}
-        for name, rgb in properties["colors"].items():
-            rgba = [float(c) / 255.0 for c in rgb] + [1.0]
-            color_name_to_rgba[name] = rgba
-        material_mapping = [(v, k) for k, v in properties["materials"].items()]
-        object_mapping = [(v, k) for k, v in properties["shapes"].items()]
-        size_mapping = list(properties["sizes"].items())
-
-    shape_color_combos = None
-    if args.shape_color_combos_json is not None:
-        with open(args.shape_color_combos_json, "r") as f:
-            shape_color_combos = list(json.load(f).items())
-
-    positions = []
-    objects = {cam.name: [] for cam in cams}
-    blender_objects = []
+
+def collect_records(records, args, cams, visible_chars=None):
+    """
+  Gather the records of all objects of a scene (see add_random_object), after
+  recording the number of visible pixels of every character in every view.
+  visible_chars holds the counts of the views that were already rendered with
+  the scene as it is (by the visibility check of the canonical view), as
+  returned by check_visibility; only the other views are rendered here.
+
+  Returns a tuple (texts, blender_texts, objects, blender_objects).
+  """
+    objects = {cam.name: [record["views"][cam.name] for record in records] for cam in cams}
+    blender_objects = [record["blender_object"] for record in records]
+    blender_texts = [text for record in records for text in record["blender_texts"]]
+    all_chars = [c for record in records for c in record["chars"]]
     texts = []
-    blender_texts = []
-    all_chars = []
-    for i in range(num_objects):
-        # Choose a random size
-        size_name, r = choice(size_mapping)
-
-        # Try to place the object, ensuring that we don't intersect any existing
-        # objects and that we are more than the desired margin away from all existing
-        # objects along all cardinal directions.
-        num_tries = 0
-        while True:
-            # If we try and fail to place an object too many times, then delete all
-            # the objects in the scene and start over.
-            num_tries += 1
-            if num_tries > args.max_retries:
-                for obj in blender_objects:
-                    utils.delete_object(obj)
-                for text in blender_texts:
-                    utils.delete_object(text)
-                return add_random_objects(view_struct, num_objects, args, cams)
-            x = uniform(-3, 3)
-            y = uniform(-3, 3)
-            # Check to make sure the new object is further than min_dist from all
-            # other objects, and further than margin along the four cardinal directions
-            dists_good = True
-            margins_good = True
-            for (xx, yy, rr) in positions:
-                dx, dy = x - xx, y - yy
-                dist = math.sqrt(dx * dx + dy * dy)
-                if dist - r - rr < args.min_dist:
-                    dists_good = False
-                    break
-                for direction_name in ["left", "right", "front", "behind"]:
-                    direction_vec = view_struct["cc"]["directions"][direction_name]
-                    assert direction_vec[2] == 0
-                    margin = dx * direction_vec[0] + dy * direction_vec[1]
-                    if 0 < margin < args.margin:
-                        __builtin__.print(margin, args.margin, direction_name)
-                        __builtin__.print("BROKEN MARGIN!")
-                        margins_good = False
-                        break
-                if not margins_good:
-                    break
-
-            if dists_good and margins_good:
-                break
 
-        # Choose random color and shape
-        if shape_color_combos is None:
-            obj_name, obj_name_out = choice(object_mapping)
-            color_name, rgba = choice(list(color_name_to_rgba.items()))
-        else:
-            obj_name_out, color_choices = choice(shape_color_combos)
-            color_name = choice(color_choices)
-            obj_name = [k for k, v in object_mapping if v == obj_name_out][0]
-            rgba = color_name_to_rgba[color_name]
+    # Record the number of visible pixels of every character in every view
+    if args.text:
+        visible_chars = dict(visible_chars or {})
+        with metrics.timer("char_visibility"):
+            _, _, other_visible_chars = check_visibility(
+                blender_objects + all_chars, None, [cam for cam in cams if cam.name not in visible_chars]
+            )
+        visible_chars.update(other_visible_chars)
+        for record in records:
+            for cam in cams:
+                for char_bbox in record["char_bboxes"][cam.name]:
+                    char_bbox["visible_pixels"] = visible_chars[cam.name].get(char_bbox["id"], 0)
+
+    return texts, blender_texts, objects, blender_objects
 
-        # For cube, adjust the size a bit
-        if obj_name == "Cube":
-            r /= math.sqrt(2)
 
-        # Choose random orientation for the object.
-        theta = 360.0 * random()
+def place_random_objects(view_struct, num_objects, args, cams, properties, retries):
+    """
+  Make one attempt at laying out and adding num_objects random objects.
+
+  If text cannot be added to an object then only that object is re-rolled, and
+  if some objects (or their characters) are not visible enough from the
+  canonical camera then only those objects are moved and re-rolled, keeping the
+  rest of the scene in place. If that still fails after --max_retries attempts
+  then everything added so far is removed and None is returned, as it is if no
+  layout could be sampled for the chosen sizes; otherwise this
+  returns a tuple (records, visible_chars) where records is a list of records
+  describing the objects (see add_random_object) and visible_chars holds the
+  character pixel counts of the final visibility check as returned by
+  check_visibility, which is empty if there was no check.
+  """
+    # Choose a random size for every object, then lay them all out on the ground
+    # plane before touching Blender, ensuring that objects don't intersect and
+    # are more than the desired margin away from each other along all cardinal
+    # directions. Cubes are laid out with their unadjusted size, which bounds
+    # their corners.
+    directions = view_struct["cc"]["directions"]
+    sizes = [choice(properties["size_mapping"]) for _ in range(num_objects)]
+    radii = [r for _, r in sizes]
+    rng = placement.make_rng()
+    with metrics.timer("sample_layout"):
+        positions, num_restarts = placement.sample_layout(
+            radii,
+            directions,
+            rng,
+            min_dist=args.min_dist,
+            margin=args.margin,
+            max_retries=args.max_retries,
+        )
+    retries["layout"] += num_restarts
+    if positions is None:
+        return None
+
+    records = []
+    for i in range(num_objects):
+        record = add_random_object(i, sizes[i], positions[i], properties, args, cams, retries)
+        if record is None:
+            remove_random_objects(records)
+            return None
+        records.append(record)
+
+    # Now that placement is final, check visibility from the canonical view; this
+    # renders a single image rather than one per view.
+    min_pixels = args.min_pixels_per_object if args.enforce_obj_visibility else None
+    min_char_pixels = args.min_char_pixels if args.text and args.all_chars_visible else None
+    if min_pixels is None and min_char_pixels is None:
+        return records, {}
+    canonical_cams = [cam for cam in cams if cam.name == "cc"]
+    num_rerolls = 0
+    while True:
+        blender_objects = [record["blender_object"] for record in records]
+        all_chars = [c for record in records for c in record["chars"]]
+        with metrics.timer("visibility"):
+            all_visible, visible_objects, visible_chars = check_visibility(
+                blender_objects + all_chars, min_pixels, canonical_cams, min_char_pixels=min_char_pixels
+            )
+        if all_visible:
+            return records, visible_chars
+        metrics.count("visibility_failures")
+        if num_rerolls == args.max_retries:
+            remove_random_objects(records)
+            return None
+        num_rerolls += 1
+
+        for i, record in enumerate(records):
+            if record_visible(record, visible_objects["cc"], visible_chars["cc"], min_pixels, min_char_pixels):
+                continue
+            __builtin__.print("object %d is not visible enough; re-rolling it" % i)
+            retries["visibility"] += 1
+            position = placement.sample_position(
+                i,
+                positions,
+                radii,
+                directions,
+                rng,
+                min_dist=args.min_dist,
+                margin=args.margin,
+                max_retries=args.max_retries,
+            )
+            if position is None:
+                remove_random_objects(records)
+                return None
+            remove_random_object(record)
+            positions[i] = position
+            records[i] = add_random_object(i, sizes[i], position, properties, args, cams, retries)
+            if records[i] is None:
+                remove_random_objects([r for r in records if r is not None])
+                return None
+
+
+def record_visible(record, object_pixels, char_pixels, min_pixels, min_char_pixels):
+    """
+  Check the visible pixel counts of an object and its characters from
+  check_visibility; either check is skipped if its minimum is None.
+  """
+    if min_pixels is not None and object_pixels.get(record["blender_object"].name, 0) <= min_pixels:
+        return False
+    if min_char_pixels is not None:
+        for c in record["chars"]:
+            if char_pixels.get(c.data.name, 0) <= min_char_pixels:
+                return False
+    return True
+
 
-        # Actually add the object to the scene
+def add_random_object(i, size, position, properties, args, cams, retries):
+    """
+  Add object i with the given (size name, radius) at the given ground plane
+  position, choosing everything else at random. If adding text fails then
+  everything added for the object is removed and it is re-rolled, up to
+  --max_retries times.
+
+  Returns a record dictionary with the Blender object ("blender_object"), its
+  texts ("blender_texts") and characters ("chars"), the character bounding
+  boxes in each view ("char_bboxes") and the object's entry for the scene
+  structure of each view ("views"); returns None if we ran out of retries.
+  """
+    for num_tries in range(args.max_retries):
+        if num_tries > 0:
+            retries["object"] += 1
+        scene_objects_before = set(obj.name for obj in bpy.context.scene.objects)
+        record = try_add_random_object(i, size, position, properties, args, cams)
+        if record is not None:
+            return record
+        # Remove everything this attempt added, including partial text
+        metrics.count("text_failures")
+        for obj in list(bpy.context.scene.objects):
+            if obj.name not in scene_objects_before:
+                utils.delete_object_and_data(obj)
+    return None
+
+
+def try_add_random_object(i, size, position, properties, args, cams):
+    """ A single attempt of add_random_object; returns None if text could not be added """
+    obj_spec = scene_specs.sample_object(size, position, properties, args)
+    return add_spec_object(i, obj_spec, properties, args, cams)
+
+
+def add_spec_object(i, obj_spec, properties, args, cams):
+    """
+  Add object i as described by its spec (see scene_specs.sample_object).
+  Returns a record as add_random_object does, or None if text could not be
+  added.
+  """
+    color_name_to_rgba = properties["color_name_to_rgba"]
+    obj_name = obj_spec["shape"]
+    obj_name_out = obj_spec["shape_name"]
+    size_name = obj_spec["size"]
+    r = obj_spec["radius"]
+    x, y = obj_spec["position"]
+    theta = obj_spec["rotation"]
+    color_name = obj_spec["color"]
+    rgba = color_name_to_rgba[color_name]
+
+    # Actually add the object to the scene
+    with metrics.timer("add_object"):
         utils.add_object(args.shape_dir, obj_name, r, (x, y), theta=theta)
-        obj = bpy.context.object
-        blender_objects.append(obj)
-        positions.append((x, y, r))
-        __builtin__.print("added random object " + str(i))
+    obj = bpy.context.object
+    __builtin__.print("added random object " + str(i))
 
-        # Attach a random material
-        mat_name, mat_name_out = choice(material_mapping)
-        utils.add_material(mat_name, Color=rgba)
+    # Attach the material
+    mat_name_out = obj_spec["material_name"]
+    utils.add_material(obj_spec["material"], Color=rgba)
 
-        # Record data about the object in the scene data structure
-        for cam in cams:
-            pixel_coords = utils.get_camera_coords(cam, obj.location)
-            objects[cam.name].append(
-                {
-                    "shape": obj_name_out,
-                    "size": size_name,
-                    "material": mat_name_out,
-                    "3d_coords": tuple(obj.location),
-                    "rotation": theta,
-                    "pixel_coords": pixel_coords,
-                    "color": color_name,
-                }
-            )
+    # Record data about the object in the scene data structure
+    views = {}
+    for cam in cams:
+        pixel_coords = utils.get_camera_coords(cam, obj.location)
+        views[cam.name] = {
+            "shape": obj_name_out,
+            "size": size_name,
+            "material": mat_name_out,
+            "3d_coords": tuple(obj.location),
+            "rotation": theta,
+            "pixel_coords": pixel_coords,
+            "color": color_name,
+        }
 
-        # Generate Text
-
-        # Add text to Blender
-        if args.text:
-            all_word_bboxes = []
-            all_char_bboxes = []
-            for i in range(np.random.randint(1, args.max_texts_per_obj + 1)):
-                num_chars = 1  # random.choice(range(1, 7))
-                chars = choice(
-                    string.ascii_lowercase
-                )  # "".join([random.choice(string.printable[:36]) for _ in range(num_chars)])
-
-                try:
-                    out_word_bboxes, out_char_bboxes, out_chars = utils.add_text(chars, args.random_text_rotation, cams)
-                    all_chars.extend(out_chars)
-                    all_word_bboxes.extend(out_word_bboxes)
-                    all_char_bboxes.extend(out_char_bboxes)
-                    # Select material and color for text
-                    text = bpy.context.scene.objects.active
-                    temp_dict = color_name_to_rgba.copy()
-                    del temp_dict[color_name]
-                    mat_name, mat_name_out = choice(material_mapping)
-                    color_name, rgba = choice(list(temp_dict.items()))
-                    utils.add_material(mat_name, Color=rgba)
-
-                    for char in out_chars:
-                        bpy.context.scene.objects.active = char
-                        utils.add_material(mat_name, Color=rgba)
-
-                except Exception as e:
-                    return purge(blender_objects, blender_texts, view_struct, num_objects, args, cams)
-
-            blender_texts.append(text)
-            __builtin__.print("added text to object " + str(i))
-
-            # Check that all objects are at least partially visible in the rendered image
-            for cam in cams:
-                bpy.context.scene.camera = cam
-                all_objects_visible, visible_chars = check_visibility(
-                    blender_objects + all_chars, args.min_pixels_per_object, cams
+    record = {
+        "blender_object": obj,
+        "blender_texts": [],
+        "chars": [],
+        "char_bboxes": {cam.name: [] for cam in cams},
+        "views": views,
+    }
+    if not obj_spec["texts"]:
+        return record
+
+    # Add text to Blender
+    all_word_bboxes = {cam.name: [] for cam in cams}
+    for text_spec in obj_spec["texts"]:
+        # Text is always attached to the object itself
+        bpy.context.scene.objects.active = obj
+        try:
+            with metrics.timer("add_text"):
+                out_word_bboxes, out_char_bboxes, out_chars = utils.add_text(
+                    text_spec["body"], args.random_text_rotation, cams, rotation=text_spec["rotation"]
                 )
-                for textid, visible_pixels in visible_chars.items():
-                    for char_bbox in all_char_bboxes[cam.name]:
-                        if char_bbox["id"] == textid:
-                            char_bbox["visible_pixels"] = visible_pixels
-            all_chars_visible = [c["visible_pixels"] > args.min_char_pixels for c in all_char_bboxes["cc"]]
-            if args.all_chars_visible and not all(all_chars_visible):
-                __builtin__.print("not all characters were visible, purging and retrying...")
-                return purge(blender_objects, blender_texts, view_struct, num_objects, args, cams)
+        except Exception as e:
+            __builtin__.print("could not add text to object %d (%s)" % (i, e))
+            return None
+        text = bpy.context.scene.objects.active
+        record["blender_texts"].append(text)
+        record["chars"].extend(out_chars)
+        for cam in cams:
+            all_word_bboxes[cam.name].append(out_word_bboxes[cam.name])
+            record["char_bboxes"][cam.name].extend(out_char_bboxes[cam.name])
 
-            for cam in cams:
-                x, y, _ = utils.get_camera_coords(cam, text.location)
-                objects[cam.name][-1]["text"] = {
-                    "font": text.data.font.name,
-                    "body": text.data.body,
-                    "3d_coords": tuple(text.location),
-                    "pixel_coords": (
-                        x / bpy.context.scene.render.resolution_x,
-                        y / bpy.context.scene.render.resolution_y,
-                    ),
-                    "color": color_name,
-                    "char_bboxes": all_char_bboxes,
-                    "word_bboxes": all_word_bboxes,
-                }
-        else:
-            all_objects_visible, visible_chars = check_visibility(
-                blender_objects + all_chars, args.min_pixels_per_object, cams
-            )
+        # Material and color for text
+        mat_name = text_spec["material"]
+        text_color_name = text_spec["color"]
+        rgba = color_name_to_rgba[text_color_name]
+        utils.add_material(mat_name, Color=rgba)
 
-    if args.enforce_obj_visibility and not all_objects_visible:
-        __builtin__.print("not all objects were visible, purging and retrying...")
-        return purge(blender_objects, blender_texts, view_struct, num_objects, args, cams)
+        for char in out_chars:
+            bpy.context.scene.objects.active = char
+            utils.add_material(mat_name, Color=rgba)
+
+    __builtin__.print("added text to object " + str(i))
+
+    for cam in cams:
+        x, y, _ = utils.get_camera_coords(cam, text.location)
+        views[cam.name]["text"] = {
+            "font": text.data.font.name,
+            "body": text.data.body,
+            "3d_coords": tuple(text.location),
+            "pixel_coords": (x / bpy.context.scene.render.resolution_x, y / bpy.context.scene.render.resolution_y,),
+            "color": text_color_name,
+            "char_bboxes": record["char_bboxes"][cam.name],
+            "word_bboxes": all_word_bboxes[cam.name],
+        }
+    return record
+
+
+def remove_random_object(record):
+    """ Remove an object added by add_random_object, with its text and data """
+    for obj in record["chars"] + record["blender_texts"] + [record["blender_object"]]:
+        utils.delete_object_and_data(obj)
 
-    return texts, blender_texts, objects, blender_objects
 
+def remove_random_objects(records):
+    for record in records:
+        remove_random_object(record)
 
-def purge(blender_objects, blender_texts, view_struct, num_objects, args, cams):
-    # If any of the objects are fully occluded then start over; delete all
-    # objects from the scene and place them all again.
-    __builtin__.print("Some objects are occluded; replacing objects")
-    for obj in blender_objects:
-        utils.delete_object(obj)
-    for text in blender_texts:
-        utils.delete_object(text)
-    for obj in bpy.context.scene.objects:
-        if "Text" in obj.name:
-            utils.delete_object(obj)
-    return add_random_objects(view_struct, num_objects, args, cams)
+
+def compute_view_directions(quaternions, plane_normal=(0.0, 0.0, 1.0)):
+    """
+  Compute the cardinal directions along the ground plane for a batch of
+  cameras. quaternions is a sequence of C camera orientations as (w, x, y, z)
+  and plane_normal is the normal of the ground plane.
+
+  Returns a list of C dictionaries mapping behind, front, left, right, above
+  and below to direction tuples: behind and left are the camera's -z and -x
+  axes projected onto the plane, and above is its y axis projected onto the
+  plane normal.
+  """
+    q = np.asarray(quaternions, dtype=np.float64).reshape(-1, 4)
+    q = q / np.linalg.norm(q, axis=1, keepdims=True)
+    w, x, y, z = q.T
+    # Columns of each camera's rotation matrix, i.e. its local axes in world space
+    cam_x = np.stack([1 - 2 * (y * y + z * z), 2 * (x * y + w * z), 2 * (x * z - w * y)], axis=1)
+    cam_y = np.stack([2 * (x * y - w * z), 1 - 2 * (x * x + z * z), 2 * (y * z + w * x)], axis=1)
+    cam_z = np.stack([2 * (x * z + w * y), 2 * (y * z - w * x), 1 - 2 * (x * x + y * y)], axis=1)
+
+    normal = np.asarray(plane_normal, dtype=np.float64)
+    normal = normal / np.linalg.norm(normal)
+
+    def normalized(v):
+        norms = np.linalg.norm(v, axis=1, keepdims=True)
+        return v / np.where(norms > 0, norms, 1.0)
+
+    def along_normal(v):
+        return np.outer(v.dot(normal), normal)
+
+    plane_behind = normalized(-cam_z - along_normal(-cam_z))
+    plane_left = normalized(-cam_x - along_normal(-cam_x))
+    plane_up = normalized(along_normal(cam_y))
+
+    all_directions = []
+    for behind, left, up in zip(plane_behind.tolist(), plane_left.tolist(), plane_up.tolist()):
+        all_directions.append(
+            {
+                "behind": tuple(behind),
+                "front": tuple(-c for c in behind),
+                "left": tuple(left),
+                "right": tuple(-c for c in left),
+                "above": tuple(up),
+                "below": tuple(-c for c in up),
+            }
+        )
+    return all_directions
+
+
+def compute_view_relationship_matrices(coords, view_directions, eps=0.2):
+    """
+  Vectorized core of compute_all_view_relationships. coords is a sequence of N
+  (x, y, z) object positions and view_directions is a list of C dictionaries,
+  one per camera, all mapping the same direction names to 3-vectors.
+
+  Returns a list of C dictionaries mapping each direction name other than
+  above / below to an (N, N) boolean array M, where M[i, j] is True if object j
+  has that relationship with object i in that view.
+  """
+    if not view_directions:
+        return []
+    names = [name for name in view_directions[0] if name != "above" and name != "below"]
+    dirs = np.array([[directions[name] for name in names] for directions in view_directions], dtype=np.float64)
+    dirs = dirs.reshape(len(view_directions), len(names), 1, 1, 3)
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    # diff[i, j] = coords[j] - coords[i]
+    diff = coords[None, :, :] - coords[:, None, :]
+    # Accumulate the dot products one component at a time, in the same order as
+    # a plain Python sum, so that pairs right at eps are thresholded the same way
+    # as before. dot has shape (C, len(names), N, N).
+    dot = diff[:, :, 0] * dirs[..., 0]
+    dot = dot + diff[:, :, 1] * dirs[..., 1]
+    dot = dot + diff[:, :, 2] * dirs[..., 2]
+    related = (dot > eps) & ~np.eye(len(coords), dtype=bool)
+    return [dict(zip(names, view_related)) for view_related in related]
+
+
+def compute_relationship_matrices(coords, directions, eps=0.2):
+    """ Single-view version of compute_view_relationship_matrices """
+    return compute_view_relationship_matrices(coords, [directions], eps=eps)[0]
+
+
+def compute_all_view_relationships(view_struct, cam_names, eps=0.2, as_matrices=False):
+    """
+  Computes relationships between all pairs of objects in the scene, relative to
+  each of the cameras in cam_names, in a single batched pass. Object positions
+  are the same in every view so they are taken from the canonical view.
+
+  Returns a dictionary mapping camera names to relationships in the format
+  returned by compute_all_relationships.
+  """
+    coords = [obj["3d_coords"] for obj in view_struct["cc"]["objects"]]
+    view_directions = [view_struct[cam_name]["directions"] for cam_name in cam_names]
+    view_matrices = compute_view_relationship_matrices(coords, view_directions, eps=eps)
+    output = {}
+    for cam_name, matrices in zip(cam_names, view_matrices):
+        if as_matrices:
+            output[cam_name] = matrices
+            continue
+        all_relationships = {}
+        for name, related in matrices.items():
+            all_relationships[name] = [np.flatnonzero(row).tolist() for row in related]
+        output[cam_name] = all_relationships
+    return output
 
 
-def compute_all_relationships(view_struct, eps=0.2):
+def compute_all_relationships(view_struct, eps=0.2, as_matrices=False, cam_name="cc"):
     """
   Computes relationships between all pairs of objects in the scene.
   
@@ -751,105 +1295,151 @@ def compute_all_relationships(view_struct, eps=0.2):
   integers, where output[rel][i] gives a list of object indices that have the
   relationship rel with object i. For example if j is in output['left'][i] then
   object j is left of object i.
+
+  If as_matrices is True then output[rel] is instead an (N, N) boolean array
+  whose row i marks the objects that have the relationship rel with object i.
+  Relationships are relative to the camera cam_name.
   """
-    all_relationships = {}
-    for name, direction_vec in view_struct["cc"]["directions"].items():
-        if name == "above" or name == "below":
-            continue
-        all_relationships[name] = []
-        for i, obj1 in enumerate(view_struct["cc"]["objects"]):
-            coords1 = obj1["3d_coords"]
-            related = set()
-            for j, obj2 in enumerate(view_struct["cc"]["objects"]):
-                if obj1 == obj2:
-                    continue
-                coords2 = obj2["3d_coords"]
-                diff = [coords2[k] - coords1[k] for k in [0, 1, 2]]
-                dot = sum(diff[k] * direction_vec[k] for k in [0, 1, 2])
-                if dot > eps:
-                    related.add(j)
-            all_relationships[name].append(sorted(list(related)))
-    return all_relationships
-
-
-def check_visibility(blender_objects, min_pixels_per_object, cams):
+    return compute_all_view_relationships(view_struct, [cam_name], eps=eps, as_matrices=as_matrices)[cam_name]
+
+
+def check_visibility(blender_objects, min_pixels_per_object, cams, min_char_pixels=None):
     """
   Check whether all objects in the scene have some minimum number of visible
-  pixels; to accomplish this we assign random (but distinct) colors to all
-  objects, and render using no lighting or shading or antialiasing; this
+  pixels; to accomplish this we assign distinct colors encoding an integer ID
+  to all objects, and render using no lighting or shading or antialiasing; this
   ensures that each object is just a solid uniform color. We can then count
-  the number of pixels of each color in the output image to check the visibility
+  the number of pixels of each ID in the output image to check the visibility
   of each object.
 
-  Returns True if all objects are visible and False otherwise.
+  The flat materials are set up once and then the view of each camera in cams
+  is rendered in turn. A view fails if some object has min_pixels_per_object
+  or fewer visible pixels (pass None to skip this check), or if min_char_pixels
+  is given and some character has that many or fewer; we stop rendering as soon
+  as a view fails.
+
+  Returns a tuple (all_visible, visible_objects, visible_chars) where
+  all_visible is True if all views passed, visible_objects maps the name of
+  each camera that was rendered to a dictionary from object names to visible
+  pixel counts, and visible_chars does the same for the characters that are
+  visible at all.
+  """
+    visible_objects = {}
+    visible_chars = {}
+    if not cams:
+        return True, visible_objects, visible_chars
+
+    f, path = tempfile.mkstemp(suffix=".exr")
+    os.close(f)
+    saved_state = enable_shadeless(blender_objects, path)
+    all_visible = True
+    buf = None
+    try:
+        for cam in cams:
+            # render an image with different colors for each object and count the pixels
+            bpy.context.scene.camera = cam
+            with metrics.timer("render_id_pass"):
+                bpy.ops.render.render(write_still=True)
+            with metrics.timer("decode_id_pass"):
+                img = bpy.data.images.load(path)
+                object_pixels, char_pixels, buf = decode_id_pass(img, blender_objects, buf=buf)
+                bpy.data.images.remove(img)
+            visible_objects[cam.name] = object_pixels
+            visible_chars[cam.name] = {name: count for name, count in char_pixels.items() if count > 0}
+
+            if min_pixels_per_object is not None:
+                if any(count <= min_pixels_per_object for count in object_pixels.values()):
+                    all_visible = False
+            if min_char_pixels is not None:
+                if any(count <= min_char_pixels for count in char_pixels.values()):
+                    all_visible = False
+            if not all_visible:
+                break
+    finally:
+        disable_shadeless(blender_objects, saved_state)
+        os.remove(path)
+    return all_visible, visible_objects, visible_chars
+
+
+def is_char(obj):
+    return "Mesh" in obj.data.name or "CUText" in obj.data.name
+
+
+def id_to_color(idx):
+    """
+  Encode a non-negative integer ID below 65536 as an RGB color. Each channel
+  holds a multiple of 1/255, so the ID can be recovered exactly from a Raw
+  floating point render (and would even survive 8-bit quantization).
   """
+    return [(idx % 256) / 255.0, (idx // 256) / 255.0, 0.0]
+
+
+def decode_id_pass(img, blender_objects, buf=None, chunk_size=1 << 20):
+    """
+  Count the visible pixels of every object in an image rendered after
+  enable_shadeless(blender_objects), in a single pass over the image.
 
-    # Split up input objects into characters and objects
-    num_visible_obs = 0
-    chars = []
-    objs = []
-    for obj in blender_objects:
-        __builtin__.print(obj.data.name)
-        if "Mesh" in obj.data.name or "CUText" in obj.data.name:
-            chars.append(obj)
+  The pixels are copied into buf, a preallocated float32 array that can be
+  passed back in for the next image of the same size, and are then decoded
+  into integer IDs and counted with np.bincount chunk_size pixels at a time so
+  that temporary arrays stay small even for very large renders.
+
+  Returns a tuple (object_pixels, char_pixels, buf) where object_pixels maps
+  object names to visible pixel counts and char_pixels maps character names
+  to visible pixel counts.
+  """
+    num_values = len(img.pixels)
+    if buf is None or len(buf) != num_values:
+        buf = np.empty(num_values, dtype=np.float32)
+    if hasattr(img.pixels, "foreach_get"):
+        img.pixels.foreach_get(buf)
+    else:
+        # Older versions of Blender do not have foreach_get on pixel arrays
+        buf[:] = img.pixels[:]
+    pixels = buf.reshape(-1, 4)
+
+    # ID 0 is the background; object i has ID i + 1
+    num_ids = len(blender_objects) + 1
+    counts = np.zeros(num_ids, dtype=np.int64)
+    for start in range(0, len(pixels), chunk_size):
+        chunk = pixels[start : start + chunk_size]
+        ids = np.rint(chunk[:, 0] * 255.0).astype(np.int64)
+        ids += 256 * np.rint(chunk[:, 1] * 255.0).astype(np.int64)
+        counts += np.bincount(ids, minlength=num_ids)[:num_ids]
+
+    object_pixels = {}
+    char_pixels = {}
+    for obj, count in zip(blender_objects, counts[1:].tolist()):
+        if is_char(obj):
+            char_pixels[obj.data.name] = count
         else:
-            objs.append(obj)
+            object_pixels[obj.name] = count
+    return object_pixels, char_pixels, buf
 
-    # render an image with different colors for each object and count the pixels (ignoring alpha)
-    f, path = tempfile.mkstemp(suffix=".exr")
-    object_colors, text_colors = render_shadeless(blender_objects, path=path)
-    img = bpy.data.images.load(path)
-    __builtin__.print(img)
-    p = list(img.pixels)
-    color_count = Counter((p[i], p[i + 1], p[i + 2]) for i in range(0, len(p), 4))
-    os.remove(path)
-
-    # loop through the colors and match them to objects (and characters)
-    visible_chars = {}
-    i = 0
-    for color, count in color_count.most_common():
-        if i != 0:
-            color = (round(color[0], 2), round(color[1], 2), round(color[2], 2))
-        i += 1
-        was_text, text_name = color_in_colors(color, text_colors)
-        was_obj = color_in_objcolors(color, object_colors)
-        if was_text:
-            visible_chars[text_name] = count
-        if was_obj and count > min_pixels_per_object:
-            num_visible_obs += 1
-    if num_visible_obs == len(objs):
-        return True, visible_chars
-    return False, visible_chars
-
-
-def color_in_colors(color, text_colors):
-    tname = None
-    for tname, tc in text_colors.items():
-        if color == tc:
-            return True, tname
-    return False, tname
-
-
-def color_in_objcolors(color, obj_colors):
-    for c in obj_colors:
-        if color == c:
-            return True
-    return False
-
-
-def render_shadeless(blender_objects, path="flat.png"):
+
+def enable_shadeless(blender_objects, path="flat.png"):
     """
-  Render a version of the scene with shading disabled and unique materials
-  assigned to all objects, and return a set of all colors that should be in the
-  rendered image. The image itself is written to path. This is used to ensure
+  Set up the scene so that renders have shading disabled and unique materials
+  assigned to all objects, and are written to path. This is used to ensure
   that all objects will be visible in the final rendered scene.
+
+  Object i in blender_objects gets the color id_to_color(i + 1), leaving ID 0
+  for the background. Returns the state that disable_shadeless needs to undo
+  these changes.
   """
     render_args = bpy.context.scene.render
 
     # Cache the render args we are about to clobber
-    old_filepath = render_args.filepath
-    old_engine = render_args.engine
-    old_use_antialiasing = render_args.use_antialiasing
+    saved_state = {
+        "filepath": render_args.filepath,
+        "engine": render_args.engine,
+        "use_antialiasing": render_args.use_antialiasing,
+        "camera": bpy.context.scene.camera,
+        "materials": [],
+        "view_transform": render_args.image_settings.view_settings.view_transform,
+        "file_format": render_args.image_settings.file_format,
+        "color_mode": render_args.image_settings.color_mode,
+    }
 
     # Override some render settings to have flat shading
     render_args.filepath = path
@@ -862,23 +1452,13 @@ def render_shadeless(blender_objects, path="flat.png"):
     utils.set_layer(bpy.data.objects["Lamp_Back"], 2)
     utils.set_layer(bpy.data.objects["Ground"], 2)
 
-    # Add random shadeless materials to all objects
-    object_colors = set()
-    text_colors = {}
-    old_materials = []
-
+    # Add shadeless materials encoding object IDs to all objects
     for i, obj in enumerate(blender_objects):
-        old_materials.append(obj.data.materials[0])
+        saved_state["materials"].append(obj.data.materials[0])
         bpy.ops.material.new()
         mat = bpy.data.materials["Material"]
         mat.name = "Material_%d" % i
-        r, g, b = i * 0.01, i * 0.01, i * 0.01
-
-        if "Mesh" in obj.data.name or "CUText" in obj.data.name:
-            text_colors[obj.data.name] = (r, g, b)
-        else:
-            object_colors.add((r, g, b))
-        mat.diffuse_color = [r, g, b]
+        mat.diffuse_color = id_to_color(i + 1)
         mat.use_shadeless = True
         obj.data.materials[0] = mat
 
@@ -888,16 +1468,20 @@ def render_shadeless(blender_objects, path="flat.png"):
     bpy.context.scene.render.image_settings.color_mode = "RGB"
     bpy.context.scene.render.engine = "CYCLES"  # just making sure
 
-    # Render the scene
-    bpy.ops.render.render(write_still=True)
+    return saved_state
+
+
+def disable_shadeless(blender_objects, saved_state):
+    """ Undo the changes made by enable_shadeless """
+    render_args = bpy.context.scene.render
 
     # Change these settings back so we render out the PNG images
-    bpy.context.scene.render.image_settings.view_settings.view_transform = "Default"
-    bpy.context.scene.render.image_settings.file_format = "JPEG"
-    bpy.context.scene.render.image_settings.color_mode = "RGB"
+    render_args.image_settings.view_settings.view_transform = saved_state["view_transform"]
+    render_args.image_settings.file_format = saved_state["file_format"]
+    render_args.image_settings.color_mode = saved_state["color_mode"]
 
     # Undo the above; first restore the materials to objects
-    for mat, obj in zip(old_materials, blender_objects):
+    for mat, obj in zip(saved_state["materials"], blender_objects):
         obj.data.materials[0] = mat
 
     # Move the lights and ground back to layer data
@@ -907,11 +1491,10 @@ def render_shadeless(blender_objects, path="flat.png"):
     utils.set_layer(bpy.data.objects["Ground"], 0)
 
     # Set the render settings back to what they were
-    render_args.filepath = old_filepath
-    render_args.engine = old_engine
-    render_args.use_antialiasing = old_use_antialiasing
-
-    return object_colors, text_colors
+    render_args.filepath = saved_state["filepath"]
+    render_args.engine = saved_state["engine"]
+    render_args.use_antialiasing = saved_state["use_antialiasing"]
+    bpy.context.scene.camera = saved_state["camera"]
 
 
 # I removed the "if _nname__ == main here because it's ALWAYS main.
@@ -922,32 +1505,7 @@ if INSIDE_BLENDER:
     argv = utils.extract_args()
     args = parser.parse_args(argv)
 
-    ### azimuth stuff
-    if args.random_view_azimuth_min > args.random_view_azimuth_max:
-        # swap it
-        args.random_view_azimuth_max, args.random_view_azimuth_min = (
-            args.random_view_azimuth_min,
-            args.random_view_azimuth_max,
-        )
-    if args.random_view_azimuth_max > 360:
-        print("FYI: 360 is a full rotation and you specified {} as max".format(args.random_view_azimuth_max))
-    args.random_view_azimuth_min = math.radians(args.random_view_azimuth_min)
-    args.random_view_azimuth_max = math.radians(args.random_view_azimuth_max)
-
-    assert 0.001 <= args.random_view_radius <= 100
-
-    ### elevation stuff
-    if args.random_view_elevation_min > args.random_view_elevation_max:
-        args.random_view_elevation_min, args.random_view_elevation_max = (
-            args.random_view_elevation_max,
-            args.random_view_elevation_min,
-        )
-
-    assert 0 < args.random_view_elevation_min <= args.random_view_elevation_max < 90
-    if args.random_view_elevation_min < 10:
-        print("\n\nWARNING: low elevation angle. Might take long to find non-obstructed perspective\n\n")
-    args.random_view_elevation_min = math.radians(args.random_view_elevation_min)
-    args.random_view_elevation_max = math.radians(args.random_view_elevation_max)
+    scene_specs.convert_view_args(args)
 
     ### main prog
     arg_names = sorted(vars(args))
@@ -0,0 +1,95 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import json, os
+
+"""
+Reading and writing the per-scene output files of render_images.py. This module
+does not depend on Blender, so that render_driver.py can check which scenes are
+done with plain Python.
+
+Every file is written under a temporary name and then renamed, and the JSON
+file of a scene is written only after all of its images, so a scene whose JSON
+file and images all pass scene_complete was rendered completely even if the
+job rendering it was killed at some point.
+
+A scene can also be rejected, when the spec it is rendered from cannot be
+rendered as it is (see render_images.SceneRejected). Rendering it again would
+give the same result, so this is recorded in a marker file next to its JSON
+file, and rejected scenes count as finished but are left out of the combined
+scene file.
+"""
+
+
+def scene_complete(scene_path, output_image_dir):
+    """
+  Check whether the scene whose JSON file is scene_path was rendered
+  completely: the JSON file can be read, and every image it lists exists and
+  is a complete PNG file.
+  """
+    try:
+        with open(scene_path, "r") as f:
+            view_struct = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False
+    for view in view_struct.values():
+        if not png_complete(os.path.join(output_image_dir, view["image_filename"])):
+            return False
+    return True
+
+
+def rejected_path(scene_path):
+    """ Path of the marker file recording that the scene of scene_path was rejected """
+    return os.path.splitext(scene_path)[0] + ".rejected"
+
+
+def scene_rejected(scene_path):
+    return os.path.isfile(rejected_path(scene_path))
+
+
+def write_rejected(scene_path, reason):
+    """
+  Record that the scene of scene_path was rejected, and remove any JSON file
+  left for it by an earlier run.
+  """
+    write_json_atomic({"reason": reason}, rejected_path(scene_path))
+    if os.path.isfile(scene_path):
+        os.remove(scene_path)
+
+
+def clear_rejected(scene_path):
+    """ Remove the rejection marker of a scene that has now been rendered """
+    if scene_rejected(scene_path):
+        os.remove(rejected_path(scene_path))
+
+
+def png_complete(path):
+    """ Check that path is a PNG file that ends with an IEND chunk """
+    try:
+        with open(path, "rb") as f:
+            if f.read(8) != b"\x89PNG\r\n\x1a\n":
+                return False
+            f.seek(0, os.SEEK_END)
+            if f.tell() < 20:
+                return False
+            f.seek(-12, os.SEEK_END)
+            return f.read(8)[4:] == b"IEND"
+    except (IOError, OSError):
+        return False
+
+
+def write_json_atomic(obj, path, **kwargs):
+    """
+  Write obj as JSON to path by way of a temporary file, so that path never
+  holds a partially written file.
+  """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, **kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
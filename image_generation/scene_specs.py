@@ -0,0 +1,453 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json, math, random, re, string
+import numpy as np
+
+import placement
+
+"""
+Scene specs hold every random choice that goes into a scene: the camera and
+light positions, and the shape, size, position, rotation, material and color of
+every object and of its text. They are made with plain Python, without Blender,
+so specs for a very large number of scenes can be made in seconds and then
+filtered, deduplicated or rebalanced before any rendering time is spent:
+
+python scene_specs.py --num_images 100000 --output_specs_file specs.jsonl [arguments]
+
+render_images.py --scene_specs specs.jsonl renders the scenes of a spec file
+without making any random choices of its own, so render workers only carry out
+a list of specs. Specs are written as JSON lines; the first line holds
+{"info": ...} with the arguments used, and every following line a single spec:
+
+{"index": 0,
+ "cameras": [{"name": "cc", "location": [7.1, -6.8, 6.2]}, ...],
+ "lights": {"Lamp_Key": [0.3, -0.1, 0.2], ...},
+ "objects": [{"shape": "SmoothCylinder", "shape_name": "cylinder",
+              "size": "large", "radius": 0.7, "position": [1.2, -0.4],
+              "rotation": 123.4, "material": "Rubber", "material_name": "rubber",
+              "color": "gray",
+              "texts": [{"body": "q", "rotation": 0.3, "material": "MyMetal",
+                         "material_name": "metal", "color": "red"}]},
+             ...]}
+
+Camera locations are absolute, including any jitter; cameras that are not in
+the base scene (such as the random views) are added by render_images.py. Light
+positions are offsets from their position in the base scene.
+
+Objects are laid out using the cardinal directions of the canonical camera
+("cc"), which we work out from its location assuming that it points at
+--camera_target without roll, as the cameras in the base scenes do. Since the
+base scene is not read here, the locations of its cameras are given by
+--base_cameras.
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--output_specs_file", default="../output/CLEVR_specs.jsonl", help="JSON-lines file to write")
+parser.add_argument("--start_idx", default=0, type=int, help="The index of the first scene")
+parser.add_argument("--num_images", default=5, type=int, help="The number of scene specs to make")
+parser.add_argument("--seed", default=None, type=int, help="Seed for the random number generators")
+parser.add_argument(
+    "--base_cameras",
+    nargs="+",
+    default=["cc:7,-7,6"],
+    help="Names and locations NAME:X,Y,Z of the cameras in the base scene, "
+    + 'canonical camera ("cc") first. The default matches the symmetric base '
+    + "scenes; with --multi_view list all of their cameras, e.g. cc:7,-7,6 "
+    + "cl:-7,-7,6 co:-7,7,6 cr:7,7,6.",
+)
+parser.add_argument(
+    "--camera_target",
+    default=[0.0, 0.0, 0.0],
+    type=float,
+    nargs=3,
+    help="The point that all cameras of the base scene point at",
+)
+# These match the arguments of render_images.py
+parser.add_argument("--properties_json", default="data/properties.json")
+parser.add_argument("--shape_color_combos_json", default=None)
+parser.add_argument("--min_objects", default=3, type=int)
+parser.add_argument("--max_objects", default=10, type=int)
+parser.add_argument("--min_dist", default=0.25, type=float)
+parser.add_argument("--margin", default=0.4, type=float)
+parser.add_argument("--max_retries", default=50, type=int)
+parser.add_argument("--random_text_rotation", action="store_true")
+parser.add_argument("--text", action="store_true")
+parser.add_argument("--max_texts_per_obj", default=1, type=int)
+parser.add_argument("--multi_view", action="store_true")
+parser.add_argument("--random_views", action="store_true")
+parser.add_argument("--random_view_azimuth_min", default=0, type=float)
+parser.add_argument("--random_view_azimuth_max", default=360, type=float)
+parser.add_argument("--random_view_radius", default=10.0, type=float)
+parser.add_argument("--random_view_elevation_min", default=25, type=float)
+parser.add_argument("--random_view_elevation_max", default=60, type=float)
+parser.add_argument("--key_light_jitter", default=1.0, type=float)
+parser.add_argument("--fill_light_jitter", default=1.0, type=float)
+parser.add_argument("--back_light_jitter", default=1.0, type=float)
+parser.add_argument("--camera_jitter", default=0.5, type=float)
+
+LIGHT_JITTER_ARGS = [
+    ("Lamp_Key", "key_light_jitter"),
+    ("Lamp_Back", "back_light_jitter"),
+    ("Lamp_Fill", "fill_light_jitter"),
+]
+
+
+def load_properties(args):
+    """
+  Load the property file, and the shape / color combinations if given, into a
+  dictionary of the choices available for random objects.
+  """
+    with open(args.properties_json, "r") as f:
+        properties = json.load(f)
+        color_name_to_rgba = {}
+        for name, rgb in properties["colors"].items():
+            rgba = [float(c) / 255.0 for c in rgb] + [1.0]
+            color_name_to_rgba[name] = rgba
+        material_mapping = [(v, k) for k, v in properties["materials"].items()]
+        object_mapping = [(v, k) for k, v in properties["shapes"].items()]
+        size_mapping = list(properties["sizes"].items())
+
+    shape_color_combos = None
+    if args.shape_color_combos_json is not None:
+        with open(args.shape_color_combos_json, "r") as f:
+            shape_color_combos = list(json.load(f).items())
+
+    return {
+        "color_name_to_rgba": color_name_to_rgba,
+        "material_mapping": material_mapping,
+        "object_mapping": object_mapping,
+        "size_mapping": size_mapping,
+        "shape_color_combos": shape_color_combos,
+    }
+
+
+def jitter(magnitude):
+    return 2.0 * magnitude * (random.random() - 0.5)
+
+
+def convert_view_args(args):
+    """
+  Check the random view arguments, which are given in degrees, and convert the
+  angles to radians in place.
+  """
+    ### azimuth stuff
+    if args.random_view_azimuth_min > args.random_view_azimuth_max:
+        # swap it
+        args.random_view_azimuth_max, args.random_view_azimuth_min = (
+            args.random_view_azimuth_min,
+            args.random_view_azimuth_max,
+        )
+    if args.random_view_azimuth_max > 360:
+        print("FYI: 360 is a full rotation and you specified {} as max".format(args.random_view_azimuth_max))
+    args.random_view_azimuth_min = math.radians(args.random_view_azimuth_min)
+    args.random_view_azimuth_max = math.radians(args.random_view_azimuth_max)
+
+    assert 0.001 <= args.random_view_radius <= 100
+
+    ### elevation stuff
+    if args.random_view_elevation_min > args.random_view_elevation_max:
+        args.random_view_elevation_min, args.random_view_elevation_max = (
+            args.random_view_elevation_max,
+            args.random_view_elevation_min,
+        )
+
+    assert 0 < args.random_view_elevation_min <= args.random_view_elevation_max < 90
+    if args.random_view_elevation_min < 10:
+        print("\n\nWARNING: low elevation angle. Might take long to find non-obstructed perspective\n\n")
+    args.random_view_elevation_min = math.radians(args.random_view_elevation_min)
+    args.random_view_elevation_max = math.radians(args.random_view_elevation_max)
+
+
+
+def sample_random_views(base_location, args, num_views=20):
+    """
+  Sample locations for num_views cameras on a circle of radius
+  --random_view_radius around the scene, starting from the azimuth of the
+  camera at base_location. Returns a list of (x, y, z) tuples.
+  """
+    base_angle = math.atan2(base_location[1], base_location[0])
+    azimuths = [
+        random.uniform(base_angle + args.random_view_azimuth_min, base_angle + args.random_view_azimuth_max)
+        for _ in range(num_views)
+    ]
+    x = [args.random_view_radius * math.cos(a) for a in azimuths]
+    y = [args.random_view_radius * math.sin(a) for a in azimuths]
+    elevations = [
+        random.uniform(args.random_view_elevation_min, args.random_view_elevation_max) for _ in range(num_views)
+    ]
+    z = [math.tan(e) * args.random_view_radius for e in elevations]
+
+    for z_i in z:
+        if z_i < 2:
+            print(
+                "\n\n=== WARNING: ELEVATION VERY LOW ({}). "
+                "PROLLY HARD TO FIND WORKING CONFIGURATION WHERE NOTHING IS OBSCURED.\n"
+                "Increase args.random_view_elevation_min\n\n".format(z_i)
+            )
+    return list(zip(x, y, z))
+
+
+def camera_directions(location, target=(0.0, 0.0, 0.0)):
+    """
+  The cardinal directions along the ground plane for a camera at location
+  that points at target without roll, in the same format as
+  render_images.compute_view_directions.
+  """
+    behind = np.array([target[0] - location[0], target[1] - location[1]], dtype=np.float64)
+    behind /= np.linalg.norm(behind)
+    left = np.array([-behind[1], behind[0]])
+    return {
+        "behind": (behind[0], behind[1], 0.0),
+        "front": (-behind[0], -behind[1], 0.0),
+        "left": (left[0], left[1], 0.0),
+        "right": (-left[0], -left[1], 0.0),
+        "above": (0.0, 0.0, 1.0),
+        "below": (0.0, 0.0, -1.0),
+    }
+
+
+def sample_text_rotation(random_rotation):
+    """ The same rotation about the z axis that utils.add_text chooses by default """
+    if random_rotation:
+        return random.random() * math.pi
+    return random.random() * -0.5
+
+
+def sample_object(size, position, properties, args):
+    """
+  Choose everything about an object other than its size and position, given
+  as a (size name, radius) pair and an (x, y) pair. Returns the spec of the
+  object.
+  """
+    color_name_to_rgba = properties["color_name_to_rgba"]
+    material_mapping = properties["material_mapping"]
+    object_mapping = properties["object_mapping"]
+    shape_color_combos = properties["shape_color_combos"]
+    size_name, r = size
+
+    # Choose random color and shape
+    if shape_color_combos is None:
+        obj_name, obj_name_out = random.choice(object_mapping)
+        color_name, rgba = random.choice(list(color_name_to_rgba.items()))
+    else:
+        obj_name_out, color_choices = random.choice(shape_color_combos)
+        color_name = random.choice(color_choices)
+        obj_name = [k for k, v in object_mapping if v == obj_name_out][0]
+
+    # For cube, adjust the size a bit
+    if obj_name == "Cube":
+        r /= math.sqrt(2)
+
+    # Choose random orientation for the object.
+    theta = 360.0 * random.random()
+
+    mat_name, mat_name_out = random.choice(material_mapping)
+    obj_spec = {
+        "shape": obj_name,
+        "shape_name": obj_name_out,
+        "size": size_name,
+        "radius": r,
+        "position": list(position),
+        "rotation": theta,
+        "material": mat_name,
+        "material_name": mat_name_out,
+        "color": color_name,
+        "texts": [],
+    }
+    if not args.text:
+        return obj_spec
+
+    for _ in range(np.random.randint(1, args.max_texts_per_obj + 1)):
+        body = random.choice(string.ascii_lowercase)
+        rotation = sample_text_rotation(args.random_text_rotation)
+
+        # Text gets any color other than that of the object
+        mat_name, mat_name_out = random.choice(material_mapping)
+        text_color_name = random.choice([c for c in color_name_to_rgba if c != color_name])
+        obj_spec["texts"].append(
+            {
+                "body": body,
+                "rotation": rotation,
+                "material": mat_name,
+                "material_name": mat_name_out,
+                "color": text_color_name,
+            }
+        )
+    return obj_spec
+
+
+def parse_base_cameras(base_cameras):
+    """ Parse NAME:X,Y,Z strings into a list of (name, (x, y, z)) pairs """
+    cameras = []
+    for s in base_cameras:
+        name, location = s.split(":")
+        cameras.append((name, tuple(float(c) for c in location.split(","))))
+    return cameras
+
+
+def sample_scene_spec(index, args, properties, base_cameras):
+    """ Make the spec of scene index; base_cameras is from parse_base_cameras """
+    num_objects = random.randint(args.min_objects, args.max_objects)
+
+    cameras = base_cameras if args.multi_view else base_cameras[:1]
+    cameras = [{"name": name, "location": list(location)} for name, location in cameras]
+    if args.multi_view and args.random_views:
+        views = sample_random_views(cameras[0]["location"], args)
+        cameras = cameras[:1] + [{"name": "cam%d" % i, "location": list(loc)} for i, loc in enumerate(views)]
+    if args.camera_jitter > 0:
+        for cam in cameras:
+            for i in range(3):
+                cam["location"][i] += jitter(args.camera_jitter)
+
+    lights = {}
+    for name, arg in LIGHT_JITTER_ARGS:
+        magnitude = getattr(args, arg)
+        if magnitude > 0:
+            lights[name] = [jitter(magnitude) for _ in range(3)]
+
+    canonical = [cam for cam in cameras if cam["name"] == "cc"] or cameras[:1]
+    directions = camera_directions(canonical[0]["location"], args.camera_target)
+    # As in render_images.py, choose new sizes if the objects do not fit
+    for _ in range(args.max_retries + 1):
+        sizes = [random.choice(properties["size_mapping"]) for _ in range(num_objects)]
+        positions, _ = placement.sample_layout(
+            [r for _, r in sizes],
+            directions,
+            placement.make_rng(),
+            min_dist=args.min_dist,
+            margin=args.margin,
+            max_retries=args.max_retries,
+        )
+        if positions is not None:
+            break
+    else:
+        raise ValueError("Could not lay out %d objects for scene %d; try a lower --max_objects" % (num_objects, index))
+    objects = [sample_object(size, position, properties, args) for size, position in zip(sizes, positions)]
+    return {"index": index, "cameras": cameras, "lights": lights, "objects": objects}
+
+
+# Arguments that still matter when render_images.py renders a spec, so they must
+# be the same as for scene_specs.py; the other shared arguments only affect the
+# random choices that the spec has already made
+RENDER_ARGS = ["properties_json", "text", "random_text_rotation", "multi_view", "min_dist", "margin"]
+
+
+def read_spec_info(path):
+    """ Return the "info" dict of a spec file, which holds the arguments it was made with """
+    with open(path, "rb") as f:
+        return json.loads(f.readline().decode("utf-8"))["info"]
+
+
+def spec_info_mismatches(info, args):
+    """
+  Compare the info of a spec file with the arguments of render_images.py and
+  return a list of messages for the arguments in RENDER_ARGS that differ.
+  Property files given by different paths are compared by their contents,
+  and only if both can be read, since the path in the info is relative to
+  wherever scene_specs.py was run.
+  """
+    mismatches = []
+    for name in RENDER_ARGS:
+        if name not in info or info[name] == getattr(args, name):
+            continue
+        if name.endswith("_json") and not json_files_differ(info[name], getattr(args, name)):
+            continue
+        mismatches.append("--%s is %r for the specs but %r here" % (name, info[name], getattr(args, name)))
+    return mismatches
+
+
+def json_files_differ(path1, path2):
+    try:
+        with open(path1, "r") as f1, open(path2, "r") as f2:
+            return json.load(f1) != json.load(f2)
+    except (IOError, ValueError):
+        return False
+
+
+# Specs are written by json.dumps with "index" as their first key
+SPEC_INDEX_RE = re.compile(rb'\{"index": (-?\d+)[,}]')
+
+
+def spec_index(line):
+    """
+  The index of the spec on a line (as bytes) of a spec file. This is read from
+  the start of the line where possible, so that the line is only decoded if
+  it was not written by json.dumps.
+  """
+    m = SPEC_INDEX_RE.match(line)
+    if m is not None:
+        return int(m.group(1))
+    return json.loads(line.decode("utf-8"))["index"]
+
+
+def read_specs(path, start_idx=0, num_images=None):
+    """
+  Read the specs with indices start_idx to start_idx + num_images - 1 (or all
+  from start_idx if num_images is None) from a spec file, returning a dict
+  from index to spec. Specs may be in any order, since spec files can be
+  filtered or rebalanced, so every line is checked, but only the specs in the
+  range are decoded.
+  """
+    end_idx = None if num_images is None else start_idx + num_images
+    specs = {}
+    with open(path, "rb") as f:
+        f.readline()  # info
+        for line in f:
+            if not line.strip():
+                continue
+            idx = spec_index(line)
+            if idx >= start_idx and (end_idx is None or idx < end_idx):
+                specs[idx] = json.loads(line.decode("utf-8"))
+    return specs
+
+
+def index_specs(path):
+    """ Return a dict from scene index to the byte offset of its line in a spec file """
+    offsets = {}
+    with open(path, "rb") as f:
+        offset = len(f.readline())  # info
+        for line in f:
+            if line.strip():
+                offsets[spec_index(line)] = offset
+            offset += len(line)
+    return offsets
+
+
+def write_spec_slice(path, output_path, indices, offsets):
+    """
+  Write a spec file holding the info of the spec file at path and the specs of
+  the given scene indices that it has, found using offsets from index_specs.
+  This lets every render worker read a small file of its own.
+  """
+    with open(path, "rb") as f, open(output_path, "wb") as out:
+        out.write(f.readline())
+        for idx in indices:
+            if idx in offsets:
+                f.seek(offsets[idx])
+                out.write(f.readline())
+
+
+def main(args):
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+    info = dict(vars(args))
+    convert_view_args(args)
+    properties = load_properties(args)
+    base_cameras = parse_base_cameras(args.base_cameras)
+    with open(args.output_specs_file, "w") as f:
+        f.write(json.dumps({"info": info}) + "\n")
+        for i in range(args.num_images):
+            spec = sample_scene_spec(args.start_idx + i, args, properties, base_cameras)
+            f.write(json.dumps(spec) + "\n")
+    print("Wrote %d scene specs to %s" % (args.num_images, args.output_specs_file))
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
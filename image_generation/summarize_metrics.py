@@ -0,0 +1,121 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json
+import numpy as np
+
+"""
+Summarize the metrics written by render_images.py --metrics_file. Run with plain
+Python, giving one or more metrics files:
+
+python summarize_metrics.py ../output/metrics.jsonl
+
+For every stage of rendering this prints the total time over all scenes, its
+share of the total, the mean and percentiles of the time per scene, and the
+self time (excluding nested stages). Nested stages are indented under the stage
+they run in. With --sort self the stages are instead listed by self time, so the
+biggest hot spots come first. This is followed by the totals of all counters.
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument("metrics_files", nargs="+", help="JSON-lines files written by render_images.py")
+parser.add_argument(
+    "--sort",
+    default="tree",
+    choices=["tree", "self"],
+    help="List stages nested under their parent stage (tree), or by " + "decreasing self time (self)",
+)
+
+
+def load_records(paths):
+    records = []
+    for path in paths:
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+    return records
+
+
+def stage_times(records):
+    """ Returns a dict from each stage path to an array of its seconds in each scene """
+    paths = sorted(set(path for record in records for path in record["stages"]))
+    times = {}
+    for path in paths:
+        times[path] = np.array([record["stages"].get(path, {"seconds": 0.0})["seconds"] for record in records])
+    return times
+
+
+def self_times(times):
+    """ Subtract the time of each stage's direct children from its own time """
+    result = {}
+    for path, seconds in times.items():
+        children = [p for p in times if p.startswith(path + "/") and "/" not in p[len(path) + 1 :]]
+        result[path] = seconds - sum((times[p] for p in children), np.zeros_like(seconds))
+    return result
+
+
+def main(args):
+    records = load_records(args.metrics_files)
+    if not records:
+        print("No scenes found")
+        return
+    scene_seconds = np.array([record["seconds"] for record in records])
+    total = scene_seconds.sum()
+    print(
+        "%d scenes, %.1f s in total, %.2f s per scene (median %.2f s, 95th percentile %.2f s)"
+        % (len(records), total, scene_seconds.mean(), np.median(scene_seconds), np.percentile(scene_seconds, 95))
+    )
+    print()
+
+    times = stage_times(records)
+    selfs = self_times(times)
+    calls = {path: sum(record["stages"].get(path, {"calls": 0})["calls"] for record in records) for path in times}
+    if args.sort == "self":
+        paths = sorted(times, key=lambda p: -selfs[p].sum())
+    else:
+        paths = sorted(times, key=lambda p: p.split("/"))
+
+    print(
+        "%-44s %10s %6s %9s %9s %9s %10s %9s"
+        % ("stage", "total s", "%", "mean s", "p50 s", "p95 s", "self s", "calls")
+    )
+    for path in paths:
+        if args.sort == "self":
+            name = path
+        else:
+            name = "  " * path.count("/") + path.split("/")[-1]
+        seconds = times[path]
+        print(
+            "%-44s %10.1f %6.1f %9.3f %9.3f %9.3f %10.1f %9d"
+            % (
+                name,
+                seconds.sum(),
+                100.0 * seconds.sum() / max(total, 1e-9),
+                seconds.mean(),
+                np.median(seconds),
+                np.percentile(seconds, 95),
+                selfs[path].sum(),
+                calls[path],
+            )
+        )
+    untimed = total - sum(times[path].sum() for path in times if "/" not in path)
+    print("%-44s %10.1f %6.1f" % ("(not in any stage)", untimed, 100.0 * untimed / max(total, 1e-9)))
+    print()
+
+    counters = sorted(set(name for record in records for name in record["counters"]))
+    if counters:
+        print("%-44s %10s %9s %9s" % ("counter", "total", "mean", "max"))
+        for name in counters:
+            values = np.array([record["counters"].get(name, 0) for record in records])
+            print("%-44s %10d %9.2f %9d" % (name, values.sum(), values.mean(), values.max()))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -11,6 +11,7 @@ import numpy as np
 from mathutils import Vector
 import collections
 from bpy_extras.object_utils import world_to_camera_view
+import metrics
 """
 Some utility functions for interacting with Blender
 """
@@ -46,6 +47,10 @@ def parse_args(parser, argv=None):
   return parser.parse_args(extract_args(argv))
 
 
+# Name of the unlinked copy of each shape kept by add_object
+SHAPE_TEMPLATE = '%s_template'
+
+
 # I wonder if there's a better way to do this?
 def delete_object(obj):
   """ Delete a specified blender object """
@@ -55,6 +60,28 @@ def delete_object(obj):
   bpy.ops.object.delete()
 
 
+def delete_object_and_data(obj):
+  """
+  Delete a blender object along with its mesh or curve data and its materials
+  when nothing else uses them, so that objects which are added and removed
+  again do not leave orphaned datablocks behind. Node groups loaded by
+  load_materials are shared and are kept.
+  """
+  data = obj.data
+  materials = []
+  if data is not None and hasattr(data, 'materials'):
+    materials = [mat for mat in data.materials if mat is not None]
+  delete_object(obj)
+  if data is not None and data.users == 0:
+    if isinstance(data, bpy.types.Mesh):
+      bpy.data.meshes.remove(data)
+    elif isinstance(data, bpy.types.Curve):
+      bpy.data.curves.remove(data)
+  for mat in materials:
+    if mat.users == 0:
+      bpy.data.materials.remove(mat)
+
+
 def bounds(cam, obj, local=False):
 
   local_coords = obj.bound_box[:]
@@ -111,6 +138,11 @@ def add_object(object_dir, name, scale, loc, theta=0):
   is a file named "$name.blend" which contains a single object named "$name"
   that has unit size and is centered at the origin.
 
+  The first time a shape is loaded we keep an unlinked copy of it (see
+  SHAPE_TEMPLATE), and later objects of the same shape are copied from that in
+  memory rather than appended from the .blend file again. The copy lasts until
+  a different main file is opened.
+
   - scale: scalar giving the size that the object should be in the scene
   - loc: tuple (x, y) giving the coordinates on the ground plane where the
     object should be placed.
@@ -122,20 +154,47 @@ def add_object(object_dir, name, scale, loc, theta=0):
     if obj.name.startswith(name):
       count += 1
 
-  filename = os.path.join(object_dir, '%s.blend' % name, 'Object', name)
-  bpy.ops.wm.append(filename=filename)
-
-  # Give it a new name to avoid conflicts
   new_name = '%s_%d' % (name, count)
-  bpy.data.objects[name].name = new_name
-
-  # Set the new object as active, then rotate, scale, and translate it
   x, y = loc
 
-  bpy.context.scene.objects.active = bpy.data.objects[new_name]
-  bpy.context.object.rotation_euler[2] = theta
-  bpy.ops.transform.resize(value=(scale, scale, scale))
-  bpy.ops.transform.translate(value=(x, y, scale))
+  template = bpy.data.objects.get(SHAPE_TEMPLATE % name)
+  if template is None:
+    filename = os.path.join(object_dir, '%s.blend' % name, 'Object', name)
+    bpy.ops.wm.append(filename=filename)
+
+    # Give it a new name to avoid conflicts
+    bpy.data.objects[name].name = new_name
+    obj = bpy.data.objects[new_name]
+
+    # Keep an untransformed copy, with its own mesh, for later objects
+    template = obj.copy()
+    template.data = obj.data.copy()
+    template.name = SHAPE_TEMPLATE % name
+    template.use_fake_user = True
+
+    # Set the new object as active, then rotate, scale, and translate it
+    bpy.context.scene.objects.active = obj
+    bpy.context.object.rotation_euler[2] = theta
+    bpy.ops.transform.resize(value=(scale, scale, scale))
+    bpy.ops.transform.translate(value=(x, y, scale))
+  else:
+    # Each object gets its own copy of the mesh, since materials are attached
+    # to the mesh
+    obj = template.copy()
+    obj.data = template.data.copy()
+    obj.name = new_name
+    obj.use_fake_user = False
+    bpy.context.scene.objects.link(obj)
+    for o in bpy.context.scene.objects:
+      o.select = False
+    obj.select = True
+
+    # Same as the transforms above, given that the template has unit size and
+    # is centered at the origin
+    bpy.context.scene.objects.active = obj
+    obj.rotation_euler[2] = theta
+    obj.scale = (scale, scale, scale)
+    obj.location = (x, y, scale)
 
 def make_invisible(ob):
   for child in ob.children:
@@ -160,57 +219,62 @@ def load_font(text):
   text.data.font = font
 
 
-def add_text(body, random_rotation, cams):
-
-
-  # Take the current object and "increase the resolution"
-  obj = bpy.context.active_object
-  bpy.ops.object.modifier_add(type='SUBSURF')
-  bpy.context.active_object.modifiers['Subsurf'].levels = 2  # View
-  bpy.context.active_object.modifiers['Subsurf'].render_levels = 2  # Render
-  bpy.context.active_object.modifiers['Subsurf'].subdivision_type = "SIMPLE"
-
-  # Create the text at the location where the object is
-  loc = obj.location.copy()
-  loc[2] = loc[2] - 0.2
-  bpy.ops.object.text_add(location=loc)
-  text = bpy.context.active_object
-  text.data.body = body
-  text.data.extrude = 0.0
-  text.data.size = 1.0#0.5
-  text.data.align_x = "CENTER"
-  bpy.context.scene.update()
-
-  # Increase text mesh resolution and rotate
-  bpy.ops.object.modifier_add(type='SUBSURF')
-  bpy.context.active_object.modifiers['Subsurf'].levels = 3  # View
-  bpy.context.active_object.modifiers['Subsurf'].render_levels = 3  # Render
-  bpy.context.active_object.modifiers['Subsurf'].subdivision_type = "SIMPLE"
-
-  bpy.ops.object.modifier_add(type='SHRINKWRAP')
-  bpy.context.active_object.modifiers['Shrinkwrap'].target = obj
-  bpy.context.active_object.modifiers['Shrinkwrap'].offset = 0.01
-  bpy.context.active_object.modifiers['Shrinkwrap'].wrap_method = "PROJECT"
-  bpy.context.active_object.modifiers['Shrinkwrap'].use_project_z = True
-  bpy.context.active_object.modifiers['Shrinkwrap'].use_project_x = True
-  bpy.context.active_object.modifiers['Shrinkwrap'].use_positive_direction = True
-  bpy.context.active_object.modifiers['Shrinkwrap'].use_negative_direction = False
-  if random_rotation:
-    rot = random.random() * math.pi
-  else:
-    rot = random.random() * -0.5
-
-  text.rotation_euler = (1.5, 0, rot)
-  bpy.context.scene.update()
-
-  # copy the existing text then break into characters
-  bpy.ops.object.duplicate()
-  bpy.ops.object.convert(target="MESH")
-  bpy.ops.object.mode_set(mode='EDIT')
-  bpy.ops.mesh.select_all(action='SELECT')
-  bpy.ops.mesh.separate(type='LOOSE')
-  bpy.ops.object.mode_set(mode='OBJECT')
-  bpy.context.scene.update()
+def add_text(body, random_rotation, cams, rotation=None):
+
+
+  with metrics.timer('subdivide'):
+    # Take the current object and "increase the resolution"
+    obj = bpy.context.active_object
+    bpy.ops.object.modifier_add(type='SUBSURF')
+    bpy.context.active_object.modifiers['Subsurf'].levels = 2  # View
+    bpy.context.active_object.modifiers['Subsurf'].render_levels = 2  # Render
+    bpy.context.active_object.modifiers['Subsurf'].subdivision_type = "SIMPLE"
+
+    # Create the text at the location where the object is
+    loc = obj.location.copy()
+    loc[2] = loc[2] - 0.2
+    bpy.ops.object.text_add(location=loc)
+    text = bpy.context.active_object
+    text.data.body = body
+    text.data.extrude = 0.0
+    text.data.size = 1.0#0.5
+    text.data.align_x = "CENTER"
+    bpy.context.scene.update()
+
+    # Increase text mesh resolution and rotate
+    bpy.ops.object.modifier_add(type='SUBSURF')
+    bpy.context.active_object.modifiers['Subsurf'].levels = 3  # View
+    bpy.context.active_object.modifiers['Subsurf'].render_levels = 3  # Render
+    bpy.context.active_object.modifiers['Subsurf'].subdivision_type = "SIMPLE"
+
+    bpy.ops.object.modifier_add(type='SHRINKWRAP')
+    bpy.context.active_object.modifiers['Shrinkwrap'].target = obj
+    bpy.context.active_object.modifiers['Shrinkwrap'].offset = 0.01
+    bpy.context.active_object.modifiers['Shrinkwrap'].wrap_method = "PROJECT"
+    bpy.context.active_object.modifiers['Shrinkwrap'].use_project_z = True
+    bpy.context.active_object.modifiers['Shrinkwrap'].use_project_x = True
+    bpy.context.active_object.modifiers['Shrinkwrap'].use_positive_direction = True
+    bpy.context.active_object.modifiers['Shrinkwrap'].use_negative_direction = False
+    # The rotation about the z axis is chosen at random unless given
+    if rotation is not None:
+      rot = rotation
+    elif random_rotation:
+      rot = random.random() * math.pi
+    else:
+      rot = random.random() * -0.5
+
+    text.rotation_euler = (1.5, 0, rot)
+    bpy.context.scene.update()
+
+  with metrics.timer('separate_chars'):
+    # copy the existing text then break into characters
+    bpy.ops.object.duplicate()
+    bpy.ops.object.convert(target="MESH")
+    bpy.ops.object.mode_set(mode='EDIT')
+    bpy.ops.mesh.select_all(action='SELECT')
+    bpy.ops.mesh.separate(type='LOOSE')
+    bpy.ops.object.mode_set(mode='OBJECT')
+    bpy.context.scene.update()
 
   chars = bpy.context.selected_objects
   bpy.ops.object.origin_set(type='ORIGIN_CENTER_OF_MASS', center='BOUNDS')
@@ -221,16 +285,17 @@ def add_text(body, random_rotation, cams):
     print("wrong number of meshes")
     raise Exception
 
-  char_bboxes = {cam.name: [] for cam in cams}
-  word_bboxes = {cam.name: [] for cam in cams}
-  for cam in cams:
-    for i, o in enumerate(chars):
-      bbox_coords = bounds(cam, o)
-      o_loc = get_camera_coords(cam, o.location)
-      char_bboxes[cam.name].append({"center": o_loc, "bbox": bbox_coords, "id": o.data.name, 'visible_pixels': 0})
-      make_invisible(o)
-    char_bboxes[cam.name] = id_chars(text, char_bboxes[cam.name])
-    word_bboxes[cam.name] = make_scale_word_bbox(char_bboxes[cam.name])
+  with metrics.timer('char_bboxes'):
+    char_bboxes = {cam.name: [] for cam in cams}
+    word_bboxes = {cam.name: [] for cam in cams}
+    for cam in cams:
+      for i, o in enumerate(chars):
+        bbox_coords = bounds(cam, o)
+        o_loc = get_camera_coords(cam, o.location)
+        char_bboxes[cam.name].append({"center": o_loc, "bbox": bbox_coords, "id": o.data.name, 'visible_pixels': 0})
+        make_invisible(o)
+      char_bboxes[cam.name] = id_chars(text, char_bboxes[cam.name])
+      word_bboxes[cam.name] = make_scale_word_bbox(char_bboxes[cam.name])
   make_visible(text)
   text.data.extrude = 0.03
 
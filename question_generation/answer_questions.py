@@ -0,0 +1,268 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json
+import multiprocessing
+from collections import defaultdict
+import question_engine as qeng
+import scene_io
+
+"""
+Answer the programs of existing questions on other views of their scenes.
+Input is a questions file from generate_questions.py and a scenes file, and
+output is a JSON-lines file with the answer of every question on every
+requested view of its scene, so that view-conditioned answers can be produced
+without generating questions again; the scenes may also differ from those the
+questions were generated on, for example if objects were perturbed.
+
+Questions are matched to scenes by the image_filename of the canonical view
+("cc"). All questions about a scene are merged into one program (see
+question_engine.ProgramBatch), so that sub-programs shared between them are
+only executed once per view, and object sets are represented as bitmasks.
+"""
+
+
+parser = argparse.ArgumentParser()
+
+# Inputs
+parser.add_argument('--input_questions_file',
+    default='../output/CLEVR_questions.json',
+    help="JSON file containing questions from generate_questions.py; files " +
+         "ending in .jsonl are read as JSON-lines. Questions are read in " +
+         "step with the scenes, so if they are in the same order as the " +
+         "scenes (as written by generate_questions.py) only the questions " +
+         "about one scene are held in memory at a time")
+parser.add_argument('--input_scene_file', default='../output/CLEVR_scenes.json',
+    help="JSON file containing ground-truth scene information for all images " +
+         "from render_images.py. Scenes are read one at a time; files ending " +
+         "in .jsonl are read as JSON-lines (see scene_io.py)")
+
+# Output
+parser.add_argument('--output_answers_file',
+    default='../output/CLEVR_answers.jsonl',
+    help="The output file to write. The info of the questions file is " +
+         "written on the first line, followed by one line per question with " +
+         "its question_index, image_index, image_filename and the answer on " +
+         "each view")
+
+# Control which views and scenes to process
+parser.add_argument('--views', default=None,
+    help="Comma-separated names of the views on which to answer questions, " +
+         "e.g. cc,cam0,cam1. By default every view of each scene is used")
+parser.add_argument('--scene_start_idx', default=0, type=int,
+    help="The scene at which to start answering questions. Earlier scenes " +
+         "are skipped unparsed in a .jsonl scene file but decoded in a " +
+         "single JSON file, so use .jsonl input for sharded runs")
+parser.add_argument('--num_scenes', default=0, type=int,
+    help="The number of scenes for which to answer questions. Setting to 0 " +
+         "answers questions for all scenes in the input file starting from " +
+         "--scene_start_idx")
+
+# Misc
+parser.add_argument('--workers', default=1, type=int,
+    help="The number of processes to use. Scenes are split into shards of " +
+         "--shard_size scenes which are answered by a pool of processes")
+parser.add_argument('--shard_size', default=100, type=int,
+    help="The number of scenes sent to a worker process at a time")
+
+
+def iter_question_groups(path):
+  """
+  Read the programs of the questions in a questions file one at a time, and
+  yield (image_filename, questions) for each run of consecutive questions
+  about the same image, where questions is a list of (question_index,
+  image_index, nodes, answer) tuples in the order of the file.
+  """
+  filename, group = None, []
+  for i, q in enumerate(scene_io.iter_questions(path)):
+    if q['image_filename'] != filename and group:
+      yield filename, group
+      group = []
+    filename = q['image_filename']
+    group.append((
+      q.get('question_index', i),
+      q.get('image_index'),
+      qeng.program_to_nodes(q['program']),
+      q.get('answer'),
+    ))
+  if group:
+    yield filename, group
+
+
+def pair_questions(get_scenes, groups, counts):
+  """
+  Pair scenes with the questions about them. get_scenes returns a new
+  iterator over the scenes each time it is called, and groups is an iterator
+  as returned by iter_question_groups. Yields (scene, questions) pairs for
+  the scenes that have questions.
+
+  The scenes are read once up front to find the position of each image.
+  After that question groups are only read until one about a later scene
+  turns up, so if the questions are in the same order as the scenes just the
+  questions about the current scene are held in memory; groups about later
+  scenes wait until their scene is reached. Questions that come after their
+  scene in the questions file are answered in a second pass over the scenes
+  at the end. counts['questions'] is set to the number of questions read and
+  counts['unmatched'] to the number about images that are not in the scenes.
+  """
+  positions = {scene['cc']['image_filename']: pos
+               for pos, scene in enumerate(get_scenes())}
+  pending = defaultdict(list)
+  latest = -1
+  for pos, scene in enumerate(get_scenes()):
+    while latest <= pos:
+      group = next(groups, None)
+      if group is None:
+        break
+      filename, questions = group
+      counts['questions'] += len(questions)
+      if filename not in positions:
+        counts['unmatched'] += len(questions)
+        continue
+      pending[filename].extend(questions)
+      latest = positions[filename]
+    questions = pending.pop(scene['cc']['image_filename'], [])
+    if questions:
+      yield scene, questions
+  if pending:
+    for scene in get_scenes():
+      questions = pending.pop(scene['cc']['image_filename'], [])
+      if questions:
+        yield scene, questions
+
+
+def scene_views(scene):
+  """ Names of the views of a scene, which maps view names to views """
+  return [name for name, view in scene.items()
+          if isinstance(view, dict) and 'objects' in view]
+
+
+def answer_scene(scene, programs, views=None, use_masks=True):
+  """
+  Answer the programs of several questions about a scene, each given as a
+  list of nodes, on the named views of the scene (by default all of them).
+  Returns a dict mapping each view name to the list of answers of the
+  programs on that view.
+  """
+  if views is None:
+    views = scene_views(scene)
+  batch = qeng.ProgramBatch(programs)
+  answers = {}
+  for view in views:
+    assert view in scene, 'Scene %s has no view "%s"' % (
+      scene['cc']['image_filename'], view)
+    answers[view] = batch.execute(scene[view], use_masks=use_masks)
+  return answers
+
+
+def iter_scene_answers(items, views=None):
+  """
+  Answer questions for an iterable of (scene, questions) pairs, where
+  questions is a list of tuples as yielded by iter_question_groups. Yields an
+  output record for each question.
+  """
+  for scene, questions in items:
+    answers = answer_scene(scene, [q[2] for q in questions], views)
+    for i, (question_index, image_index, _, answer) in enumerate(questions):
+      yield {
+        'question_index': question_index,
+        'image_index': image_index,
+        'image_filename': scene['cc']['image_filename'],
+        'answer': answer,
+        'answers': {view: view_answers[i]
+                    for view, view_answers in answers.items()},
+      }
+
+
+# The views to answer on in a worker process, set once by _init_worker
+_worker_context = {}
+
+
+def _init_worker(views):
+  _worker_context['views'] = views
+
+
+def _process_shard(items):
+  return list(iter_scene_answers(items, _worker_context['views']))
+
+
+def iter_shards(items, shard_size):
+  shard = []
+  for item in items:
+    shard.append(item)
+    if len(shard) == shard_size:
+      yield shard
+      shard = []
+  if shard:
+    yield shard
+
+
+def iter_answers(items, views, workers, shard_size):
+  """
+  Answer questions for (scene, questions) pairs as iter_scene_answers does,
+  using a pool of processes if workers > 1. Records are yielded in scene
+  order either way.
+  """
+  if workers <= 1:
+    for record in iter_scene_answers(items, views):
+      yield record
+    return
+  pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                              initargs=(views,))
+  try:
+    for records in pool.imap(_process_shard, iter_shards(items, shard_size)):
+      for record in records:
+        yield record
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+
+def main(args):
+  views = args.views.split(',') if args.views else None
+  info = scene_io.read_scene_info(args.input_questions_file)
+
+  # Stream scenes and questions from the input files, pairing each scene
+  # with its questions
+  def get_scenes():
+    return scene_io.iter_scenes(args.input_scene_file,
+                                start_idx=args.scene_start_idx,
+                                num_scenes=args.num_scenes)
+  groups = iter_question_groups(args.input_questions_file)
+  counts = defaultdict(int)
+  items = pair_questions(get_scenes, groups, counts)
+
+  num_answered = 0
+  num_changed = defaultdict(int)
+  num_per_view = defaultdict(int)
+  with open(args.output_answers_file, 'w') as f:
+    f.write(json.dumps({'info': info}) + '\n')
+    for record in iter_answers(items, views, args.workers, args.shard_size):
+      f.write(json.dumps(record) + '\n')
+      num_answered += 1
+      for view, answer in record['answers'].items():
+        num_per_view[view] += 1
+        if answer != record['answer']:
+          num_changed[view] += 1
+
+  print('Read %d questions' % counts['questions'])
+  print('Wrote answers to %d questions to %s' % (num_answered,
+                                                args.output_answers_file))
+  for view in sorted(num_per_view):
+    print('%s: %d of %d answers differ from the stored answer' % (
+      view, num_changed[view], num_per_view[view]))
+  if args.num_scenes == 0 and args.scene_start_idx == 0 and counts['unmatched']:
+    print('No scene found for %d questions' % counts['unmatched'])
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)
@@ -4,42 +4,43 @@ import time
 import re
 from collections import defaultdict
 import question_engine as qeng
+import scene_io
 
 
 parser = argparse.ArgumentParser()
 
 # Inputs
-# parser.add_argument('--input_scene_file', default='../output/CLEVR_scenes.json',
-#     help="JSON file containing ground-truth scene information for all images " +
-#          "from render_images.py")
-parser.add_argument('--input_data_dir',
+parser.add_argument('--input_scene_file', default=None,
     help="JSON file containing ground-truth scene information for all images " +
-         "from render_images.py")
+         "from render_images.py; files ending in .jsonl are read as JSON-lines")
+parser.add_argument('--input_data_dir',
+    help="Directory whose subdirectories each contain a scenes.json file; " +
+         "used if --input_scene_file is not given")
 
 # Output
 parser.add_argument('--output_ocr_file',
     default='../output/CLEVR_questions.json',
     help="The output file to write containing generated questions")
 
-def main(args):
-    try:
-        with open(args.input_scene_file, 'r') as f:
-                scene_data = json.load(f)
-                all_scenes = scene_data['scenes']
-    except Exception:
-        all_scenes = []
-        path = args.input_data_dir
-        # path = args.input_scene_file # "/".join(args.input_scene_file.split("/")[:-1])
+def iter_all_scenes(args):
+    # Scenes are streamed one at a time so that memory use does not depend on
+    # the size of the scene files
+    if args.input_scene_file is not None:
+        for scene in scene_io.iter_scenes(args.input_scene_file):
+            yield scene
+        return
 
-        for subdir in os.listdir(path):
-            if not os.path.isdir(os.path.join(path, subdir)):
-                continue
-            with open(os.path.join(path, subdir, "scenes.json"), 'r') as f:
-                scene_data = json.load(f)
-                all_scenes.extend(scene_data['scenes'])
+    path = args.input_data_dir
+    for subdir in os.listdir(path):
+        if not os.path.isdir(os.path.join(path, subdir)):
+            continue
+        for scene in scene_io.iter_scenes(os.path.join(path, subdir, "scenes.json")):
+            yield scene
 
+
+def main(args):
     tokens = []
-    for i, scene in enumerate(all_scenes):
+    for i, scene in enumerate(iter_all_scenes(args)):
         scene_fn = scene['cc']['image_filename']
         split = os.path.splitext(scene_fn)[0].split('_')
         if split[-1][0] == 'c':
@@ -51,8 +52,7 @@ def main(args):
         scene_tokens = []
         for object in view_struct['objects']:
             scene_tokens.append({'body': object['text']['body'], 'pixel_coords': object['text']['pixel_coords']})
-        print('starting image %s (%d / %d)'
-              % (scene_fn, i + 1, len(all_scenes)))
+        print('starting image %s (%d)' % (scene_fn, i + 1))
         tokens.append(scene_tokens)
 
     with open(args.output_ocr_file, 'w') as f:
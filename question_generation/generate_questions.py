@@ -8,9 +8,12 @@
 from __future__ import print_function
 import argparse, json, os, itertools, random, shutil, string
 import time
-import re
+import multiprocessing
 from collections import defaultdict
 import question_engine as qeng
+import scene_io
+import template_compiler as tc
+from question_writer import QuestionWriter
 
 """
 Generate synthetic questions and answers for CLEVR images. Input is a single
@@ -47,7 +50,8 @@ parser = argparse.ArgumentParser()
 # Inputs
 parser.add_argument('--input_scene_file', default='../output/CLEVR_scenes.json',
     help="JSON file containing ground-truth scene information for all images " +
-         "from render_images.py")
+         "from render_images.py. Scenes are read one at a time; files ending " +
+         "in .jsonl are read as JSON-lines (see scene_io.py)")
 parser.add_argument('--metadata_file', default='metadata.json',
     help="JSON file containing metadata about functions")
 parser.add_argument('--synonyms_json', default='synonyms.json',
@@ -58,12 +62,20 @@ parser.add_argument('--template_dir', default='CLEVR_1.0_templates',
 # Output
 parser.add_argument('--output_questions_file',
     default='../output/CLEVR_questions.json',
-    help="The output file to write containing generated questions")
+    help="The output file to write containing generated questions. If it " +
+         "ends in .jsonl then a JSON-lines file is written, with the info " +
+         "on the first line and one question per line after that")
+parser.add_argument('--resume', action='store_true',
+    help="Continue from the checkpoint left next to --output_questions_file " +
+         "by a previous run that did not finish. All other flags should be " +
+         "the same as for that run.")
 
 # Control which and how many images to process
 parser.add_argument('--scene_start_idx', default=0, type=int,
     help="The image at which to start generating questions; this allows " +
-         "question generation to be split across many workers")
+         "question generation to be split across many workers. Earlier " +
+         "scenes are skipped unparsed in a .jsonl scene file but decoded in " +
+         "a single JSON file, so use .jsonl input for sharded runs")
 parser.add_argument('--num_scenes', default=0, type=int,
     help="The number of images for which to generate questions. Setting to data " +
          "generates questions for all scenes in the input file starting from " +
@@ -82,78 +94,127 @@ parser.add_argument('--reset_counts_every', default=250, type=int,
     help="How often to reset template and answer counts. Higher values will " +
          "result in flatter distributions over templates and answers, but " +
          "will result in longer runtimes.")
+parser.add_argument('--workers', default=1, type=int,
+    help="The number of processes to use for question generation. Scenes are " +
+         "split into shards of --reset_counts_every scenes, so values larger " +
+         "than the number of shards will not give any further speedup.")
+parser.add_argument('--seed', default=None, type=int,
+    help="If given then reseed the random number generator at the start of " +
+         "every block of --reset_counts_every scenes, so that the output " +
+         "is reproducible and does not depend on --workers")
+parser.add_argument('--use_bitsets', action='store_true',
+    help="Represent object sets as integer bitmasks rather than lists of " +
+         "object indices while searching for template instantiations; this " +
+         "is faster and gives the same output")
 parser.add_argument('--verbose', action='store_true',
     help="Print more verbose output")
 parser.add_argument('--time_dfs', action='store_true',
     help="Time each depth-first search; must be given with --verbose")
 parser.add_argument('--profile', action='store_true',
     help="If given then run inside cProfile")
+parser.add_argument('--dfs_max_states', default=0, type=int,
+    help="If positive then stop searching for instantiations of a template " +
+         "on a scene after expanding this many states, keeping the " +
+         "instantiations found so far. This bounds the time spent on " +
+         "templates with few or no valid instantiations on a scene.")
+parser.add_argument('--dfs_max_ms', default=0, type=float,
+    help="If positive then stop searching for instantiations of a template " +
+         "on a scene after this many milliseconds, keeping the " +
+         "instantiations found so far. Unlike --dfs_max_states the output " +
+         "then depends on the speed of the machine.")
+parser.add_argument('--dfs_stats_file', default=None,
+    help="If given then write a JSON report to this file with statistics of " +
+         "the template search for each template, summed over all scenes: " +
+         "attempts, hits and misses, time taken, states expanded, states " +
+         "pruned by each type of constraint and rejected instantiations")
+
+
+def eval_feasibility_expr(expr, scene_index, cache):
+  """
+  Evaluate an expression from template_compiler.feasibility_checks on a scene;
+  set expressions give a list of the masks of the sets the node may output
+  (None for any set) and object expressions the mask of the objects it may
+  output.
+  Results are kept in cache, which should be shared by all templates tried
+  on the same scene since they have many expressions in common.
+  """
+  if expr is None:
+    return None
+  if expr in cache:
+    return cache[expr]
+  kind = expr[0]
+  if kind == 'scene':
+    result = [scene_index.all_objects]
+  elif kind == 'all_text':
+    result = all('text' in obj for obj in scene_index.objects)
+  elif kind == 'text':
+    objects = eval_feasibility_expr(expr[1], scene_index, cache)
+    if objects is None:
+      objects = scene_index.all_objects
+    result = any('text' in scene_index.objects[idx]
+                 for idx in qeng.mask_to_list(objects))
+  elif kind in ('relate', 'same'):
+    objects = eval_feasibility_expr(expr[-1], scene_index, cache)
+    if objects is None:
+      objects = scene_index.all_objects
+    if kind == 'relate':
+      all_masks = [scene_index.relate_masks(r)
+                   for r in scene_index.relationships]
+    else:
+      all_masks = [scene_index.same_attr_masks(expr[1])]
+    result = list(set(masks[idx] for masks in all_masks
+                      for idx in qeng.mask_to_list(objects)))
+  elif kind == 'unique':
+    sets = eval_feasibility_expr(expr[1], scene_index, cache)
+    if sets is None:
+      result = scene_index.all_objects
+    else:
+      # The objects that some filter picks out on its own from one of the sets
+      filter_masks = scene_index.filter_masks(expr[2]).values()
+      result = 0
+      for object_set in sets:
+        for mask in filter_masks:
+          picked = object_set & mask
+          if qeng.mask_size(picked) == 1:
+            result |= picked
+  else:
+    assert False, 'Unrecognized feasibility expression "%s"' % kind
+  cache[expr] = result
+  return result
 
 
-def precompute_filter_options(view_struct, metadata, template=None):
-  # Keys are tuples (size, color, shape, material) (where some may be None)
-  # and values are lists of object idxs that match the filter criterion
-  attribute_map = {}
-
-
-  attr_keys = ['size', 'color', 'material', 'shape']
-  attr_mask_keys = attr_keys
-  if template:
-    requires_text = bool(template.get("require_text", False))
-    if requires_text:
-      attr_mask_keys = attr_keys
-      attr_keys = ['size', 'color', 'material', 'shape', 'text']
-
-  # Precompute masks
-  masks = []
-  for i in range(2 ** len(attr_mask_keys)):
-    mask = []
-    for j in range(len(attr_mask_keys)):
-      mask.append((i // (2 ** j)) % 2)
-    if len(attr_mask_keys) != len(attr_keys):
-      mask.append(1)
-    masks.append(mask)
-  for object_idx, obj in enumerate(view_struct['objects']):
-    if metadata['dataset'] == 'CLEVR-v1.0':
-      keys = [tuple(obj[k] for k in attr_keys)]
-    elif metadata['dataset'] == "CLEVR_TEXT":
-      keys = []
-      for k in attr_keys:
-        if k == "text":
-          keys.append(obj[k]['body'])
-        else:
-          keys.append(obj[k])
-      keys = [tuple(keys)]
-    for mask in masks:
-      for key in keys:
-        masked_key = []
-        for a, b in zip(key, mask):
-          if b == 1:
-            masked_key.append(a)
-          else:
-            masked_key.append(None)
-        masked_key = tuple(masked_key)
-        if masked_key not in attribute_map:
-          attribute_map[masked_key] = set()
-        attribute_map[masked_key].add(object_idx)
-
-  view_struct['_filter_options'] = attribute_map
-
-
-def find_filter_options(object_idxs, view_struct, metadata, template):
-  # Keys are tuples (size, color, shape, material) (where some may be None)
-  # and values are lists of object idxs that match the filter criterion
-  if '_filter_options' not in view_struct:
-    precompute_filter_options(view_struct, metadata, template)
-
+def template_feasible(template, scene_index, cache):
+  """
+  Check whether a template can possibly be instantiated on a scene, using
+  the conditions from template_compiler.feasibility_checks. If this returns
+  False then the template has no instantiations on the scene; if it returns
+  True it may still have none. cache should be a dict shared by all templates
+  tried on the scene.
+  """
+  for check in template.feasibility_checks:
+    if not eval_feasibility_expr(check, scene_index, cache):
+      return False
+  return True
+
+
+def find_filter_options(object_idxs, scene_index, template, use_masks=False):
+  # Keys are tuples (size, color, material, shape) (where some may be None),
+  # with an extra text entry for templates that require text, and values are
+  # lists of object idxs that match the filter criterion; if use_masks is True
+  # then object_idxs and the values are object bitmasks.
+  filter_masks = scene_index.filter_masks(template.requires_text)
+  if use_masks:
+    return {k: object_idxs & mask for k, mask in filter_masks.items()}
+
+  object_mask = qeng.list_to_mask(object_idxs)
   attribute_map = {}
-  object_idxs = set(object_idxs)
-  for k, vs in view_struct['_filter_options'].items():
-    attribute_map[k] = sorted(list(object_idxs & vs))
+  for k, mask in filter_masks.items():
+    attribute_map[k] = qeng.mask_to_list(object_mask & mask)
   return attribute_map
 
 
-def add_empty_filter_options(attribute_map, metadata, num_to_add):
+def add_empty_filter_options(attribute_map, metadata, num_to_add,
+                             use_masks=False):
   # Add some filtering criterion that do NOT correspond to objects
 
   if metadata['dataset'] == 'CLEVR-v1.0':
@@ -171,30 +232,32 @@ def add_empty_filter_options(attribute_map, metadata, num_to_add):
   while len(attribute_map) < target_size:
     k = (random.choice(v) for v in attr_vals)
     if k not in attribute_map:
-      attribute_map[k] = []
+      attribute_map[k] = 0 if use_masks else []
 
 
-def find_relate_filter_options(object_idx, view_struct, metadata,
-    unique=False, include_zero=False, trivial_frac=0.1):
+def find_relate_filter_options(object_idx, scene_index, template,
+    unique=False, include_zero=False, trivial_frac=0.1, use_masks=False):
   options = {}
-  if '_filter_options' not in view_struct:
-    precompute_filter_options(view_struct, metadata)
+  filter_masks = scene_index.filter_masks(template.requires_text)
 
   # TODO: Right now this is only looking for nontrivial combinations; in some
   # cases I may want to add trivial combinations, either where the intersection
   # is empty or where the intersection is equal to the filtering output.
   trivial_options = {}
-  for relationship in view_struct['relationships']:
-    related = set(view_struct['relationships'][relationship][object_idx])
-    for filters, filtered in view_struct['_filter_options'].items():
+  for relationship in scene_index.relationships:
+    related = scene_index.relate_masks(relationship)[object_idx]
+    for filters, filtered in filter_masks.items():
       intersection = related & filtered
       trivial = (intersection == filtered)
-      if unique and len(intersection) != 1: continue
-      if not include_zero and len(intersection) == 0: continue
+      num_objects = qeng.mask_size(intersection)
+      if unique and num_objects != 1: continue
+      if not include_zero and num_objects == 0: continue
+      if not use_masks:
+        intersection = qeng.mask_to_list(intersection)
       if trivial:
-        trivial_options[(relationship, filters)] = sorted(list(intersection))
+        trivial_options[(relationship, filters)] = intersection
       else:
-        options[(relationship, filters)] = sorted(list(intersection))
+        options[(relationship, filters)] = intersection
 
   N, f = len(options), trivial_frac
   num_trivial = int(round(N * f / (1 - f)))
@@ -252,11 +315,38 @@ def other_heuristic(text, param_vals):
 
 
 def instantiate_templates_dfs(view_struct, template, metadata, answer_counts,
-                              synonyms, max_instances=None, verbose=False):
-
-  param_name_to_type = {p['name']: p['type'] for p in template['params']}
+                              synonyms, max_instances=None, verbose=False,
+                              use_masks=False, scene_index=None, stats=None,
+                              max_states=None, deadline=None):
+  """
+  Search for up to max_instances instantiations of template, a compiled
+  template (see template_compiler.py), on a scene.
+
+  The search gives up once it has expanded max_states states, or once
+  time.time() passes deadline, returning the instantiations found so far.
+
+  If stats is given then it should map names to counts (e.g. a
+  defaultdict(int)), and the counts of the following events in the search
+  are added to it (see DFS_STAT_KEYS): states popped from the stack
+  (states_expanded), states whose program is invalid on the scene
+  (invalid_states), states pruned by each type of constraint (pruned_neq,
+  pruned_null, pruned_out_neq), complete instantiations rejected by answer
+  balancing (rejected_answer_balance) or as degenerate (rejected_degenerate),
+  the instantiations that were kept (instances), and whether the search ran
+  out of budget (budget_exhausted).
+  """
+  if stats is None:
+    stats = defaultdict(int)
+  if scene_index is None:
+    scene_index = qeng.SceneIndex(view_struct)
+  set_size = qeng.mask_size if use_masks else len
+  # Each state carries the outputs of all nodes in its program that have
+  # already been executed, so that only newly added nodes are executed when
+  # the state is popped.
+  first_node = template.nodes[0]
   initial_state = {
-    'nodes': [node_shallow_copy(template['nodes'][0])],
+    'nodes': [{'type': first_node.type, 'inputs': list(first_node.inputs)}],
+    'outputs': [],
     'vals': {},
     'input_map': {0: 0},
     'next_template_node': 1,
@@ -264,63 +354,40 @@ def instantiate_templates_dfs(view_struct, template, metadata, answer_counts,
   states = [initial_state]
   final_states = []
 
+  num_states = 0
   while states:
+    if ((max_states is not None and num_states >= max_states)
+        or (deadline is not None and time.time() > deadline)):
+      stats['budget_exhausted'] += 1
+      break
     state = states.pop()
+    num_states += 1
+    stats['states_expanded'] += 1
     # Check to make sure the current state is valid
     q = {'nodes': state['nodes']}
-    outputs = qeng.answer_question(q, metadata, view_struct, state, all_outputs=True)
+    outputs = qeng.answer_question(q, metadata, view_struct, state, all_outputs=True,
+                                   cache_outputs=False, use_masks=use_masks,
+                                   prefix_outputs=state['outputs'],
+                                   scene_index=scene_index)
     answer = outputs[-1]
-    if answer == '__INVALID__': continue
+    if answer == '__INVALID__':
+      stats['invalid_states'] += 1
+      continue
 
     # Check to make sure constraints are satisfied for the current state
-    skip_state = False
-    for constraint in template['constraints']:
-      if constraint['type'] == 'NEQ':
-        p1, p2 = constraint['params']
-        v1, v2 = state['vals'].get(p1), state['vals'].get(p2)
-        if v1 is not None and v2 is not None and v1 != v2:
-          if verbose:
-            print('skipping due to NEQ constraint')
-            print(constraint)
-            print(state['vals'])
-          skip_state = True
-          break
-      elif constraint['type'] == 'NULL':
-        p = constraint['params'][0]
-        p_type = param_name_to_type[p]
-        v = state['vals'].get(p)
-        if v is not None and v is not '':
-          skip = False
-          if p_type == 'Shape' and v != 'thing': skip = True
-          if p_type != 'Shape' and v != '': skip = True
-          if skip:
-            if verbose:
-              print('skipping due to NULL constraint')
-              print(constraint)
-              print(state['vals'])
-            skip_state = True
-            break
-      elif constraint['type'] == 'OUT_NEQ':
-        i, j = constraint['params']
-        i = state['input_map'].get(i, None)
-        j = state['input_map'].get(j, None)
-        if i is not None and j is not None and outputs[i] == outputs[j]:
-          if verbose:
-            print('skipping due to OUT_NEQ constraint')
-            print(outputs[i])
-            print(outputs[j])
-          skip_state = True
-          break
-      else:
-        assert False, 'Unrecognized constraint type "%s"' % constraint['type']
-
-    if skip_state:
+    pruned = None
+    for check in template.constraints:
+      pruned = check(state, outputs, verbose)
+      if pruned is not None:
+        break
+    if pruned is not None:
+      stats[pruned] += 1
       continue
 
     # We have already checked to make sure the answer is valid, so if we have
     # processed all the nodes in the template then the current state is a valid
     # question, so add it if it passes our rejection sampling tests.
-    if state['next_template_node'] == len(template['nodes']):
+    if state['next_template_node'] == len(template.nodes):
       # Use our rejection sampling heuristics to decide whether we should
       # keep this template instantiation
       cur_answer_count = answer_counts[answer]
@@ -330,64 +397,63 @@ def instantiate_templates_dfs(view_struct, template, metadata, answer_counts,
       try:
         if cur_answer_count > 1.1 * answer_counts_sorted[-2]:
           if verbose: print('skipping due to second count')
+          stats['rejected_answer_balance'] += 1
           continue
         if cur_answer_count > 5.0 * median_count:
           if verbose: print('skipping due to median')
+          stats['rejected_answer_balance'] += 1
           continue
       except Exception:
         pass
       # If the template contains a raw relate node then we need to check for
       # degeneracy at the end
-      has_relate = any(n['type'] == 'relate' for n in template['nodes'])
-      if has_relate:
+      if template.has_relate:
         degen = qeng.is_degenerate(q, metadata, view_struct, answer=answer,
-                                   verbose=verbose)
+                                   verbose=verbose, use_masks=use_masks,
+                                   scene_index=scene_index)
         if degen:
+          stats['rejected_degenerate'] += 1
           continue
 
       answer_counts[answer] += 1
+      stats['instances'] += 1
       state['answer'] = answer
+      state['outputs'] = outputs
       final_states.append(state)
       if max_instances is not None and len(final_states) == max_instances:
         break
       continue
 
     # Otherwise fetch the next node from the template
-    # Make a shallow copy so cached _outputs don't leak ... this is very nasty
-    next_node = template['nodes'][state['next_template_node']]
-    next_node = node_shallow_copy(next_node)
-
-    special_nodes = {
-        'filter_unique', 'filter_text_unique', 'filter_count', 'filter_text_count', 'filter_exist', 'filter_text_exist',
-        'filter_text', 'filter', 'relate_filter', 'relate_filter_unique', 'relate_filter_count',
-        'relate_filter_text_count', 'relate_filter_exist'
-    }
-    if next_node['type'] in special_nodes:
-
-      if next_node['type'].startswith('relate_filter'):
-        unique = (next_node['type'] == 'relate_filter_unique')
-        include_zero = (next_node['type'] == 'relate_filter_count'
-                        or next_node['type'] == 'relate_filter_exist' or next_node['type'] == 'relate_filter_text_count')
-        filter_options = find_relate_filter_options(answer, view_struct, metadata,
-                            unique=unique, include_zero=include_zero)
+    next_node = template.nodes[state['next_template_node']]
+
+    if next_node.opcode in (tc.OP_FILTER, tc.OP_RELATE_FILTER):
+
+      if next_node.opcode == tc.OP_RELATE_FILTER:
+        filter_options = find_relate_filter_options(answer, scene_index, template,
+                            unique=next_node.unique,
+                            include_zero=next_node.include_zero,
+                            use_masks=use_masks)
       else:
-        filter_options = find_filter_options(answer, view_struct, metadata, template)
-        if next_node['type'] == 'filter':
+        filter_options = find_filter_options(answer, scene_index, template,
+                                             use_masks=use_masks)
+        if next_node.remove_null:
           # Remove null filter
           filter_options.pop((None, None, None, None), None)
-        if next_node['type'] == 'filter_unique' or next_node['type'] == 'filter_text_unique':
+        if next_node.unique:
           # Get rid of all filter options that don't result in a single object
           filter_options = {k: v for k, v in filter_options.items()
-                            if len(v) == 1}
+                            if set_size(v) == 1}
         else:
           # Add some filter options that do NOT correspond to the scene
-          if next_node['type'] == 'filter_exist' or next_node['type'] == 'filter_text_exist':
+          if next_node.add_as_many_empty:
             # For filter_exist we want an equal number that do and don't
             num_to_add = len(filter_options)
-          elif next_node['type'] == 'filter_count' or next_node['type'] == 'filter' or next_node['type'] == 'filter_text_count':
+          else:
             # For filter_count add nulls equal to the number of singletons
-            num_to_add = sum(1 for k, v in filter_options.items() if len(v) == 1)
-          add_empty_filter_options(filter_options, metadata, num_to_add)
+            num_to_add = sum(1 for k, v in filter_options.items() if set_size(v) == 1)
+          add_empty_filter_options(filter_options, metadata, num_to_add,
+                                   use_masks=use_masks)
 
       filter_option_keys = list(filter_options.keys())
       random.shuffle(filter_option_keys)
@@ -395,13 +461,8 @@ def instantiate_templates_dfs(view_struct, template, metadata, answer_counts,
         new_nodes = []
         cur_next_vals = {k: v for k, v in state['vals'].items()}
 
-        next_input = state['input_map'][next_node['inputs'][0]]
-        filter_side_inputs = next_node['side_inputs']
-        if next_node['type'].startswith('relate'):
-          param_name = next_node['side_inputs'][0] # First one should be relate
-          filter_side_inputs = next_node['side_inputs'][1:]
-          param_type = param_name_to_type[param_name]
-          assert param_type == 'Relation'
+        next_input = state['input_map'][next_node.inputs[0]]
+        if next_node.relate_param is not None:
           param_val = k[0]
           k = k[1]
           new_nodes.append({
@@ -409,11 +470,10 @@ def instantiate_templates_dfs(view_struct, template, metadata, answer_counts,
             'inputs': [next_input],
             'side_inputs': [param_val],
           })
-          cur_next_vals[param_name] = param_val
+          cur_next_vals[next_node.relate_param] = param_val
           next_input = len(state['nodes']) + len(new_nodes) - 1
-        for param_name, param_val in zip(filter_side_inputs, k):
-          param_type = param_name_to_type[param_name]
-          filter_type = 'filter_%s' % param_type.lower()
+        for (param_name, filter_type, null_value), param_val in zip(
+            next_node.filter_params, k):
           if param_val is not None:
             new_nodes.append({
               'type': filter_type,
@@ -422,53 +482,37 @@ def instantiate_templates_dfs(view_struct, template, metadata, answer_counts,
             })
             cur_next_vals[param_name] = param_val
             next_input = len(state['nodes']) + len(new_nodes) - 1
-
-          elif param_val is None:
-            if metadata['dataset'] == 'CLEVR-v1.0' and param_type == 'Shape':
-              param_val = 'thing'
-            else:
-              param_val = ''
-            cur_next_vals[param_name] = param_val
+          else:
+            cur_next_vals[param_name] = null_value
         input_map = {k: v for k, v in state['input_map'].items()}
-        extra_type = None
-        if next_node['type'].endswith('unique'):
-          extra_type = 'unique'
-        if next_node['type'].endswith('count'):
-          extra_type = 'count'
-        if next_node['type'].endswith('exist'):
-          extra_type = 'exist'
-        if extra_type is not None:
+        if next_node.extra_type is not None:
           new_nodes.append({
-            'type': extra_type,
-            'inputs': [input_map[next_node['inputs'][0]] + len(new_nodes)],
+            'type': next_node.extra_type,
+            'inputs': [input_map[next_node.inputs[0]] + len(new_nodes)],
           })
         input_map[state['next_template_node']] = len(state['nodes']) + len(new_nodes) - 1
         states.append({
           'nodes': state['nodes'] + new_nodes,
+          'outputs': outputs,
           'vals': cur_next_vals,
           'input_map': input_map,
           'next_template_node': state['next_template_node'] + 1,
         })
 
-    elif 'side_inputs' in next_node:
-      # If the next node has template parameters, expand them out
-      # TODO: Generalize this to work for nodes with more than one side input
-      assert len(next_node['side_inputs']) == 1, 'NOT IMPLEMENTED'
-
-      # Use metadata to figure out domain of valid values for this parameter.
-      # Iterate over the values in a random order; then it is safe to bail
-      # from the DFS as soon as we find the desired number of valid template
-      # instantiations.
-      param_name = next_node['side_inputs'][0]
-      param_type = param_name_to_type[param_name]
-      param_vals = metadata['types'][param_type][:]
+    elif next_node.opcode == tc.OP_PARAM:
+      # If the next node has template parameters, expand them out. Iterate
+      # over the values of the parameter's type in a random order; then it is
+      # safe to bail from the DFS as soon as we find the desired number of
+      # valid template instantiations.
+      param_name = next_node.param_name
+      param_vals = list(next_node.param_values)
       random.shuffle(param_vals)
       for val in param_vals:
         input_map = {k: v for k, v in state['input_map'].items()}
         input_map[state['next_template_node']] = len(state['nodes'])
         cur_next_node = {
-          'type': next_node['type'],
-          'inputs': [input_map[idx] for idx in next_node['inputs']],
+          'type': next_node.type,
+          'inputs': [input_map[idx] for idx in next_node.inputs],
           'side_inputs': [val],
         }
         cur_next_vals = {k: v for k, v in state['vals'].items()}
@@ -476,34 +520,23 @@ def instantiate_templates_dfs(view_struct, template, metadata, answer_counts,
 
         states.append({
           'nodes': state['nodes'] + [cur_next_node],
+          'outputs': outputs,
           'vals': cur_next_vals,
           'input_map': input_map,
           'next_template_node': state['next_template_node'] + 1,
         })
-    elif next_node['type'] == "query_text_q":
-      state['vals']['<T>'] = answer if random.random() > 0.5 else random.choice(string.ascii_lowercase)
-      input_map = {k: v for k, v in state['input_map'].items()}
-      input_map[state['next_template_node']] = len(state['nodes'])
-      next_node = {
-        'type': next_node['type'],
-        'inputs': [input_map[idx] for idx in next_node['inputs']],
-      }
-      states.append({
-        'nodes': state['nodes'] + [next_node],
-        'vals': state['vals'],
-        'input_map': input_map,
-        'next_template_node': state['next_template_node'] + 1,
-      })
-
     else:
+      if next_node.opcode == tc.OP_QUERY_TEXT_Q:
+        state['vals']['<T>'] = answer if random.random() > 0.5 else random.choice(string.ascii_lowercase)
       input_map = {k: v for k, v in state['input_map'].items()}
       input_map[state['next_template_node']] = len(state['nodes'])
       next_node = {
-        'type': next_node['type'],
-        'inputs': [input_map[idx] for idx in next_node['inputs']],
+        'type': next_node.type,
+        'inputs': [input_map[idx] for idx in next_node.inputs],
       }
       states.append({
         'nodes': state['nodes'] + [next_node],
+        'outputs': outputs,
         'vals': state['vals'],
         'input_map': input_map,
         'next_template_node': state['next_template_node'] + 1,
@@ -512,16 +545,25 @@ def instantiate_templates_dfs(view_struct, template, metadata, answer_counts,
   # Actually instantiate the template with the solutions we've found
   text_questions, structured_questions, answers = [], [], []
   for state in final_states:
-    structured_questions.append(state['nodes'])
+    outputs = state['outputs']
+    if use_masks:
+      outputs = qeng.outputs_to_lists(state['nodes'], outputs, metadata)
+    program = []
+    for node, output in zip(state['nodes'], outputs):
+      # Nodes are shared between states and with the template, so copy them
+      # before attaching outputs
+      node = node_shallow_copy(node)
+      node['_output'] = output
+      program.append(node)
+    structured_questions.append(program)
     answers.append(state['answer'])
-    text = random.choice(template['text'])
+    text_tokens = random.choice(template.text_tokens)
+    values = {}
     for name, val in state['vals'].items():
       if val in synonyms:
         val = random.choice(synonyms[val])
-      text = text.replace(name, val)
-      text = ' '.join(text.split())
-    text = replace_optionals(text)
-    text = ' '.join(text.split())
+      values[name] = val
+    text = tc.realize_text(text_tokens, values)
     text = other_heuristic(text, state['vals'])
     if ' s ' in text:
       text = text.replace(" s ", " things ")
@@ -529,118 +571,197 @@ def instantiate_templates_dfs(view_struct, template, metadata, answer_counts,
   return text_questions, structured_questions, answers
 
 
-def replace_optionals(s):
+def reset_counts(templates, metadata):
+  # Maps a template (filename, index) to the number of questions we have
+  # so far using that template
+  template_counts = {}
+  # Maps a template (filename, index) to a dict mapping the answer to the
+  # number of questions so far of that template type with that answer
+  template_answer_counts = {}
+  node_type_to_dtype = {n['name']: n['output'] for n in metadata['functions']}
+  for key, template in templates.items():
+    template_counts[key[:2]] = 0
+    final_node_type = template.nodes[-1].type
+    final_dtype = node_type_to_dtype[final_node_type]
+    answers = metadata['types'][final_dtype]
+    if final_dtype == 'Bool':
+      answers = [True, False]
+    if final_dtype == 'Integer':
+      if metadata['dataset'] == 'CLEVR-v1.0' or metadata['dataset'] == 'CLEVR_TEXT':
+        answers = list(range(0, 11))
+    if final_dtype == 'Text':
+      answers = string.ascii_lowercase
+    template_answer_counts[key[:2]] = defaultdict(int)
+    for a in answers:
+      template_answer_counts[key[:2]][a] = 0
+  return template_counts, template_answer_counts
+
+
+def encode_counts(counts):
+  """ Convert template and answer counts into a JSON-serializable list """
+  template_counts, template_answer_counts = counts
+  encoded = []
+  for key, count in template_counts.items():
+    answer_counts = list(template_answer_counts[key].items())
+    encoded.append([list(key), count, answer_counts])
+  return encoded
+
+
+def decode_counts(encoded):
+  """ Inverse of encode_counts """
+  template_counts, template_answer_counts = {}, {}
+  for key, count, answer_counts in encoded:
+    key = tuple(key)
+    template_counts[key] = count
+    template_answer_counts[key] = defaultdict(int)
+    for a, c in answer_counts:
+      template_answer_counts[key][a] = c
+  return template_counts, template_answer_counts
+
+
+# Counts recorded for each template by instantiate_templates_dfs, and by
+# iter_scene_questions for each attempt at instantiating a template on a scene
+DFS_STAT_KEYS = [
+  'states_expanded', 'invalid_states', 'pruned_neq', 'pruned_null',
+  'pruned_out_neq', 'rejected_answer_balance', 'rejected_degenerate',
+  'instances', 'budget_exhausted',
+]
+TEMPLATE_STAT_KEYS = ['attempts', 'hits', 'misses', 'seconds',
+                      'skipped_infeasible'] + DFS_STAT_KEYS
+
+
+def merge_template_stats(total, template_stats):
+  """ Add the per-template stats in template_stats to those in total """
+  for key, stats in template_stats.items():
+    total_stats = total.setdefault(key, defaultdict(int))
+    for name, value in stats.items():
+      total_stats[name] += value
+
+
+def encode_template_stats(template_stats):
+  return [[list(key), dict(stats)] for key, stats in template_stats.items()]
+
+
+def decode_template_stats(encoded):
+  template_stats = {}
+  for key, stats in encoded:
+    template_stats[tuple(key)] = defaultdict(int, stats)
+  return template_stats
+
+
+def write_dfs_stats(path, template_stats, num_scenes, num_to_print=10):
   """
-  Each substring of s that is surrounded in square brackets is treated as
-  optional and is removed with probability 0.5. For example the string
-
-  "A [aa] B [bb]"
-
-  could become any of
-
-  "A aa B bb"
-  "A  B bb"
-  "A aa B "
-  "A  B "
-
-  with probability 1/4.
+  Write the per-template search statistics gathered over num_scenes scenes to
+  a JSON file, with the templates that took the most time first, and print a
+  summary of those templates.
   """
-  pat = re.compile(r'\[([^\[]*)\]')
-
-  while True:
-    match = re.search(pat, s)
-    if not match:
-      break
-    i0 = match.start()
-    i1 = match.end()
-    if random.random() > 0.5:
-      s = s[:i0] + match.groups()[0] + s[i1:]
-    else:
-      s = s[:i0] + s[i1:]
-  return s
-
-
-def main(args):
-  with open(args.metadata_file, 'r') as f:
-    metadata = json.load(f)
-
-  if "CLEVR_TEXT" in args.template_dir:
-    metadata['dataset'] = "CLEVR_TEXT"
+  report = []
+  for (fn, idx), stats in template_stats.items():
+    row = {'template_filename': fn, 'question_family_index': idx}
+    for name in TEMPLATE_STAT_KEYS:
+      row[name] = stats.get(name, 0)
+    attempts = max(row['attempts'], 1)
+    row['hit_rate'] = row['hits'] / float(attempts)
+    row['skip_rate'] = row['skipped_infeasible'] / float(attempts)
+    row['states_per_attempt'] = row['states_expanded'] / float(attempts)
+    row['ms_per_attempt'] = 1000.0 * row['seconds'] / attempts
+    report.append(row)
+  report.sort(key=lambda row: -row['seconds'])
+  num_attempts = sum(row['attempts'] for row in report)
+  num_skipped = sum(row['skipped_infeasible'] for row in report)
+  skip_rate = num_skipped / float(max(num_attempts, 1))
+  with open(path, 'w') as f:
+    json.dump({'num_scenes': num_scenes, 'skip_rate': skip_rate,
+               'templates': report}, f, indent=2)
+
+  print('Wrote search statistics for %d templates to %s' % (len(report), path))
+  print('Skipped %d of %d attempts (%.1f%%) as infeasible without searching'
+        % (num_skipped, num_attempts, 100.0 * skip_rate))
+  print('%-40s %9s %9s %9s %12s %12s' % ('template', 'seconds', 'hit rate',
+                                         'skip rate', 'states/try', 'ms/try'))
+  for row in report[:num_to_print]:
+    name = '%s:%d' % (row['template_filename'], row['question_family_index'])
+    print('%-40s %9.2f %9.2f %9.2f %12.1f %12.2f'
+          % (name, row['seconds'], row['hit_rate'], row['skip_rate'],
+             row['states_per_attempt'], row['ms_per_attempt']))
+
+
+def encode_random_state(state):
+  version, internal_state, gauss_next = state
+  return [version, list(internal_state), gauss_next]
+
+
+def decode_random_state(encoded):
+  version, internal_state, gauss_next = encoded
+  return (version, tuple(internal_state), gauss_next)
+
+
+def rename_side_inputs(questions):
+  # Change "side_inputs" to "value_inputs" in all functions of all functional
+  # programs. My original name for these was "side_inputs" but I decided to
+  # change the name to "value_inputs" for the public CLEVR release. I should
+  # probably go through all question generation code and templates and rename,
+  # but that could be tricky and take a while, so instead I'll just do it here.
+  # To further complicate things, originally functions without value inputs did
+  # not have a "side_inputs" field at all, and I'm pretty sure this fact is used
+  # in some of the code above; however in the public CLEVR release all functions
+  # have a "value_inputs" field, and it's an empty list for functions that take
+  # no value inputs. Again this should probably be refactored, but the quick and
+  # dirty solution is to keep the code above as-is, but here make "value_inputs"
+  # an empty list for those functions that do not have "side_inputs". Gross.
+  for q in questions:
+    for f in q['program']:
+      if 'side_inputs' in f:
+        f['value_inputs'] = f['side_inputs']
+        del f['side_inputs']
+      else:
+        f['value_inputs'] = []
 
-  functions_by_name = {}
-  for f in metadata['functions']:
-    functions_by_name[f['name']] = f
-  metadata['_functions_by_name'] = functions_by_name
-  # Load templates from disk
-  # Key is (filename, file_idx)
-  num_loaded_templates = 0
-  templates = {}
-  for fn in os.listdir(args.template_dir):
-    if not fn.endswith('.json'): continue
-    with open(os.path.join(args.template_dir, fn), 'r') as f:
-      base = os.path.splitext(fn)[0]
-      for i, template in enumerate(json.load(f)):
-        num_loaded_templates += 1
-        key = (fn, i)
-        templates[key] = template
-  print('Read %d templates from disk' % num_loaded_templates)
-
-  def reset_counts():
-    # Maps a template (filename, index) to the number of questions we have
-    # so far using that template
-    template_counts = {}
-    # Maps a template (filename, index) to a dict mapping the answer to the
-    # number of questions so far of that template type with that answer
-    template_answer_counts = {}
-    node_type_to_dtype = {n['name']: n['output'] for n in metadata['functions']}
-    for key, template in templates.items():
-      template_counts[key[:2]] = 0
-      final_node_type = template['nodes'][-1]['type']
-      final_dtype = node_type_to_dtype[final_node_type]
-      answers = metadata['types'][final_dtype]
-      if final_dtype == 'Bool':
-        answers = [True, False]
-      if final_dtype == 'Integer':
-        if metadata['dataset'] == 'CLEVR-v1.0' or metadata['dataset'] == 'CLEVR_TEXT':
-          answers = list(range(0, 11))
-      if final_dtype == 'Text':
-        answers = string.ascii_lowercase
-      template_answer_counts[key[:2]] = defaultdict(int)
-      for a in answers:
-        template_answer_counts[key[:2]][a] = 0
-    return template_counts, template_answer_counts
-
-  template_counts, template_answer_counts = reset_counts()
-
-  # Read file containing input scenes
-  all_scenes = []
-  with open(args.input_scene_file, 'r') as f:
-    scene_data = json.load(f)
-    all_scenes = scene_data['scenes']
-    scene_info = scene_data['info']
-  begin = args.scene_start_idx
-  if args.num_scenes > 0:
-    end = args.scene_start_idx + args.num_scenes
-    all_scenes = all_scenes[begin:end]
-  else:
-    all_scenes = all_scenes[begin:]
 
-  # Read synonyms file
-  with open(args.synonyms_json, 'r') as f:
-    synonyms = json.load(f)
+def iter_scene_questions(scenes, templates, metadata, synonyms, scene_info,
+                         args, scene_offset=0, num_total_scenes=None,
+                         seed=None, counts=None, template_stats=None):
+  """
+  Generate questions for a contiguous run of scenes, which may be any
+  iterable of scenes. Template and answer counts are reset every
+  args.reset_counts_every scenes, counting from the start of the full run of
+  scenes; scene_offset gives the position of the first scene within that run
+  so that a shard processes exactly the same count blocks as it would in a
+  serial run. num_total_scenes is only used for progress messages.
+
+  If seed is given then the random module is reseeded at the start of every
+  count block, which makes the output independent of how the scenes are
+  sharded across workers. counts is the (template_counts,
+  template_answer_counts) pair to start from when resuming part of the way
+  through a count block. If template_stats is given then search statistics
+  for each template (see TEMPLATE_STAT_KEYS) are added to it.
+
+  Yields a (questions, counts) pair after each scene, where counts are the
+  template and answer counts after that scene. Questions do not have a
+  question_index yet; QuestionWriter assigns these.
+  """
+  if counts is None:
+    counts = reset_counts(templates, metadata)
+  template_counts, template_answer_counts = counts
 
-  questions = []
-  scene_count = 0
-  for i, scene in enumerate(all_scenes):
+  for i, scene in enumerate(scenes):
     scene_fn = scene['cc']['image_filename']
     view_struct = scene['cc']
-    print('starting image %s (%d / %d)'
-          % (scene_fn, i + 1, len(all_scenes)))
+    # Lookups shared by all templates tried on this scene
+    scene_index = qeng.SceneIndex(view_struct)
+    feasibility_cache = {}
+    scene_count = scene_offset + i
+    if num_total_scenes is None:
+      print('starting image %s (%d)' % (scene_fn, scene_count + 1))
+    else:
+      print('starting image %s (%d / %d)'
+            % (scene_fn, scene_count + 1, num_total_scenes))
 
     if scene_count % args.reset_counts_every == 0:
       print('resetting counts')
-      template_counts, template_answer_counts = reset_counts()
-    scene_count += 1
+      template_counts, template_answer_counts = reset_counts(templates, metadata)
+      if seed is not None:
+        random.seed('%s-%d' % (seed, scene_count // args.reset_counts_every))
 
     # Order templates by the number of questions we have so far for those
     # templates. This is a simple heuristic to give a flat distribution over
@@ -649,12 +770,25 @@ def main(args):
     templates_items = sorted(templates_items,
                         key=lambda x: template_counts[x[0][:2]])
     num_instantiated = 0
+    questions = []
     for (fn, idx), template in templates_items:
       if args.verbose:
         print('trying template ', fn, idx)
-      if args.time_dfs and args.verbose:
-        tic = time.time()
-
+      tic = time.time()
+      dfs_stats = None
+      if template_stats is not None:
+        dfs_stats = template_stats.setdefault((fn, idx), defaultdict(int))
+      if not template_feasible(template, scene_index, feasibility_cache):
+        if args.verbose:
+          print('template cannot be instantiated on this scene; skipping')
+        if dfs_stats is not None:
+          dfs_stats['attempts'] += 1
+          dfs_stats['misses'] += 1
+          dfs_stats['skipped_infeasible'] += 1
+        continue
+      deadline = None
+      if args.dfs_max_ms > 0:
+        deadline = tic + args.dfs_max_ms / 1000.0
       ts, qs, ans = instantiate_templates_dfs(
                       view_struct,
                       template,
@@ -662,10 +796,19 @@ def main(args):
                       template_answer_counts[(fn, idx)],
                       synonyms,
                       max_instances=args.instances_per_template,
-                      verbose=args.verbose)
+                      verbose=args.verbose,
+                      use_masks=args.use_bitsets,
+                      scene_index=scene_index,
+                      stats=dfs_stats,
+                      max_states=args.dfs_max_states or None,
+                      deadline=deadline)
+      toc = time.time()
       if args.time_dfs and args.verbose:
-        toc = time.time()
         print('that took ', toc - tic)
+      if dfs_stats is not None:
+        dfs_stats['attempts'] += 1
+        dfs_stats['hits' if len(ts) > 0 else 'misses'] += 1
+        dfs_stats['seconds'] += toc - tic
       split = os.path.splitext(scene_fn)[0].split('_')
       if split[-1][0] == 'c':
         image_index = int(split[-2][1:7])# int(os.path.splitext(scene_fn)[0].split('_')[-1])
@@ -683,7 +826,6 @@ def main(args):
           'answer': a,
           'template_filename': fn,
           'question_family_index': idx,
-          'question_index': len(questions),
         })
       if len(ts) > 0:
         if args.verbose:
@@ -695,32 +837,178 @@ def main(args):
       if num_instantiated >= args.templates_per_image:
         break
 
-  # Change "side_inputs" to "value_inputs" in all functions of all functional
-  # programs. My original name for these was "side_inputs" but I decided to
-  # change the name to "value_inputs" for the public CLEVR release. I should
-  # probably go through all question generation code and templates and rename,
-  # but that could be tricky and take a while, so instead I'll just do it here.
-  # To further complicate things, originally functions without value inputs did
-  # not have a "side_inputs" field at all, and I'm pretty sure this fact is used
-  # in some of the code above; however in the public CLEVR release all functions
-  # have a "value_inputs" field, and it's an empty list for functions that take
-  # no value inputs. Again this should probably be refactored, but the quick and
-  # dirty solution is to keep the code above as-is, but here make "value_inputs"
-  # an empty list for those functions that do not have "side_inputs". Gross.
-  for q in questions:
-    for f in q['program']:
-      if 'side_inputs' in f:
-        f['value_inputs'] = f['side_inputs']
-        del f['side_inputs']
-      else:
-        f['value_inputs'] = []
+    rename_side_inputs(questions)
+    yield questions, (template_counts, template_answer_counts)
 
-  with open(args.output_questions_file, 'w') as f:
-    print('Writing %i questions to %s' % (len(questions), args.output_questions_file))
-    json.dump({
-        'info': scene_info,
-        'questions': questions,
-      }, f)
+
+# Read-only state shared by all scene shards in a worker process; this is set
+# once per process by _init_worker so that templates, metadata and synonyms
+# are not pickled again for every shard.
+_worker_context = {}
+
+
+def _init_worker(templates, metadata, synonyms, scene_info, args):
+  _worker_context['templates'] = templates
+  _worker_context['metadata'] = metadata
+  _worker_context['synonyms'] = synonyms
+  _worker_context['scene_info'] = scene_info
+  _worker_context['args'] = args
+
+
+def _process_shard(shard):
+  scene_offset, scenes, num_total_scenes, seed = shard
+  ctx = _worker_context
+  questions = []
+  template_stats = {}
+  for scene_questions, _ in iter_scene_questions(
+      scenes, ctx['templates'], ctx['metadata'], ctx['synonyms'],
+      ctx['scene_info'], ctx['args'], scene_offset=scene_offset,
+      num_total_scenes=num_total_scenes, seed=seed,
+      template_stats=template_stats):
+    questions.extend(scene_questions)
+  return scene_offset + len(scenes), questions, template_stats
+
+
+def iter_shards(scenes, shard_size, scene_offset=0):
+  """
+  Group an iterable of scenes into lists of shard_size consecutive scenes,
+  yielding (offset of the first scene, list of scenes) pairs.
+  """
+  shard = []
+  begin = scene_offset
+  for scene in scenes:
+    shard.append(scene)
+    if len(shard) == shard_size:
+      yield begin, shard
+      begin += len(shard)
+      shard = []
+  if shard:
+    yield begin, shard
+
+
+def iter_shard_questions(scenes, templates, metadata, synonyms, scene_info,
+                         args, seed, scene_offset=0, num_total_scenes=None):
+  """
+  Split scenes into shards of args.reset_counts_every scenes, one shard per
+  count block, and generate questions for the shards in a pool of
+  args.workers processes. Since counts are reset at every block boundary
+  anyway, each shard sees exactly the same answer and template balancing as
+  in a serial run. scene_offset must therefore be at a block boundary.
+
+  scenes may be a lazy iterator; shards are only read from it as workers
+  become free to process them. Yields a (questions, num_scenes,
+  template_stats) tuple for each shard in scene order, where num_scenes is
+  the number of scenes done so far and template_stats holds the search
+  statistics of the shard.
+  """
+  assert scene_offset % args.reset_counts_every == 0, \
+    'Shards must start at a multiple of --reset_counts_every'
+  shards = ((begin, shard, num_total_scenes, seed) for begin, shard
+            in iter_shards(scenes, args.reset_counts_every, scene_offset))
+
+  pool = multiprocessing.Pool(args.workers, initializer=_init_worker,
+                              initargs=(templates, metadata, synonyms,
+                                        scene_info, args))
+  try:
+    for num_scenes, questions, template_stats in pool.imap(_process_shard,
+                                                           shards):
+      yield questions, num_scenes, template_stats
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+
+def main(args):
+  with open(args.metadata_file, 'r') as f:
+    metadata = json.load(f)
+
+  if "CLEVR_TEXT" in args.template_dir:
+    metadata['dataset'] = "CLEVR_TEXT"
+
+  functions_by_name = {}
+  for f in metadata['functions']:
+    functions_by_name[f['name']] = f
+  metadata['_functions_by_name'] = functions_by_name
+  # Load templates from disk and compile them
+  # Key is (filename, file_idx)
+  templates = tc.load_templates(args.template_dir, metadata)
+  print('Read %d templates from disk' % len(templates))
+
+  # Read synonyms file
+  with open(args.synonyms_json, 'r') as f:
+    synonyms = json.load(f)
+
+  scene_info = scene_io.read_scene_info(args.input_scene_file)
+
+  # Questions are written out after every scene along with a checkpoint; if
+  # we are resuming then pick up the state saved with the last checkpoint.
+  writer = QuestionWriter(args.output_questions_file, scene_info,
+                          resume=args.resume)
+  num_scenes_done = 0
+  seed = args.seed
+  counts = None
+  template_stats = {} if args.dfs_stats_file is not None else None
+  if writer.checkpoint is not None:
+    num_scenes_done = writer.checkpoint['num_scenes']
+    state = writer.checkpoint['state']
+    seed = state['seed']
+    if state['random_state'] is not None:
+      random.setstate(decode_random_state(state['random_state']))
+    if state['counts'] is not None:
+      counts = decode_counts(state['counts'])
+    if template_stats is not None and state.get('template_stats') is not None:
+      template_stats = decode_template_stats(state['template_stats'])
+
+  # Stream scenes from the input file one at a time rather than loading them
+  # all into memory
+  all_scenes = scene_io.iter_scenes(args.input_scene_file,
+                    start_idx=args.scene_start_idx + num_scenes_done)
+  num_total_scenes = None
+  if args.num_scenes > 0:
+    num_total_scenes = args.num_scenes
+    all_scenes = itertools.islice(all_scenes,
+                                  max(args.num_scenes - num_scenes_done, 0))
+
+  if args.workers > 1:
+    if seed is None:
+      # Shards still need distinct, reproducible seeds within this run
+      seed = random.randint(0, 2 ** 31 - 1)
+      print('using random seed %d' % seed)
+    for questions, num_scenes_done, shard_stats in iter_shard_questions(
+        all_scenes, templates, metadata, synonyms, scene_info, args, seed,
+        scene_offset=num_scenes_done, num_total_scenes=num_total_scenes):
+      writer.write(questions)
+      if template_stats is not None:
+        merge_template_stats(template_stats, shard_stats)
+      # Every shard starts from fresh counts and its own seed
+      writer.save_checkpoint(num_scenes_done, {
+        'seed': seed,
+        'random_state': None,
+        'counts': None,
+        'template_stats': (encode_template_stats(template_stats)
+                           if template_stats is not None else None),
+      })
+  else:
+    for questions, counts in iter_scene_questions(
+        all_scenes, templates, metadata, synonyms, scene_info, args,
+        scene_offset=num_scenes_done, num_total_scenes=num_total_scenes,
+        seed=seed, counts=counts, template_stats=template_stats):
+      writer.write(questions)
+      num_scenes_done += 1
+      writer.save_checkpoint(num_scenes_done, {
+        'seed': seed,
+        'random_state': encode_random_state(random.getstate()),
+        'counts': encode_counts(counts),
+        'template_stats': (encode_template_stats(template_stats)
+                           if template_stats is not None else None),
+      })
+
+  writer.finish()
+  if template_stats is not None:
+    write_dfs_stats(args.dfs_stats_file, template_stats, num_scenes_done)
 
 
 if __name__ == '__main__':
@@ -730,4 +1018,3 @@ if __name__ == '__main__':
     cProfile.run('main(args)')
   else:
     main(args)
-
@@ -16,103 +16,229 @@ in a JSON metadata file.
 """
 
 
-# Handlers for answering questions. Each handler receives the scene structure
-# that was output from Blender, the node, and a list of values that were output
-# from each of the node's inputs; the handler should return the computed output
-# value from this node.
+# Object sets can be represented either as sorted lists of object indices or
+# as integer bitmasks, where bit i of the mask is set iff object i is in the
+# set. Scenes only have a handful of objects, so with bitmasks filters, relates
+# and same_* become lookups of precomputed masks followed by AND / OR /
+# popcount.
 
 
-def scene_handler(view_struct, inputs, side_inputs):
+def mask_to_list(mask):
+  """ Convert an object set bitmask into a sorted list of object indices """
+  idxs = []
+  idx = 0
+  while mask:
+    if mask & 1:
+      idxs.append(idx)
+    mask >>= 1
+    idx += 1
+  return idxs
+
+
+def list_to_mask(idxs):
+  """ Convert an iterable of object indices into an object set bitmask """
+  mask = 0
+  for idx in idxs:
+    mask |= 1 << idx
+  return mask
+
+
+def mask_size(mask):
+  """ Number of objects in an object set bitmask """
+  return bin(mask).count('1')
+
+
+if hasattr(int, 'bit_count'):
+  # Python 3.10+ has a native popcount
+  mask_size = int.bit_count
+
+
+class SceneIndex(object):
+  """
+  Precomputed lookups for a single view of a scene. An index is built once
+  per scene and shared by every template and execute handler that runs on
+  that scene; lookups are computed on first use and then kept here rather
+  than being stashed inside the scene structure itself.
+
+  All object sets held by the index are bitmasks.
+  """
+
+  FILTER_ATTRIBUTES = ['size', 'color', 'material', 'shape']
+
+  def __init__(self, view_struct):
+    self.view_struct = view_struct
+    self.objects = view_struct['objects']
+    self.relationships = view_struct.get('relationships', {})
+    self.all_objects = (1 << len(self.objects)) - 1
+    self._attribute_masks = {}
+    self._relate_masks = {}
+    self._same_attr_masks = {}
+    self._same_attr_lists = {}
+    self._filter_masks = {}
+
+  def attribute_value(self, idx, attribute):
+    if attribute == 'text':
+      return self.objects[idx][attribute]['body']
+    return self.objects[idx][attribute]
+
+  def attribute_mask(self, attribute, value):
+    """ Mask of the objects that a filter_<attribute>[value] node keeps """
+    key = (attribute, value)
+    if key not in self._attribute_masks:
+      mask = 0
+      for idx in range(len(self.objects)):
+        atr = self.attribute_value(idx, attribute)
+        if value == atr or value in atr:
+          mask |= 1 << idx
+      self._attribute_masks[key] = mask
+    return self._attribute_masks[key]
+
+  def relate_masks(self, relation):
+    """ List giving, for each object, the mask of objects related to it """
+    if relation not in self._relate_masks:
+      related = self.relationships[relation]
+      self._relate_masks[relation] = [list_to_mask(idxs) for idxs in related]
+    return self._relate_masks[relation]
+
+  def same_attr_masks(self, attribute):
+    """
+    List giving, for each object, the mask of the other objects that have the
+    same value of attribute.
+    """
+    if attribute not in self._same_attr_masks:
+      masks = []
+      for i, obj1 in enumerate(self.objects):
+        mask = 0
+        for j, obj2 in enumerate(self.objects):
+          if i != j and obj1[attribute] == obj2[attribute]:
+            mask |= 1 << j
+        masks.append(mask)
+      self._same_attr_masks[attribute] = masks
+    return self._same_attr_masks[attribute]
+
+  def same_attr_lists(self, attribute):
+    """ Same as same_attr_masks but with lists of object indices """
+    if attribute not in self._same_attr_lists:
+      self._same_attr_lists[attribute] = [
+        mask_to_list(mask) for mask in self.same_attr_masks(attribute)]
+    return self._same_attr_lists[attribute]
+
+  def filter_masks(self, with_text=False):
+    """
+    Map filtering criteria to the mask of objects matching them. Keys are
+    tuples (size, color, material, shape) where some entries may be None,
+    meaning that the attribute is not filtered on. If with_text is True then
+    keys have a fifth entry giving the text on the object, which is never
+    None. Both key schemes are kept, so the map does not depend on which
+    template asked for it first.
+    """
+    if with_text not in self._filter_masks:
+      attr_keys = list(self.FILTER_ATTRIBUTES)
+      if with_text:
+        attr_keys.append('text')
+
+      # Each mask says which of the attributes are kept in the key
+      num_masked = len(self.FILTER_ATTRIBUTES)
+      masks = []
+      for i in range(2 ** num_masked):
+        mask = [(i // (2 ** j)) % 2 for j in range(num_masked)]
+        if with_text:
+          mask.append(1)
+        masks.append(mask)
+
+      attribute_map = {}
+      for object_idx in range(len(self.objects)):
+        key = [self.attribute_value(object_idx, k) for k in attr_keys]
+        for mask in masks:
+          masked_key = tuple(a if b == 1 else None for a, b in zip(key, mask))
+          attribute_map[masked_key] = (attribute_map.get(masked_key, 0)
+                                       | (1 << object_idx))
+      self._filter_masks[with_text] = attribute_map
+    return self._filter_masks[with_text]
+
+
+# Handlers for answering questions. Each handler receives the SceneIndex for
+# the scene structure that was output from Blender, a list of values that were
+# output from each of the node's inputs, and the node's side inputs; the
+# handler should return the computed output value from this node.
+
+
+def scene_handler(scene, inputs, side_inputs):
   # Just return all objects in the scene
-  return list(range(len(view_struct['objects'])))
+  return list(range(len(scene.objects)))
 
 
 def make_filter_handler(attribute):
-  def filter_handler(view_struct, inputs, side_inputs):
+  def filter_handler(scene, inputs, side_inputs):
     assert len(inputs) == 1
     assert len(side_inputs) == 1
     value = side_inputs[0]
     output = []
 
     for idx in inputs[0]:
-      if attribute == 'text':
-        atr = view_struct['objects'][idx][attribute]['body']
-      else:
-        atr = view_struct['objects'][idx][attribute]
+      atr = scene.attribute_value(idx, attribute)
       if value == atr or value in atr:
         output.append(idx)
     return output
   return filter_handler
 
 
-def unique_handler(view_struct, inputs, side_inputs):
+def unique_handler(scene, inputs, side_inputs):
   assert len(inputs) == 1
   if len(inputs[0]) != 1:
     return '__INVALID__'
   return inputs[0][0]
 
 
-def vg_relate_handler(view_struct, inputs, side_inputs):
+def vg_relate_handler(scene, inputs, side_inputs):
   assert len(inputs) == 1
   assert len(side_inputs) == 1
   output = set()
-  for rel in view_struct['relationships']:
+  for rel in scene.relationships:
     if rel['predicate'] == side_inputs[0] and rel['subject_idx'] == inputs[0]:
       output.add(rel['object_idx'])
   return sorted(list(output))
 
 
 
-def relate_handler(view_struct, inputs, side_inputs):
+def relate_handler(scene, inputs, side_inputs):
   assert len(inputs) == 1
   assert len(side_inputs) == 1
   relation = side_inputs[0]
-  return view_struct['relationships'][relation][inputs[0]]
+  return scene.relationships[relation][inputs[0]]
     
 
-def union_handler(view_struct, inputs, side_inputs):
+def union_handler(scene, inputs, side_inputs):
   assert len(inputs) == 2
   assert len(side_inputs) == 0
   return sorted(list(set(inputs[0]) | set(inputs[1])))
 
 
-def intersect_handler(view_struct, inputs, side_inputs):
+def intersect_handler(scene, inputs, side_inputs):
   assert len(inputs) == 2
   assert len(side_inputs) == 0
   return sorted(list(set(inputs[0]) & set(inputs[1])))
 
 
-def count_handler(view_struct, inputs, side_inputs):
+def count_handler(scene, inputs, side_inputs):
   assert len(inputs) == 1
   return len(inputs[0])
 
 
 def make_same_attr_handler(attribute):
-  def same_attr_handler(view_struct, inputs, side_inputs):
-    cache_key = '_same_%s' % attribute
-    if cache_key not in view_struct:
-      cache = {}
-      for i, obj1 in enumerate(view_struct['objects']):
-        same = []
-        for j, obj2 in enumerate(view_struct['objects']):
-          if i != j and obj1[attribute] == obj2[attribute]:
-            same.append(j)
-        cache[i] = same
-      view_struct[cache_key] = cache
-
-    cache = view_struct[cache_key]
+  def same_attr_handler(scene, inputs, side_inputs):
     assert len(inputs) == 1
     assert len(side_inputs) == 0
-    return cache[inputs[0]]
+    return scene.same_attr_lists(attribute)[inputs[0]]
   return same_attr_handler
 
 
 def make_query_handler(attribute):
-  def query_handler(view_struct, inputs, side_inputs):
+  def query_handler(scene, inputs, side_inputs):
     assert len(inputs) == 1
     assert len(side_inputs) == 0
     idx = inputs[0]
-    obj = view_struct['objects'][idx]
+    obj = scene.objects[idx]
     assert attribute in obj
     val = obj[attribute]
     if type(val) == list and len(val) != 1:
@@ -126,36 +252,36 @@ def make_query_handler(attribute):
   return query_handler
 
 
-def exist_handler(view_struct, inputs, side_inputs):
+def exist_handler(scene, inputs, side_inputs):
   assert len(inputs) == 1
   assert len(side_inputs) == 0
   return len(inputs[0]) > 0
 
 
-def equal_handler(view_struct, inputs, side_inputs):
+def equal_handler(scene, inputs, side_inputs):
   assert len(inputs) == 2
   assert len(side_inputs) == 0
   return inputs[0] == inputs[1]
 
 
-def less_than_handler(view_struct, inputs, side_inputs):
+def less_than_handler(scene, inputs, side_inputs):
   assert len(inputs) == 2
   assert len(side_inputs) == 0
   return inputs[0] < inputs[1]
 
 
-def greater_than_handler(view_struct, inputs, side_inputs):
+def greater_than_handler(scene, inputs, side_inputs):
   assert len(inputs) == 2
   assert len(side_inputs) == 0
   return inputs[0] > inputs[1]
 
 
-def q_text_handler(view_struct, inputs, side_inputs):
+def q_text_handler(scene, inputs, side_inputs):
   # This is a stub handler because this framework is only built to operate on visual information, and this module
   # is meant to operate on text from the question. It's handled in answer_question below.
   pass
 
-def query_text_terminal(view_struct, inputs, side_inputs):
+def query_text_terminal(scene, inputs, side_inputs):
   # This is a stub handler because this framework is only built to operate on visual information, and this module
   # is meant to operate on text from the question. It's handled in answer_question below.
   pass
@@ -201,8 +327,110 @@ execute_handlers = {
 }
 
 
+# Handlers that operate on bitmask object sets. Every node type whose inputs
+# or outputs include an ObjectSet is overridden here, everything else is
+# shared with execute_handlers.
+
+
+def scene_mask_handler(scene, inputs, side_inputs):
+  return scene.all_objects
+
+
+def make_filter_mask_handler(attribute):
+  def filter_mask_handler(scene, inputs, side_inputs):
+    assert len(inputs) == 1
+    assert len(side_inputs) == 1
+    return inputs[0] & scene.attribute_mask(attribute, side_inputs[0])
+  return filter_mask_handler
+
+
+def unique_mask_handler(scene, inputs, side_inputs):
+  assert len(inputs) == 1
+  mask = inputs[0]
+  # A single bit is set iff clearing the lowest set bit leaves nothing
+  if mask == 0 or mask & (mask - 1):
+    return '__INVALID__'
+  return mask.bit_length() - 1
+
+
+def relate_mask_handler(scene, inputs, side_inputs):
+  assert len(inputs) == 1
+  assert len(side_inputs) == 1
+  return scene.relate_masks(side_inputs[0])[inputs[0]]
+
+
+def union_mask_handler(scene, inputs, side_inputs):
+  assert len(inputs) == 2
+  assert len(side_inputs) == 0
+  return inputs[0] | inputs[1]
+
+
+def intersect_mask_handler(scene, inputs, side_inputs):
+  assert len(inputs) == 2
+  assert len(side_inputs) == 0
+  return inputs[0] & inputs[1]
+
+
+def count_mask_handler(scene, inputs, side_inputs):
+  assert len(inputs) == 1
+  return mask_size(inputs[0])
+
+
+def exist_mask_handler(scene, inputs, side_inputs):
+  assert len(inputs) == 1
+  assert len(side_inputs) == 0
+  return inputs[0] != 0
+
+
+def make_same_attr_mask_handler(attribute):
+  def same_attr_mask_handler(scene, inputs, side_inputs):
+    assert len(inputs) == 1
+    assert len(side_inputs) == 0
+    return scene.same_attr_masks(attribute)[inputs[0]]
+  return same_attr_mask_handler
+
+
+mask_execute_handlers = dict(execute_handlers)
+mask_execute_handlers.update({
+  'scene': scene_mask_handler,
+  'filter_color': make_filter_mask_handler('color'),
+  'filter_shape': make_filter_mask_handler('shape'),
+  'filter_material': make_filter_mask_handler('material'),
+  'filter_size': make_filter_mask_handler('size'),
+  'filter_text': make_filter_mask_handler('text'),
+  'filter_objectcategory': make_filter_mask_handler('objectcategory'),
+  'unique': unique_mask_handler,
+  'relate': relate_mask_handler,
+  'union': union_mask_handler,
+  'intersect': intersect_mask_handler,
+  'count': count_mask_handler,
+  'exist': exist_mask_handler,
+  'same_color': make_same_attr_mask_handler('color'),
+  'same_shape': make_same_attr_mask_handler('shape'),
+  'same_size': make_same_attr_mask_handler('size'),
+  'same_material': make_same_attr_mask_handler('material'),
+})
+
+
+def outputs_to_lists(nodes, outputs, metadata):
+  """
+  Convert the outputs of nodes evaluated with use_masks=True back into sorted
+  lists of object indices, so that programs look the same as they would
+  without bitmasks. Returns a new list of outputs.
+  """
+  functions_by_name = metadata['_functions_by_name']
+  converted = []
+  for node, output in zip(nodes, outputs):
+    f = functions_by_name.get(node['type'])
+    if f is not None and f['output'] == 'ObjectSet':
+      output = mask_to_list(output)
+    converted.append(output)
+  return converted
+
+
 def answer_question(question, metadata, view_struct, state=None, all_outputs=False,
-                    cache_outputs=True):
+                    cache_outputs=True, use_masks=False, prefix_outputs=None,
+                    scene_index=None):
   """
   Use structured scene information to answer a structured question. Most of the
   heavy lifting is done by the execute handlers defined above.
@@ -211,31 +439,48 @@ def answer_question(question, metadata, view_struct, state=None, all_outputs=Fal
   when we want to answer many questions that share nodes on the same scene
   (such as during question-generation DFS). This will NOT work if the same
   nodes are executed on different scenes.
+
+  If use_masks is True then object sets are represented as integer bitmasks
+  (see mask_execute_handlers); the caller is responsible for converting any
+  object set outputs back into lists with mask_to_list / outputs_to_lists.
+
+  If prefix_outputs is given then it holds the outputs of the first
+  len(prefix_outputs) nodes of the question; these nodes are not executed
+  again, and only the remaining nodes are. This lets question-generation DFS
+  evaluate each state incrementally, since every state extends the program of
+  its parent state by a few nodes.
+
+  scene_index is the SceneIndex for view_struct; callers that answer many
+  questions on the same scene should build it once and pass it in.
   """
+  if scene_index is None:
+    scene_index = SceneIndex(view_struct)
+  handlers = mask_execute_handlers if use_masks else execute_handlers
   all_input_types, all_output_types = [], []
-  node_outputs = []
-  for node in question['nodes']:
+  if prefix_outputs is None:
+    node_outputs = []
+  else:
+    node_outputs = list(prefix_outputs)
+  for node in question['nodes'][len(node_outputs):]:
     if cache_outputs and '_output' in node:
       node_output = node['_output']
     elif node['type'] == "query_text_q":
       node_output = state['vals']['<T>']
       if cache_outputs:
         node['_output'] = node_output
-      node_outputs.append(node_output)
     elif node['type'] == "query_text_terminal":
       node_inputs = [node_outputs[idx] for idx in node['inputs']]
+      node_output = scene_index.objects[node_inputs[0]]['text']['body']
       if cache_outputs:
         node['_output'] = node_output
-      node_output = view_struct['objects'][node_inputs[0]]['text']['body']
-      node_outputs.append(node_output)
     else:
       node_type = node['type']
       msg = 'Could not find handler for "%s"' % node_type
-      assert node_type in execute_handlers, msg
-      handler = execute_handlers[node_type]
+      assert node_type in handlers, msg
+      handler = handlers[node_type]
       node_inputs = [node_outputs[idx] for idx in node['inputs']]
       side_inputs = node.get('side_inputs', [])
-      node_output = handler(view_struct, node_inputs, side_inputs)
+      node_output = handler(scene_index, node_inputs, side_inputs)
       if cache_outputs:
         node['_output'] = node_output
     node_outputs.append(node_output)
@@ -247,6 +492,101 @@ def answer_question(question, metadata, view_struct, state=None, all_outputs=Fal
     return node_outputs[-1]
 
 
+def program_to_nodes(program):
+  """
+  Convert a functional program as stored in a questions file into a list of
+  nodes that can be executed by answer_question or ProgramBatch. Stored
+  programs call literal inputs "value_inputs" and give every function that
+  field (see generate_questions.rename_side_inputs), while nodes here call
+  them "side_inputs" and leave the field out for functions without any;
+  either name is accepted, as is "function" in place of "type". Outputs of
+  nodes are dropped, except for query_text_q nodes whose output comes from
+  the text of the question rather than from the scene.
+  """
+  nodes = []
+  for f in program:
+    node = {
+      'type': f['type'] if 'type' in f else f['function'],
+      'inputs': list(f['inputs']),
+    }
+    side_inputs = f.get('side_inputs', f.get('value_inputs', []))
+    if side_inputs:
+      node['side_inputs'] = list(side_inputs)
+    if node['type'] == 'query_text_q':
+      node['_output'] = f['_output']
+    nodes.append(node)
+  return nodes
+
+
+class ProgramBatch(object):
+  """
+  The programs of several questions about the same scene, merged into a
+  single program so that they can be answered together on any number of
+  views of the scene.
+
+  Nodes with the same type, side inputs and inputs are merged, so a
+  sub-program shared by several questions (for example scene, filter_color
+  [red], unique) is only executed once per view rather than once per
+  question. Programs are given as lists of nodes (see program_to_nodes).
+  """
+
+  def __init__(self, programs=()):
+    # Each node is a (type, inputs, side_inputs, output) tuple, where inputs
+    # index into self.nodes and output is only set for query_text_q nodes
+    self.nodes = []
+    self.node_idxs = {}
+    self.answer_idxs = []
+    for program in programs:
+      self.add(program)
+
+  def add(self, program):
+    """ Add a program; returns its index in the answers of execute """
+    idxs = []
+    for node in program:
+      output = None
+      if node['type'] == 'query_text_q':
+        output = node['_output']
+      key = (node['type'], tuple(idxs[i] for i in node['inputs']),
+             tuple(node.get('side_inputs', ())), output)
+      idx = self.node_idxs.get(key)
+      if idx is None:
+        idx = len(self.nodes)
+        self.node_idxs[key] = idx
+        self.nodes.append(key)
+      idxs.append(idx)
+    self.answer_idxs.append(idxs[-1])
+    return len(self.answer_idxs) - 1
+
+  def execute(self, view_struct, use_masks=True, scene_index=None):
+    """
+    Execute all programs on a view of the scene, returning the list of their
+    answers in the order they were added. Answers are the same as those of
+    answer_question, including '__INVALID__' for programs that are invalid on
+    the view. scene_index is the SceneIndex for view_struct if the caller
+    already has one.
+    """
+    if scene_index is None:
+      scene_index = SceneIndex(view_struct)
+    handlers = mask_execute_handlers if use_masks else execute_handlers
+    node_outputs = []
+    for node_type, inputs, side_inputs, output in self.nodes:
+      node_inputs = [node_outputs[idx] for idx in inputs]
+      if any(x == '__INVALID__' for x in node_inputs):
+        # answer_question stops at the first invalid node
+        node_output = '__INVALID__'
+      elif node_type == 'query_text_q':
+        node_output = output
+      elif node_type == 'query_text_terminal':
+        node_output = scene_index.objects[node_inputs[0]]['text']['body']
+      else:
+        msg = 'Could not find handler for "%s"' % node_type
+        assert node_type in handlers, msg
+        node_output = handlers[node_type](scene_index, node_inputs,
+                                          side_inputs)
+      node_outputs.append(node_output)
+    return [node_outputs[idx] for idx in self.answer_idxs]
+
+
 def insert_scene_node(nodes, idx):
   # First make a shallow-ish copy of the input
   new_nodes = []
@@ -290,20 +630,26 @@ def insert_scene_node(nodes, idx):
   return new_nodes_trimmed
 
 
-def is_degenerate(question, metadata, view_struct, answer=None, verbose=False):
+def is_degenerate(question, metadata, view_struct, answer=None, verbose=False,
+                  use_masks=False, scene_index=None):
   """
   A question is degenerate if replacing any of its relate nodes with a scene
   node results in a question with the same answer.
   """
+  if scene_index is None:
+    scene_index = SceneIndex(view_struct)
   if answer is None:
-    answer = answer_question(question, metadata, view_struct)
+    answer = answer_question(question, metadata, view_struct,
+                             use_masks=use_masks, scene_index=scene_index)
 
   for idx, node in enumerate(question['nodes']):
     if node['type'] == 'relate':
       new_question = {
         'nodes': insert_scene_node(question['nodes'], idx)
       }
-      new_answer = answer_question(new_question, metadata, view_struct)
+      new_answer = answer_question(new_question, metadata, view_struct,
+                                   use_masks=use_masks,
+                                   scene_index=scene_index)
 
       if verbose:
         print('here is truncated question:')
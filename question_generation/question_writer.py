@@ -0,0 +1,108 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import json, os
+
+"""
+Incremental writer for generated questions. Questions are appended to a
+JSON-lines file as soon as each scene is done, together with a small checkpoint
+file recording how far we got, so that a long generation job that dies part of
+the way through can be resumed rather than restarted.
+
+For an output file OUT the writer uses:
+
+- OUT.partial.jsonl: {"info": ...} on the first line, then one question per
+  line, in order.
+- OUT.checkpoint.json: the number of scenes and questions written so far, the
+  size of OUT.partial.jsonl at that point, and any extra state the caller
+  needs to continue (random state, answer counts, ...). This is replaced
+  atomically after every scene.
+
+When generation finishes, OUT is written from the partial file without loading
+all questions into memory; if OUT ends in .jsonl then it is simply the partial
+file renamed. Both intermediate files are then removed.
+"""
+
+
+class QuestionWriter(object):
+
+  def __init__(self, output_path, info, resume=False):
+    self.output_path = output_path
+    self.info = info
+    self.partial_path = output_path + '.partial.jsonl'
+    self.checkpoint_path = output_path + '.checkpoint.json'
+    self.checkpoint = None
+    self.num_questions = 0
+
+    if resume and os.path.isfile(self.checkpoint_path):
+      with open(self.checkpoint_path, 'r') as f:
+        self.checkpoint = json.load(f)
+      self.num_questions = self.checkpoint['num_questions']
+      # Drop anything written after the last checkpoint, such as questions
+      # for a scene that was only partially written
+      with open(self.partial_path, 'r+') as f:
+        f.truncate(self.checkpoint['partial_size'])
+      self.f = open(self.partial_path, 'a')
+      print('Resuming from %s: %d scenes and %d questions already written'
+            % (self.checkpoint_path, self.checkpoint['num_scenes'],
+               self.num_questions))
+    else:
+      if resume:
+        print('No checkpoint found at %s; starting from scratch'
+              % self.checkpoint_path)
+      self.f = open(self.partial_path, 'w')
+      self.f.write(json.dumps({'info': info}) + '\n')
+
+  def write(self, questions):
+    """
+    Append questions to the partial file, assigning their question_index
+    values so that they are consistent across the whole output.
+    """
+    for q in questions:
+      q['question_index'] = self.num_questions
+      self.f.write(json.dumps(q) + '\n')
+      self.num_questions += 1
+
+  def save_checkpoint(self, num_scenes, state=None):
+    """
+    Record that the first num_scenes scenes are done and all their questions
+    have been written. state must be JSON-serializable.
+    """
+    self.f.flush()
+    os.fsync(self.f.fileno())
+    self.checkpoint = {
+      'num_scenes': num_scenes,
+      'num_questions': self.num_questions,
+      'partial_size': self.f.tell(),
+      'state': state,
+    }
+    tmp_path = self.checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(self.checkpoint, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp_path, self.checkpoint_path)
+
+  def finish(self):
+    """ Write the final output file and remove the intermediate files """
+    self.f.close()
+    print('Writing %i questions to %s' % (self.num_questions, self.output_path))
+    if self.output_path.endswith('.jsonl'):
+      os.rename(self.partial_path, self.output_path)
+    else:
+      # Same layout as json.dump({'info': ..., 'questions': [...]})
+      with open(self.partial_path, 'r') as fin, open(self.output_path, 'w') as fout:
+        fin.readline()  # info
+        fout.write('{"info": %s, "questions": [' % json.dumps(self.info))
+        for i, line in enumerate(fin):
+          if i > 0:
+            fout.write(', ')
+          fout.write(line.rstrip('\n'))
+        fout.write(']}')
+      os.remove(self.partial_path)
+    if os.path.isfile(self.checkpoint_path):
+      os.remove(self.checkpoint_path)
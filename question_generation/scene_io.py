@@ -0,0 +1,182 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import json
+
+"""
+Utilities for reading scene files one scene at a time, so that peak memory does
+not grow with the number of scenes in a split.
+
+Two formats are supported:
+
+- The usual single JSON file {"info": {...}, "scenes": [...]} written by
+  render_images.py and collect_scenes.py. This is decoded incrementally, one
+  element of the "scenes" list at a time. Finding where a scene ends means
+  parsing it, so every scene before --scene_start_idx is still decoded (and
+  then dropped); sharded runs over large splits should use JSON-lines instead.
+- A JSON-lines file (any file whose name ends in .jsonl, as written by
+  collect_scenes.py) whose first line is {"info": {...}} and where every
+  following line holds a single scene. Scenes before --scene_start_idx can be
+  skipped without decoding them at all.
+
+Question files written by generate_questions.py come in the same two formats,
+with "questions" in place of "scenes"; they can be read with iter_questions,
+and their info with read_scene_info.
+"""
+
+
+class JSONStream(object):
+  """
+  Decode JSON values one at a time from a file object without reading the
+  whole file into memory. The caller drives the parse using peek / expect /
+  decode, so this only handles the structure we need to walk through.
+  """
+
+  def __init__(self, f, chunk_size=1 << 20):
+    self.f = f
+    self.chunk_size = chunk_size
+    self.buf = ''
+    self.pos = 0
+    self.decoder = json.JSONDecoder()
+
+  def _fill(self):
+    # Read at least as much as is already buffered, so that decoding a single
+    # large value takes a logarithmic number of attempts.
+    size = max(self.chunk_size, len(self.buf) - self.pos)
+    chunk = self.f.read(size)
+    if not chunk:
+      return False
+    self.buf = self.buf[self.pos:] + chunk
+    self.pos = 0
+    return True
+
+  def peek(self):
+    """ Return the next non-whitespace character without consuming it """
+    while True:
+      while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+        self.pos += 1
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      if not self._fill():
+        raise ValueError('Unexpected end of JSON input')
+
+  def expect(self, chars):
+    """ Consume the next non-whitespace character, which must be in chars """
+    c = self.peek()
+    if c not in chars:
+      raise ValueError('Expected one of "%s" but found "%s"' % (chars, c))
+    self.pos += 1
+    return c
+
+  def decode(self):
+    """ Decode and consume the next JSON value """
+    self.peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buf, self.pos)
+      except ValueError:
+        # The value is probably cut off at the end of the buffer
+        if not self._fill():
+          raise
+        continue
+      if end == len(self.buf) and self._fill():
+        # A number at the end of the buffer may continue in the next chunk
+        continue
+      self.pos = end
+      return value
+
+
+def iter_top_level(stream, list_key='scenes'):
+  """
+  Walk through a top-level {"info": ..., "scenes": [...]} object, yielding
+  (key, value) pairs. The elements of the list_key list are yielded one at a
+  time as (list_key, element) pairs rather than as a single list; this is
+  "scenes" for scene files and "questions" for question files.
+  """
+  stream.expect('{')
+  if stream.peek() == '}':
+    return
+  while True:
+    key = stream.decode()
+    stream.expect(':')
+    if key == list_key:
+      stream.expect('[')
+      if stream.peek() == ']':
+        stream.pos += 1
+      else:
+        while True:
+          yield key, stream.decode()
+          if stream.expect(',]') == ']':
+            break
+    else:
+      yield key, stream.decode()
+    if stream.expect(',}') == '}':
+      return
+
+
+def is_jsonl(path):
+  return path.endswith('.jsonl')
+
+
+def read_scene_info(path):
+  """
+  Return the "info" dict of a scenes file without keeping its scenes in
+  memory. Scene files written by this repo have "info" before "scenes", so
+  this normally stops right at the start of the file.
+  """
+  with open(path, 'r') as f:
+    if is_jsonl(path):
+      return json.loads(f.readline())['info']
+    for key, value in iter_top_level(JSONStream(f)):
+      if key == 'info':
+        return value
+  return None
+
+
+def iter_scenes(path, start_idx=0, num_scenes=0):
+  """
+  Yield the scenes in a scenes file one at a time, starting from scene
+  start_idx. If num_scenes > 0 then stop after that many scenes.
+
+  In a JSON-lines file the lines before start_idx are skipped unparsed. In a
+  single JSON file they have to be decoded to find where each one ends: a
+  pure-Python bracket scan over the raw text measured slower than the C
+  decoder, so the cost of reaching start_idx grows with start_idx there.
+  """
+  end_idx = start_idx + num_scenes if num_scenes > 0 else None
+  with open(path, 'r') as f:
+    if is_jsonl(path):
+      f.readline()  # info
+      scenes = (line for line in f if line.strip())
+    else:
+      scenes = (value for key, value in iter_top_level(JSONStream(f))
+                if key == 'scenes')
+    for idx, scene in enumerate(scenes):
+      if end_idx is not None and idx >= end_idx:
+        break
+      if idx < start_idx:
+        continue
+      if is_jsonl(path):
+        scene = json.loads(scene)
+      yield scene
+
+
+def iter_questions(path):
+  """
+  Yield the questions in a questions file one at a time. This reads both the
+  single JSON file and the JSON-lines file written by generate_questions.py.
+  """
+  with open(path, 'r') as f:
+    if is_jsonl(path):
+      f.readline()  # info
+      for line in f:
+        if line.strip():
+          yield json.loads(line)
+    else:
+      for key, value in iter_top_level(JSONStream(f), list_key='questions'):
+        if key == 'questions':
+          yield value
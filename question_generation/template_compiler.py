@@ -0,0 +1,329 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import functools, json, os, random, re
+
+"""
+Question templates compiled for instantiate_templates_dfs. Templates are
+compiled once when they are loaded and the compiled form is then used for every
+scene, so that nothing about a template has to be worked out again for each
+scene or each search state:
+
+- every node gets an opcode saying how the search expands it, and the filter
+  nodes get everything needed to expand them (whether they pick out a single
+  object, how many options that match no object to add, the node added after
+  the filters, and for each parameter the filter type and the value used when
+  it is not filtered on);
+- parameter types are looked up once, along with the values of parameters
+  that are expanded to every value of their type;
+- constraints become functions of the search state;
+- whether the template has a raw relate node (and so needs to be checked for
+  degeneracy), whether it requires text, and the conditions for the template
+  to be feasible on a scene (see generate_questions.template_feasible) are
+  worked out once;
+- text templates are split into literal text, parameter slots and optional
+  parts (see tokenize_text), so that the text of a question is made with a
+  single join.
+
+Compiled templates are not changed after compiling, and can be shared by all
+scenes and sent to worker processes.
+"""
+
+# How instantiate_templates_dfs expands each node of a template
+OP_PLAIN = 0  # The node is added to the program as it is
+OP_PARAM = 1  # The node has a parameter, which takes every value of its type
+OP_QUERY_TEXT_Q = 2  # A query_text_q node, which also chooses the <T> value
+OP_FILTER = 3  # Expands to filter nodes, then unique / count / exist
+OP_RELATE_FILTER = 4  # Expands to relate and filter nodes, then the above
+
+FILTER_NODE_TYPES = {
+  'filter_unique', 'filter_text_unique', 'filter_count', 'filter_text_count',
+  'filter_exist', 'filter_text_exist', 'filter_text', 'filter',
+}
+RELATE_FILTER_NODE_TYPES = {
+  'relate_filter', 'relate_filter_unique', 'relate_filter_count',
+  'relate_filter_text_count', 'relate_filter_exist',
+}
+
+# Kinds of segments of tokenized text templates
+TEXT_LITERAL = 0
+TEXT_SLOT = 1
+TEXT_OPTIONAL = 2
+
+TEXT_TOKEN_RE = re.compile(r'(<[^<>\[\]]*>|\[|\])')
+
+# Template nodes that must pick out a single object from the set they filter
+UNIQUE_FILTER_TYPES = {'filter_unique', 'filter_text_unique'}
+
+
+class CompiledNode(object):
+  """
+  A node of a compiled template. type, inputs and side_inputs are those of the
+  template node; the other attributes depend on the opcode.
+  """
+
+  def __init__(self, node, param_name_to_type, metadata):
+    self.type = node['type']
+    self.inputs = tuple(node['inputs'])
+    self.side_inputs = tuple(node.get('side_inputs', ()))
+    self.has_side_inputs = 'side_inputs' in node
+
+    if self.type in FILTER_NODE_TYPES or self.type in RELATE_FILTER_NODE_TYPES:
+      self.compile_filter(param_name_to_type, metadata)
+    elif self.has_side_inputs:
+      # TODO: Generalize this to work for nodes with more than one side input
+      assert len(self.side_inputs) == 1, 'NOT IMPLEMENTED'
+      self.opcode = OP_PARAM
+      self.param_name = self.side_inputs[0]
+      param_type = param_name_to_type[self.param_name]
+      self.param_values = tuple(metadata['types'][param_type])
+    elif self.type == 'query_text_q':
+      self.opcode = OP_QUERY_TEXT_Q
+    else:
+      self.opcode = OP_PLAIN
+
+  def compile_filter(self, param_name_to_type, metadata):
+    filter_side_inputs = self.side_inputs
+    self.relate_param = None
+    if self.type in RELATE_FILTER_NODE_TYPES:
+      self.opcode = OP_RELATE_FILTER
+      self.relate_param = self.side_inputs[0]  # First one should be relate
+      assert param_name_to_type[self.relate_param] == 'Relation'
+      filter_side_inputs = self.side_inputs[1:]
+      self.unique = (self.type == 'relate_filter_unique')
+      self.include_zero = self.type in ('relate_filter_count',
+                                        'relate_filter_exist',
+                                        'relate_filter_text_count')
+    else:
+      self.opcode = OP_FILTER
+      # The null filter is removed for filter nodes
+      self.remove_null = (self.type == 'filter')
+      self.unique = self.type in UNIQUE_FILTER_TYPES
+      # Filter options that do NOT correspond to the scene are added for the
+      # others: for exist an equal number that do and don't, otherwise nulls
+      # equal to the number of singletons
+      self.add_as_many_empty = self.type in ('filter_exist',
+                                             'filter_text_exist')
+
+    # (name, filter node type, value when not filtered on) for each filter
+    self.filter_params = []
+    for param_name in filter_side_inputs:
+      param_type = param_name_to_type[param_name]
+      if metadata['dataset'] == 'CLEVR-v1.0' and param_type == 'Shape':
+        null_value = 'thing'
+      else:
+        null_value = ''
+      self.filter_params.append((param_name, 'filter_%s' % param_type.lower(),
+                                 null_value))
+    self.filter_params = tuple(self.filter_params)
+
+    self.extra_type = None
+    if self.type.endswith('unique'):
+      self.extra_type = 'unique'
+    if self.type.endswith('count'):
+      self.extra_type = 'count'
+    if self.type.endswith('exist'):
+      self.extra_type = 'exist'
+
+
+def check_neq(constraint, p1, p2, state, outputs, verbose):
+  v1, v2 = state['vals'].get(p1), state['vals'].get(p2)
+  if v1 is not None and v2 is not None and v1 != v2:
+    if verbose:
+      print('skipping due to NEQ constraint')
+      print(constraint)
+      print(state['vals'])
+    return 'pruned_neq'
+  return None
+
+
+def check_null(constraint, p, null_value, state, outputs, verbose):
+  v = state['vals'].get(p)
+  if v is not None and v != '' and v != null_value:
+    if verbose:
+      print('skipping due to NULL constraint')
+      print(constraint)
+      print(state['vals'])
+    return 'pruned_null'
+  return None
+
+
+def check_out_neq(constraint, i, j, state, outputs, verbose):
+  i = state['input_map'].get(i, None)
+  j = state['input_map'].get(j, None)
+  if i is not None and j is not None and outputs[i] == outputs[j]:
+    if verbose:
+      print('skipping due to OUT_NEQ constraint')
+      print(outputs[i])
+      print(outputs[j])
+    return 'pruned_out_neq'
+  return None
+
+
+def compile_constraint(constraint, param_name_to_type):
+  """
+  Turn a template constraint into a function check(state, outputs, verbose)
+  of a search state and the outputs of its program, which returns the name of
+  the statistic counting states pruned by the constraint if the state
+  violates it, and None otherwise. The functions are partials of module level
+  functions so that they can be pickled.
+  """
+  if constraint['type'] == 'NEQ':
+    p1, p2 = constraint['params']
+    return functools.partial(check_neq, constraint, p1, p2)
+  elif constraint['type'] == 'NULL':
+    p = constraint['params'][0]
+    null_value = 'thing' if param_name_to_type[p] == 'Shape' else ''
+    return functools.partial(check_null, constraint, p, null_value)
+  elif constraint['type'] == 'OUT_NEQ':
+    i, j = constraint['params']
+    return functools.partial(check_out_neq, constraint, i, j)
+  else:
+    assert False, 'Unrecognized constraint type "%s"' % constraint['type']
+
+
+def feasibility_checks(nodes, with_text):
+  """
+  Derive from the node types of a template the conditions that a scene must
+  meet for the template to have any instantiation on it, so that templates
+  can be skipped on a scene without searching (see
+  generate_questions.template_feasible).
+
+  We follow the objects that each node can output: the first object of the
+  scene picked out by a unique filter, the objects related to it, the other
+  objects with the same attribute and so on. Each node whose output is a
+  single object gets an expression for the objects it may output, and the
+  scene must have at least one of them. Sets built in other ways (e.g. by
+  intersect or union) may contain any objects, so nothing is required of
+  unique filters on them. Templates that require text also need every object
+  to carry text, and query_text nodes need their object to carry text.
+  """
+  checks = []
+  if with_text:
+    checks.append(('all_text',))
+  # Expressions for the output of each node: ('scene',), ('relate', obj),
+  # ('same', attribute, obj) for sets and ('unique', set, with_text) for
+  # objects, where obj and set are the expressions of the inputs; None means
+  # that the output may be any set or object.
+  exprs = []
+  for node in nodes:
+    inputs = [exprs[i] for i in node.inputs]
+    expr = None
+    if node.type == 'scene':
+      expr = ('scene',)
+    elif node.type == 'relate':
+      expr = ('relate', inputs[0])
+    elif node.type.startswith('same_'):
+      expr = ('same', node.type[len('same_'):], inputs[0])
+    elif node.type in UNIQUE_FILTER_TYPES:
+      expr = ('unique', inputs[0], with_text)
+    elif node.type == 'relate_filter_unique':
+      expr = ('unique', ('relate', inputs[0]), with_text)
+    elif node.type.startswith('query_text'):
+      checks.append(('text', inputs[0]))
+    if expr is not None and expr[0] == 'unique':
+      checks.append(expr)
+    exprs.append(expr)
+  return tuple(checks)
+
+
+def tokenize_text(text):
+  """
+  Split a text template into a list of segments, each of which is a pair
+  (TEXT_LITERAL, string), (TEXT_SLOT, parameter name) or (TEXT_OPTIONAL, list
+  of segments) for a part of the text in square brackets. Parts in brackets
+  are optional, and each is removed with probability 0.5; for example
+
+  "A [aa] B [bb]"
+
+  could become any of "A aa B bb", "A B bb", "A aa B" and "A B" with
+  probability 1/4. Names in angle brackets such as <Z> are slots, and brackets
+  without a match are literal text.
+  """
+  stack = [[]]
+  for part in TEXT_TOKEN_RE.split(text):
+    if part == '':
+      continue
+    if part == '[':
+      stack.append([])
+    elif part == ']' and len(stack) > 1:
+      segments = stack.pop()
+      stack[-1].append((TEXT_OPTIONAL, segments))
+    elif part.startswith('<'):
+      stack[-1].append((TEXT_SLOT, part))
+    else:
+      stack[-1].append((TEXT_LITERAL, part))
+  # Brackets that were never closed
+  while len(stack) > 1:
+    segments = stack.pop()
+    stack[-1].append((TEXT_LITERAL, '['))
+    stack[-1].extend(segments)
+  return stack[0]
+
+
+def realize_segments(segments, values, parts):
+  for kind, value in segments:
+    if kind == TEXT_LITERAL:
+      parts.append(value)
+    elif kind == TEXT_SLOT:
+      parts.append(values.get(value, value))
+    else:
+      # Optional parts inside this one are chosen first
+      optional_parts = []
+      realize_segments(value, values, optional_parts)
+      if random.random() > 0.5:
+        parts.extend(optional_parts)
+
+
+def realize_text(segments, values):
+  """
+  Make the text of a question from a tokenized text template, where values
+  maps parameter names to their text. Random choices are made in the same
+  order as the string replacements that this replaces, and whitespace is
+  collapsed to single spaces.
+  """
+  parts = []
+  realize_segments(segments, values, parts)
+  return ' '.join(''.join(parts).split())
+
+
+class CompiledTemplate(object):
+  """
+  A question template compiled for instantiate_templates_dfs; key is its
+  (filename, index) pair.
+  """
+
+  def __init__(self, key, template, metadata):
+    self.key = key
+    self.param_name_to_type = {p['name']: p['type'] for p in template['params']}
+    self.requires_text = bool(template.get('require_text', False))
+    self.nodes = tuple(CompiledNode(node, self.param_name_to_type, metadata)
+                       for node in template['nodes'])
+    self.constraints = tuple(compile_constraint(c, self.param_name_to_type)
+                             for c in template['constraints'])
+    self.text = tuple(template['text'])
+    self.text_tokens = tuple(tokenize_text(text) for text in self.text)
+    # If the template contains a raw relate node then we need to check for
+    # degeneracy at the end
+    self.has_relate = any(node.type == 'relate' for node in self.nodes)
+    self.feasibility_checks = feasibility_checks(self.nodes, self.requires_text)
+
+
+def load_templates(template_dir, metadata):
+  """
+  Load and compile all templates in the JSON files of template_dir. Returns a
+  dict mapping (filename, index in the file) to compiled templates.
+  """
+  templates = {}
+  for fn in os.listdir(template_dir):
+    if not fn.endswith('.json'): continue
+    with open(os.path.join(template_dir, fn), 'r') as f:
+      for i, template in enumerate(json.load(f)):
+        key = (fn, i)
+        templates[key] = CompiledTemplate(key, template, metadata)
+  return templates